@@ -7,10 +7,9 @@ import time
 
 from logging import config, getLogger
 
-from pywxclient.core import Session, SyncClient, parse_message
+from pywxclient.core import Session, SyncClient
 from pywxclient.core.exception import (
-    WaitScanQRCode, RequestError, APIResponseError, SessionExpiredError,
-    AuthorizeTimeout, UnsupportedMessage)
+    WaitScanQRCode, SessionExpiredError, AuthorizeTimeout)
 
 
 LOGGING = {
@@ -61,6 +60,7 @@ def sync_session(client):
         try:
             authorize_success = client.authorize()
         except WaitScanQRCode:
+            time.sleep(1)
             continue
         except AuthorizeTimeout:
             client_log.warning('Waiting for authorization timeout.')
@@ -75,27 +75,13 @@ def sync_session(client):
     client.login()
     client_log.info('Login success...')
 
-    while True:
-        try:
-            sync_ret = client.sync_check()
-            if sync_ret != 0:
-                msgs = client.sync_message()
-                for msg in msgs['AddMsgList']:
-                    try:
-                        msg_obj = parse_message(msg)
-                    except UnsupportedMessage:
-                        client_log.info('unsupported message %s', msg)
-                        continue
-                    else:
-                        client_log.info(
-                            'receive message %s, %s', msg_obj, msg_obj.message)
-
-                client.flush_sync_key()
-        except (RequestError, APIResponseError):
-            client_log.info('api error.')
-        except SessionExpiredError:
-            client_log.warning('wechat session is expired....')
-            break
+    client.register_message_handler(
+        lambda msg_obj: client_log.info(
+            'receive message %s, %s', msg_obj, msg_obj.message))
+    try:
+        client.run_forever()
+    except SessionExpiredError:
+        client_log.warning('wechat session is expired....')
 
 
 @click.group()
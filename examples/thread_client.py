@@ -9,10 +9,9 @@ import time
 
 from logging import config, getLogger
 
-from pywxclient.core import Session, SyncClient, TextMessage, parse_message
+from pywxclient.core import Session, SyncClient, TextMessage
 from pywxclient.core.exception import (
-    WaitScanQRCode, RequestError, APIResponseError, SessionExpiredError,
-    UnsupportedMessage)
+    WaitScanQRCode, RequestError, APIResponseError, SessionExpiredError)
 
 
 LOGGING = {
@@ -77,6 +76,11 @@ def sync_session(client, input_queue, login_event, exit_event):
         try:
             authorize_success = client.authorize()
         except WaitScanQRCode:
+            time.sleep(1)
+            continue
+        except (RequestError, APIResponseError):
+            client_log.info('api error.')
+            time.sleep(2)
             continue
 
         if authorize_success:
@@ -90,30 +94,17 @@ def sync_session(client, input_queue, login_event, exit_event):
     client_log.debug('Login success...')
     login_event.set()
 
-    while True:
-        try:
-            sync_ret = client.sync_check()
-            if sync_ret != 0:
-                msgs = client.sync_message()
-                for msg in msgs['AddMsgList']:
-                    try:
-                        msg_obj = parse_message(msg)
-                    except UnsupportedMessage:
-                        client_log.info('unsupported message %s', msg)
-                        continue
-                    else:
-                        if msg_obj.message:
-                            input_queue.put(msg_obj)
-
-                client.flush_sync_key()
-        except (RequestError, APIResponseError):
-            client_log.info('api error.')
-        except SessionExpiredError:
-            client_log.error('wechat session is expired....')
-            exit_event.set()
-            break
-        except Exception:
-            continue
+    def put_message(msg_obj):
+        if msg_obj.message:
+            input_queue.put(msg_obj)
+
+    client.register_message_handler(put_message)
+    try:
+        client.run_forever()
+    except SessionExpiredError:
+        client_log.error('wechat session is expired....')
+    finally:
+        exit_event.set()
 
 
 def show_input_message(client, input_queue, msg_queue, exit_event):
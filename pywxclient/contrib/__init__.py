@@ -1,7 +1,16 @@
 
 """Contribution package."""
 
+from pywxclient.contrib.avatar import AvatarCache
+from pywxclient.contrib.broadcast import Broadcaster
+from pywxclient.contrib.download import MediaDownloader
 from pywxclient.contrib.file import LocalFile, HTTPFile
+from pywxclient.contrib.outbox import SendQueue, TokenBucket
+from pywxclient.contrib.prefetch import MediaPrefetcher
+from pywxclient.contrib.scheduler import MessageScheduler
 
 
-__all__ = ['LocalFile', 'HTTPFile']
+__all__ = [
+    'LocalFile', 'HTTPFile', 'MediaDownloader', 'MediaPrefetcher',
+    'AvatarCache', 'SendQueue', 'TokenBucket', 'Broadcaster',
+    'MessageScheduler']
@@ -0,0 +1,235 @@
+
+"""Head image and icon disk cache module."""
+
+import collections
+import contextlib
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+from pywxclient.core.exception import RequestError
+from pywxclient.utils import SingleFlight
+
+
+__all__ = ['AvatarCache']
+
+
+class AvatarCache:
+    """Disk LRU cache of head images and icons.
+
+    Cached images are served without request within `max_age` seconds,
+    after that they are revalidated with `If-None-Match` and
+    `If-Modified-Since` headers. Least recently used images are evicted
+    when total size exceeds `max_bytes`. Session specific query parameters
+    like skey are excluded from cache key, so cache survives re-login.
+
+    The cache index is written to disk at most once every
+    `index_save_interval` seconds, call `flush` to write pending changes,
+    e.g. before exit. Images missing from the index on start are removed.
+    """
+
+    index_name = 'index.json'
+    index_save_interval = 5
+    volatile_params = ('skey',)
+
+    _key_pattern = re.compile(r'[0-9a-f]{32}')
+
+    def __init__(
+            self, client, cache_dir, max_bytes=100 * 1024 * 1024,
+            max_age=3600):
+        """Initialize avatar cache.
+
+        :param client: logged in `SyncClient`.
+        :param cache_dir: directory images are saved to.
+        :param max_bytes: maximum total size of cached images.
+        :param max_age: seconds an image is served without revalidation.
+        """
+        self.client = client
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._index = collections.OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._saved_time = time.monotonic()
+        self._in_flight = SingleFlight()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    def make_key(self, url):
+        """Return cache key of image url."""
+        parsed_url = urlparse(url)
+        query = sorted(
+            (key, val) for key, val in parse_qsl(parsed_url.query)
+            if key not in self.volatile_params)
+        return hashlib.md5((
+            parsed_url.path + '?' + urlencode(query)).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _load_index(self):
+        try:
+            with open(self._path(self.index_name)) as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            entries = []
+
+        for key, entry in entries:
+            if os.path.exists(self._path(key)):
+                self._index[key] = entry
+                self._total_bytes += entry['size']
+
+        # Images stored after the last index write aren't accounted
+        for name in os.listdir(self.cache_dir):
+            if (self._key_pattern.fullmatch(name) and
+                    name not in self._index):
+                with contextlib.suppress(OSError):
+                    os.remove(self._path(name))
+
+    def _write_index(self, entries):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entries, f)
+
+        os.replace(tmp_path, self._path(self.index_name))
+
+    def _save_index(self):
+        """Write index if it changed and save interval has passed."""
+        if (self._dirty and time.monotonic() - self._saved_time >=
+                self.index_save_interval):
+            self.flush()
+
+    def flush(self):
+        """Write pending changes of cache index to disk."""
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+
+                entries = [
+                    (key, dict(entry)) for key, entry in self._index.items()]
+                self._dirty = False
+                self._saved_time = time.monotonic()
+
+            self._write_index(entries)
+
+    def _read(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def _store(self, key, content, res):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+
+        os.replace(tmp_path, self._path(key))
+
+        headers = res.headers
+        with self._lock:
+            old_entry = self._index.pop(key, None)
+            if old_entry:
+                self._total_bytes -= old_entry['size']
+
+            self._index[key] = {
+                'size': len(content), 'checked': time.time(),
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified')}
+            self._total_bytes += len(content)
+            self._evict()
+            self._dirty = True
+
+        self._save_index()
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and len(self._index) > 1:
+            key, entry = self._index.popitem(last=False)
+            self._total_bytes -= entry['size']
+            with contextlib.suppress(OSError):
+                os.remove(self._path(key))
+
+    def _get(self, fetch_func, url):
+        # Concurrent requests of the same image share one fetch
+        return self._in_flight.do(
+            self.make_key(url), self._fetch, fetch_func, url)
+
+    def _fetch(self, fetch_func, url):
+        key = self.make_key(url)
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is not None:
+                self._index.move_to_end(key)
+                entry = dict(entry)
+
+        headers = {}
+        if entry is not None:
+            if time.time() - entry['checked'] < self.max_age:
+                content = self._read(key)
+                if content is not None:
+                    return content
+
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        res = fetch_func(url, headers=headers or None)
+        if res.status_code == 304 and entry is not None:
+            content = self._read(key)
+            if content is not None:
+                with self._lock:
+                    if key in self._index:
+                        self._index[key]['checked'] = time.time()
+                        self._dirty = True
+
+                self._save_index()
+                return content
+
+            # Cached file is lost, fetch again unconditionally
+            res = fetch_func(url)
+
+        if res.status_code != 200:
+            raise RequestError
+
+        content = res.content
+        self._store(key, content, res)
+
+        return content
+
+    def get_head_img(self, headimg_url):
+        """Return head image bytes."""
+        return self._get(self.client.get_head_img, headimg_url)
+
+    def get_icon(self, icon_url):
+        """Return icon bytes."""
+        return self._get(self.client.get_icon, icon_url)
+
+    @property
+    def total_bytes(self):
+        """Return total size of cached images."""
+        return self._total_bytes
+
+    def clear(self):
+        """Remove all cached images."""
+        with self._lock:
+            for key in self._index:
+                with contextlib.suppress(OSError):
+                    os.remove(self._path(key))
+
+            self._index.clear()
+            self._total_bytes = 0
+            self._dirty = True
+
+        self.flush()
@@ -0,0 +1,103 @@
+
+"""Broadcast one message to many recipients module."""
+
+import time
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+from logging import getLogger
+
+from pywxclient.contrib.outbox import TokenBucket
+
+
+__all__ = ['Broadcaster', 'BroadcastReport', 'RecipientResult']
+
+
+_logger = getLogger(__name__)
+
+
+RecipientResult = namedtuple(
+    'RecipientResult', ('username', 'local_msg_id', 'msg_id', 'error'))
+
+
+class BroadcastReport(namedtuple('BroadcastReport', ('results', 'elapsed'))):
+    """Broadcast result of each recipient in sending order."""
+
+    __slots__ = ()
+
+    @property
+    def succeeded(self):
+        """Return results of recipients the message was sent to."""
+        return [result for result in self.results if result.error is None]
+
+    @property
+    def failed(self):
+        """Return results of recipients failed to send."""
+        return [result for result in self.results if result.error is not None]
+
+
+class Broadcaster:
+    """Send one message to many recipients.
+
+    Media file is uploaded only once, and the message value is constructed
+    once and copied for each recipient through `MessageBase.for_recipient`.
+    Sends run on a worker pool paced by a token bucket, or go through the
+    `bulk` lane of a `SendQueue` when one is given.
+    """
+
+    def __init__(
+            self, client, max_workers=4, rate=1.0, burst=5, send_queue=None):
+        """Initialize broadcaster.
+
+        :param client: logged in `SyncClient`.
+        :param max_workers: number of concurrent sends.
+        :param rate: messages sent per second.
+        :param burst: maximum burst of messages.
+        :param send_queue: optional `SendQueue` messages are queued to
+            instead, whose rate limits apply.
+        """
+        self.client = client
+        self.max_workers = max_workers
+        self.send_queue = send_queue
+        self._bucket = TokenBucket(rate, burst)
+
+    def _send(self, message):
+        self._bucket.acquire()
+        self.client.send_message(message)
+        return message
+
+    def broadcast(self, message, recipients, file_obj=None):
+        """Send message to recipients and return `BroadcastReport`.
+
+        :param message: message to send, its recipient is ignored.
+        :param recipients: usernames of recipients.
+        :param file_obj: media file uploaded once before sending, whose
+            media id replaces that of message.
+        """
+        recipients = list(recipients)
+        start_time = time.monotonic()
+        if file_obj is not None and recipients:
+            message.update_media_id(
+                self.client.upload(file_obj, recipients[0]))
+
+        messages = [message.for_recipient(username) for username in recipients]
+        if self.send_queue is not None:
+            futures = [
+                self.send_queue.put(msg, priority='bulk') for msg in messages]
+            wait(futures)
+        else:
+            with ThreadPoolExecutor(self.max_workers) as executor:
+                futures = [
+                    executor.submit(self._send, msg) for msg in messages]
+
+        results = []
+        for msg, future in zip(messages, futures):
+            error = future.exception()
+            if error is not None:
+                _logger.warning(
+                    'broadcast message to %s failed: %r', msg.to_user, error)
+
+            results.append(RecipientResult(
+                msg.to_user, msg.local_msg_id, msg.msg_id, error))
+
+        return BroadcastReport(results, time.monotonic() - start_time)
@@ -0,0 +1,184 @@
+
+"""Message media download module."""
+
+import contextlib
+import os
+import requests
+import threading
+import time
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+
+from pywxclient.core.exception import FileTooLarge, RequestError
+from pywxclient.utils import SingleFlight
+
+
+__all__ = ['MediaDownloader', 'DownloadResult']
+
+
+_logger = getLogger(__name__)
+
+
+class DownloadResult(namedtuple(
+        'DownloadResult', ('path', 'size', 'downloaded', 'elapsed',
+                           'resumed'))):
+    """Media download result.
+
+    `size` is the final file size, `downloaded` the bytes transferred by
+    this download, which differs from size when download is resumed or
+    restarted.
+    """
+
+    __slots__ = ()
+
+    @property
+    def throughput(self):
+        """Return download throughput in bytes per second."""
+        return self.downloaded / self.elapsed if self.elapsed else 0.0
+
+
+class MediaDownloader:
+    """Download message media to disk on a bounded thread pool.
+
+    Data is written to a `.part` file in chunks and renamed when complete.
+    A broken download is retried with a http Range request, which resumes
+    from the partial file when the server supports it.
+    """
+
+    chunk_size = 64 * 1024
+    partial_suffix = '.part'
+
+    def __init__(self, client, max_workers=4, max_retries=2):
+        """Initialize downloader.
+
+        :param client: logged in `SyncClient`.
+        :param max_workers: maximum number of concurrent downloads.
+        :param max_retries: retry times of a failed download.
+        """
+        self.client = client
+        self.max_retries = max_retries
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._downloads = 0
+        self._bytes = 0
+        self._elapsed = 0.0
+        self._in_flight = SingleFlight()
+
+    def __enter__(self):
+        """Return downloader itself."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Shut down downloader, waiting for running downloads."""
+        self.shutdown()
+
+    def _fetch(self, message, partial_path, progress, max_size=None):
+        """Download into partial file and update progress dict."""
+        try:
+            offset = os.path.getsize(partial_path)
+        except OSError:
+            offset = 0
+
+        headers = {'Range': 'bytes={0}-'.format(offset)} if offset else None
+        res = self.client.get_message_media(message, headers=headers)
+        with contextlib.closing(res):
+            if res.status_code == 416 and offset:
+                # Partial file is already complete
+                progress['resumed'] = True
+                return
+            elif res.status_code == 206 and offset:
+                mode = 'ab'
+                progress['resumed'] = True
+            elif res.status_code == 200:
+                mode = 'wb'
+            else:
+                raise RequestError
+
+            if mode == 'wb':
+                offset = 0
+
+            content_length = res.headers.get('Content-Length')
+            if (max_size is not None and content_length and
+                    offset + int(content_length) > max_size):
+                raise FileTooLarge
+
+            with open(partial_path, mode) as f:
+                for chunk in res.iter_content(self.chunk_size):
+                    offset += len(chunk)
+                    if max_size is not None and offset > max_size:
+                        raise FileTooLarge
+
+                    f.write(chunk)
+                    progress['downloaded'] += len(chunk)
+
+    def download(self, message, path, max_size=None):
+        """Download message media to path and return `DownloadResult`.
+
+        Concurrent downloads to the same path share one transfer and
+        result.
+
+        :param max_size: maximum media size in bytes, `FileTooLarge` is
+            raised and partial file is removed when exceeded.
+        """
+        return self._in_flight.do(
+            os.path.abspath(path), self._download, message, path, max_size)
+
+    def _download(self, message, path, max_size):
+        partial_path = path + self.partial_suffix
+        start_time = time.monotonic()
+        progress = {'downloaded': 0, 'resumed': False}
+        for retry_idx in range(self.max_retries + 1):
+            try:
+                self._fetch(message, partial_path, progress, max_size)
+            except FileTooLarge:
+                with contextlib.suppress(OSError):
+                    os.remove(partial_path)
+
+                raise
+            except (RequestError, requests.RequestException):
+                if retry_idx == self.max_retries:
+                    raise
+
+                _logger.info(
+                    'retry downloading media of message %s', message.msg_id)
+            else:
+                break
+
+        os.replace(partial_path, path)
+        elapsed = time.monotonic() - start_time
+        downloaded = progress['downloaded']
+
+        with self._lock:
+            self._downloads += 1
+            self._bytes += downloaded
+            self._elapsed += elapsed
+
+        return DownloadResult(
+            path, os.path.getsize(path), downloaded, elapsed,
+            progress['resumed'])
+
+    def submit(self, message, path, max_size=None):
+        """Schedule a media download, return a future of result."""
+        return self._executor.submit(self.download, message, path, max_size)
+
+    def download_all(self, items):
+        """Schedule downloads of (message, path) pairs.
+
+        Return a list of futures in the same order.
+        """
+        return [self.submit(message, path) for message, path in items]
+
+    def stats(self):
+        """Return download count, bytes and average throughput."""
+        with self._lock:
+            return {
+                'downloads': self._downloads, 'bytes': self._bytes,
+                'elapsed': self._elapsed,
+                'throughput': (
+                    self._bytes / self._elapsed if self._elapsed else 0.0)}
+
+    def shutdown(self, wait=True):
+        """Stop accepting downloads and release worker threads."""
+        self._executor.shutdown(wait=wait)
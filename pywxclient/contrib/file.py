@@ -1,13 +1,19 @@
 
 """File object module."""
 
+import contextlib
 import io
+import mmap
 import os
 import requests
+import tempfile
+import threading
 import time
 
 from hashlib import md5
 
+from pywxclient.core.exception import FileTooLarge
+
 
 __all__ = ['LocalFile', 'HTTPFile']
 
@@ -32,12 +38,27 @@ class File:
     mime_prefix_mapping = {
         'pic': 'image/', 'doc': 'application/', 'video': 'video/'}
 
-    def __init__(self, file_bytes):
+    chunk_size = 512 * 1024
+
+    def __init__(self, file_bytes=b'', stream=None, size=None):
+        """Initialize file with bytes or a seekable binary stream."""
+        if stream is None:
+            stream = io.BytesIO(file_bytes)
+            size = len(file_bytes)
 
-        self._stream = io.BytesIO(file_bytes)
-        self._size = len(file_bytes)
+        self._stream = stream
+        self._size = size
+        self._md5 = None
+        self._md5_version = None
+        self._lock = threading.RLock()
         self.name = ''
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     @property
     def size(self):
         """Return file size."""
@@ -50,7 +71,36 @@ class File:
 
     @property
     def md5(self):
-        return md5(self._stream.getbuffer()).hexdigest()
+        """Return file content md5 hex digest.
+
+        The digest is computed once and cached until file content changes.
+        """
+        with self._lock:
+            version = self._content_version()
+            if self._md5 is None or version != self._md5_version:
+                hasher = md5()
+                for chunk in self.iter_chunks():
+                    hasher.update(chunk)
+
+                self._md5 = hasher.hexdigest()
+                self._md5_version = version
+
+            return self._md5
+
+    @property
+    def fingerprint(self):
+        """Return (md5, size) tuple identifying file content."""
+        return self.md5, self._size
+
+    def invalidate_digest(self):
+        """Drop cached md5 digest."""
+        with self._lock:
+            self._md5 = None
+            self._md5_version = None
+
+    def _content_version(self):
+        """Return a token which changes along with file content."""
+        return None
 
     @property
     def last_mtime(self):
@@ -63,46 +113,137 @@ class File:
         short_type = self.short_type()
         return self.mime_prefix_mapping[short_type] + self._type
 
+    def read_at(self, offset, size):
+        """Read at most size bytes from offset keeping current position."""
+        with self._lock:
+            pos = self._stream.tell()
+            try:
+                self._stream.seek(offset)
+                return self._stream.read(size)
+            finally:
+                self._stream.seek(pos)
+
+    def iter_chunks(self, chunk_size=None, offset=0):
+        """Iterate file content by chunks without moving position."""
+        chunk_size = chunk_size or self.chunk_size
+        while offset < self._size:
+            chunk = self.read_at(offset, chunk_size)
+            if not chunk:
+                break
+
+            offset += len(chunk)
+            yield chunk
+
     def read(self, size=None):
-        return self._stream.read(size)
+        with self._lock:
+            if size is None:
+                size = -1
+
+            return self._stream.read(size)
 
     def seekable(self):
-        return self._stream.seekable()
+        return True
 
     def seek(self, pos, whence=0):
-        return self._stream.seek(pos, whence)
+        with self._lock:
+            return self._stream.seek(pos, whence)
+
+    def tell(self):
+        with self._lock:
+            return self._stream.tell()
 
     def closed(self):
-        return self._stream.closed()
+        return self._stream.closed
 
     def close(self):
         return self._stream.close()
 
     def fileno(self):
-        return self._stream.fileno()
+        fileno = getattr(self._stream, 'fileno', None)
+        if fileno is None:
+            # Memory map doesn't expose its file descriptor
+            raise io.UnsupportedOperation('fileno')
+
+        return fileno()
 
 
 class LocalFile(File):
-    """Local disk file."""
+    """Local disk file.
 
-    def __init__(self, file_path):
-        """Initialize `LocalFile` instance."""
-        with open(file_path, 'rb') as f:
-            super(LocalFile, self).__init__(f.read())
+    File content is read from disk on demand, through a read-only memory
+    map by default, or through the file descriptor when `use_mmap` is
+    false.
+    """
 
+    def __init__(self, file_path, use_mmap=True):
+        """Initialize `LocalFile` instance."""
+        disk_file = open(file_path, 'rb')
+        file_stat = os.fstat(disk_file.fileno())
+        stream = disk_file
+        if use_mmap and file_stat.st_size:
+            # Empty file can't be mapped
+            try:
+                stream = mmap.mmap(
+                    disk_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                # Fall back to reading through file descriptor
+                pass
+            else:
+                disk_file.close()
+
+        super(LocalFile, self).__init__(
+            stream=stream, size=file_stat.st_size)
+
+        self._path = file_path
         self.name = os.path.basename(file_path)
         __, file_ext = os.path.splitext(self.name)
         self._type = file_ext[1:]
-        self._last_mtime = os.stat(file_path).st_mtime
+        self._last_mtime = file_stat.st_mtime
 
+    def _content_version(self):
+        """Return file size and modification time on disk."""
+        try:
+            file_stat = os.stat(self._path)
+        except OSError:
+            return None
 
-class HTTPFile(File):
-    """HTTP file."""
+        return file_stat.st_size, file_stat.st_mtime_ns
 
-    def __init__(self, file_url):
-        """Initialize `HTTPFile` instance."""
-        res = requests.get(file_url)
-        super(HTTPFile, self).__init__(res.content)
+
+class HTTPFile(File):
+    """HTTP file.
+
+    By default the whole response body is kept in memory. In stream mode
+    the body is downloaded in chunks into a `SpooledTemporaryFile`, which
+    rolls over to disk beyond `spool_size`, while md5 and size are
+    computed along the way.
+    """
+
+    spool_size = 4 * 1024 * 1024
+    download_chunk_size = 64 * 1024
+
+    def __init__(self, file_url, stream=False, max_size=None, timeout=None):
+        """Initialize `HTTPFile` instance.
+
+        :param file_url: file url.
+        :param stream: whether to spool response body instead of keeping
+            it in memory.
+        :param max_size: maximum file size in bytes, `FileTooLarge` is
+            raised when exceeded.
+        :param timeout: http request timeout.
+        """
+        res = requests.get(file_url, stream=stream, timeout=timeout)
+        if stream:
+            with contextlib.closing(res):
+                file_stream, size, digest = self._spool(res, max_size)
+
+            super(HTTPFile, self).__init__(stream=file_stream, size=size)
+            self._md5 = digest
+        else:
+            if max_size is not None and len(res.content) > max_size:
+                raise FileTooLarge
+
+            super(HTTPFile, self).__init__(res.content)
 
         self.name = os.path.basename(file_url)
 
@@ -123,3 +264,29 @@ class HTTPFile(File):
 
         self._type = res.headers['Content-Type'].split('/')[1]
         self._last_mtime = time.time()
+
+    def _spool(self, res, max_size):
+        """Spool response body, return (stream, size, md5 digest)."""
+        content_length = res.headers.get('Content-Length')
+        if (max_size is not None and content_length and
+                int(content_length) > max_size):
+            raise FileTooLarge
+
+        spool_file = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        hasher = md5()
+        size = 0
+        try:
+            for chunk in res.iter_content(self.download_chunk_size):
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    raise FileTooLarge
+
+                hasher.update(chunk)
+                spool_file.write(chunk)
+        except BaseException:
+            spool_file.close()
+            raise
+
+        spool_file.seek(0)
+
+        return spool_file, size, hasher.hexdigest()
@@ -0,0 +1,400 @@
+
+"""Rate limited outbound message queue module."""
+
+import collections
+import threading
+import time
+
+from concurrent.futures import Future
+from logging import getLogger
+
+from pywxclient.core.exception import APIResponseError, SendQueueFull
+from pywxclient.core.metrics import default_instrumentation
+
+
+__all__ = ['TokenBucket', 'SendQueue']
+
+
+_logger = getLogger(__name__)
+
+
+class TokenBucket:
+    """Token bucket rate limiter.
+
+    Tokens are refilled at `rate` per second up to `capacity`, which is the
+    allowed burst size.
+    """
+
+    def __init__(self, rate, capacity=1):
+        """Initialize a full bucket."""
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._timestamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._timestamp) * self.rate)
+        self._timestamp = now
+
+    def delay(self, tokens=1):
+        """Return seconds until tokens are available."""
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                return 0.0
+
+            return (tokens - self._tokens) / self.rate
+
+    def consume(self, tokens=1):
+        """Take tokens if available and return whether they are taken."""
+        with self._lock:
+            self._refill()
+            if self._tokens < tokens:
+                return False
+
+            self._tokens -= tokens
+            return True
+
+    def acquire(self, tokens=1, timeout=None):
+        """Wait until tokens are taken, return False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.consume(tokens):
+            delay = self.delay(tokens)
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining < delay:
+                    return False
+
+            time.sleep(delay)
+
+        return True
+
+    def drain(self):
+        """Drop all available tokens."""
+        with self._lock:
+            self._refill()
+            self._tokens = 0.0
+
+    def is_full(self):
+        """Indicate whether the bucket is refilled to capacity."""
+        with self._lock:
+            self._refill()
+            return self._tokens >= self.capacity
+
+
+class _SendItem:
+
+    __slots__ = ('message', 'file_obj', 'future', 'lane', 'enqueue_time')
+
+    def __init__(self, message, file_obj, future, lane):
+        self.message = message
+        self.file_obj = file_obj
+        self.future = future
+        self.lane = lane
+        self.enqueue_time = time.monotonic()
+
+
+class SendQueue:
+    """Send messages of a client through a bounded, rate limited queue.
+
+    Messages are sent in order by a dispatcher thread as long as both the
+    account token bucket and the token bucket of recipient allow it. A
+    recipient which is out of tokens doesn't hold back messages to other
+    recipients, while messages to the same recipient keep their order.
+    When the server rejects a message all account tokens are dropped, so
+    sending pauses before the account is restricted.
+
+    Messages are queued in priority lanes, `interactive`, `normal` and
+    `bulk` by default. Lanes are served by smooth weighted round robin over
+    lanes having a sendable message, so bulk sends take only a small share
+    of the account rate while replies are pending. A message waiting longer
+    than `starvation_timeout` is sent next regardless of its lane.
+
+    Waiting time of each message is emitted as a `queue` metric event named
+    `send_message`, labeled by its lane.
+    """
+
+    max_idle_buckets = 10000
+    default_lane_weights = (('interactive', 8), ('normal', 3), ('bulk', 1))
+    default_lane = 'normal'
+
+    def __init__(
+            self, client, maxsize=1000, account_rate=1.0, account_burst=5,
+            recipient_rate=0.5, recipient_burst=3, block=True,
+            instrumentation=None, lane_weights=None, starvation_timeout=60):
+        """Initialize send queue and start dispatcher thread.
+
+        :param client: logged in `SyncClient`.
+        :param maxsize: maximum number of queued messages.
+        :param account_rate: messages sent per second of the account.
+        :param account_burst: maximum burst of account messages.
+        :param recipient_rate: messages sent per second to a recipient.
+        :param recipient_burst: maximum burst of messages to a recipient.
+        :param block: whether `put` waits for free space by default, or
+            raises `SendQueueFull` immediately.
+        :param instrumentation: `Instrumentation` receiving queue metrics.
+        :param lane_weights: dict of lane weights, updating the default
+            lanes.
+        :param starvation_timeout: seconds after which a waiting message is
+            sent before messages of other lanes.
+        """
+        self.client = client
+        self.maxsize = maxsize
+        self.recipient_rate = recipient_rate
+        self.recipient_burst = recipient_burst
+        self.block = block
+        self.instrumentation = instrumentation or default_instrumentation
+        self.starvation_timeout = starvation_timeout
+        self.lane_weights = collections.OrderedDict(self.default_lane_weights)
+        self.lane_weights.update(lane_weights or {})
+        self._account_bucket = TokenBucket(account_rate, account_burst)
+        self._recipient_buckets = {}
+        self._lanes = collections.OrderedDict(
+            (lane, collections.deque()) for lane in self.lane_weights)
+        self._credits = dict.fromkeys(self.lane_weights, 0)
+        self._size = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._rejected = 0
+        self._lane_stats = {
+            lane: {
+                'sent': 0, 'failed': 0, 'wait_time': 0.0,
+                'max_wait_time': 0.0}
+            for lane in self.lane_weights}
+
+        self._worker = threading.Thread(
+            target=self._run, name='send-queue', daemon=True)
+        self._worker.start()
+
+    def __len__(self):
+        """Return number of queued messages."""
+        return self._size
+
+    def __enter__(self):
+        """Return queue itself."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Shut down queue, waiting for queued messages being sent."""
+        self.shutdown()
+
+    def put(
+            self, message, file_obj=None, block=None, timeout=None,
+            priority=None):
+        """Queue a message and return a future of the sent message.
+
+        :param file_obj: file of media message, see
+            `SyncClient.send_message`.
+        :param block: whether to wait for free space, defaults to the queue
+            setting.
+        :param timeout: seconds to wait for free space.
+        :param priority: lane name, defaults to `normal`.
+        """
+        lane = priority or self.default_lane
+        if lane not in self._lanes:
+            raise ValueError('unknown priority lane {0!r}'.format(lane))
+
+        block = self.block if block is None else block
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._size >= self.maxsize and not self._closed:
+                remaining = (
+                    None if deadline is None else deadline - time.monotonic())
+                if not block or (remaining is not None and remaining <= 0):
+                    self._rejected += 1
+                    raise SendQueueFull
+
+                self._cond.wait(remaining)
+
+            if self._closed:
+                raise RuntimeError('send queue is shut down')
+
+            future = Future()
+            self._lanes[lane].append(
+                _SendItem(message, file_obj, future, lane))
+            self._size += 1
+            self._cond.notify_all()
+
+        return future
+
+    def _recipient_bucket(self, username):
+        bucket = self._recipient_buckets.get(username)
+        if bucket is None:
+            if len(self._recipient_buckets) >= self.max_idle_buckets:
+                # Full buckets behave like new ones, so they can be dropped
+                self._recipient_buckets = {
+                    name: bucket
+                    for name, bucket in self._recipient_buckets.items()
+                    if not bucket.is_full()}
+
+            bucket = self._recipient_buckets[username] = TokenBucket(
+                self.recipient_rate, self.recipient_burst)
+
+        return bucket
+
+    def _first_ready(self, pending, recipient_delays):
+        """Return the first sendable item of lane and minimum delay."""
+        delay = None
+        for item in list(pending):
+            if item.future.cancelled():
+                pending.remove(item)
+                self._size -= 1
+                continue
+
+            username = item.message.to_user
+            recipient_delay = recipient_delays.get(username)
+            if recipient_delay is None:
+                recipient_delay = recipient_delays[username] = (
+                    self._recipient_bucket(username).delay())
+
+            if not recipient_delay:
+                return item, None
+
+            delay = (
+                recipient_delay if delay is None else
+                min(delay, recipient_delay))
+
+        return None, delay
+
+    def _next_item(self):
+        """Pop the next sendable item, or return seconds to wait."""
+        account_delay = self._account_bucket.delay()
+        if account_delay:
+            return None, account_delay
+
+        delay = None
+        candidates = collections.OrderedDict()
+        recipient_delays = {}
+        for lane, pending in self._lanes.items():
+            item, lane_delay = self._first_ready(pending, recipient_delays)
+            if item is not None:
+                candidates[lane] = item
+            elif lane_delay is not None:
+                delay = lane_delay if delay is None else min(delay, lane_delay)
+
+        if not candidates:
+            return None, delay
+
+        oldest = min(
+            candidates.values(), key=lambda item: item.enqueue_time)
+        if time.monotonic() - oldest.enqueue_time >= self.starvation_timeout:
+            lane = oldest.lane
+        else:
+            credits = self._credits
+            total_weight = 0
+            for candidate_lane in candidates:
+                weight = self.lane_weights[candidate_lane]
+                credits[candidate_lane] += weight
+                total_weight += weight
+
+            lane = max(candidates, key=credits.get)
+            credits[lane] -= total_weight
+
+        item = candidates[lane]
+        self._account_bucket.consume()
+        self._recipient_bucket(item.message.to_user).consume()
+        self._lanes[lane].remove(item)
+        self._size -= 1
+        return item, None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed and not self._size:
+                        return
+
+                    item, delay = self._next_item()
+                    if item is not None:
+                        # Wake producers waiting for free space
+                        self._cond.notify_all()
+                        break
+
+                    self._cond.wait(delay)
+
+            self._send(item)
+
+    def _send(self, item):
+        if not item.future.set_running_or_notify_cancel():
+            return
+
+        wait_time = time.monotonic() - item.enqueue_time
+        self.instrumentation.emit(
+            'queue', 'send_message', wait_time, labels={'lane': item.lane})
+        error = None
+        try:
+            self.client.send_message(item.message, file_obj=item.file_obj)
+        except Exception as e:
+            if isinstance(e, APIResponseError):
+                _logger.warning(
+                    'message rejected by server, pause sending: %s', e)
+                self._account_bucket.drain()
+
+            error = e
+
+        with self._cond:
+            stats = self._lane_stats[item.lane]
+            stats['failed' if error else 'sent'] += 1
+            stats['wait_time'] += wait_time
+            stats['max_wait_time'] = max(stats['max_wait_time'], wait_time)
+
+        if error is None:
+            item.future.set_result(item.message)
+        else:
+            item.future.set_exception(error)
+
+    @staticmethod
+    def _set_avg_wait_time(stats):
+        handled = stats['sent'] + stats['failed']
+        stats['avg_wait_time'] = (
+            stats['wait_time'] / handled if handled else 0.0)
+
+    def stats(self):
+        """Return queue depth, send counts and message waiting time.
+
+        Statistics of each lane are included in `lanes`.
+        """
+        stats = {
+            'depth': 0, 'sent': 0, 'failed': 0, 'wait_time': 0.0,
+            'max_wait_time': 0.0, 'lanes': {}}
+        with self._cond:
+            stats['rejected'] = self._rejected
+            for lane, pending in self._lanes.items():
+                lane_stats = dict(self._lane_stats[lane], depth=len(pending))
+                self._set_avg_wait_time(lane_stats)
+                stats['lanes'][lane] = lane_stats
+
+                for key in ('depth', 'sent', 'failed', 'wait_time'):
+                    stats[key] += lane_stats[key]
+
+                stats['max_wait_time'] = max(
+                    stats['max_wait_time'], lane_stats['max_wait_time'])
+
+        self._set_avg_wait_time(stats)
+        return stats
+
+    def shutdown(self, wait=True, cancel_pending=False):
+        """Stop accepting messages.
+
+        :param wait: whether to wait for queued messages being sent.
+        :param cancel_pending: whether to cancel queued messages instead of
+            sending them.
+        """
+        with self._cond:
+            self._closed = True
+            if cancel_pending:
+                for pending in self._lanes.values():
+                    for item in pending:
+                        item.future.cancel()
+
+                    pending.clear()
+
+                self._size = 0
+
+            self._cond.notify_all()
+
+        if wait:
+            self._worker.join()
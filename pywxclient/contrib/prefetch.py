@@ -0,0 +1,195 @@
+
+"""Background message media prefetch module."""
+
+import itertools
+import os
+import queue
+import re
+import threading
+
+from concurrent.futures import Future
+from logging import getLogger
+
+from pywxclient.contrib.download import MediaDownloader
+from pywxclient.core.exception import FileTooLarge
+from pywxclient.core.message import (
+    FileMessage, GifImageMessage, ImageMessage, VoiceMessage)
+
+
+__all__ = ['MediaPrefetcher']
+
+
+_logger = getLogger(__name__)
+
+
+class MediaPrefetcher:
+    """Prefetch media of incoming messages into a local cache directory.
+
+    Messages are downloaded by a bounded pool of worker threads in order of
+    their type priority, the lower value first. `feed` returns a
+    `concurrent.futures.Future` which resolves to the local file path, it
+    can be awaited in asyncio code through `asyncio.wrap_future`.
+    """
+
+    default_priorities = {
+        ImageMessage.msg_type: 0, GifImageMessage.msg_type: 0,
+        VoiceMessage.msg_type: 1, FileMessage.msg_type: 2}
+
+    default_size_limits = {
+        ImageMessage.msg_type: 10 * 1024 * 1024,
+        GifImageMessage.msg_type: 10 * 1024 * 1024,
+        VoiceMessage.msg_type: 2 * 1024 * 1024,
+        FileMessage.msg_type: 50 * 1024 * 1024}
+
+    file_exts = {
+        ImageMessage.msg_type: 'jpg', GifImageMessage.msg_type: 'gif',
+        VoiceMessage.msg_type: 'mp3'}
+
+    _file_ext_pattern = re.compile(r'[A-Za-z0-9]{1,10}')
+
+    def __init__(
+            self, client, cache_dir, max_workers=2, max_pending=1000,
+            priorities=None, size_limits=None):
+        """Initialize prefetcher.
+
+        :param client: logged in `SyncClient`.
+        :param cache_dir: directory media files are saved to.
+        :param max_workers: number of download threads.
+        :param max_pending: maximum number of queued messages.
+        :param priorities: dict mapping message type to priority, messages
+            of other types are ignored.
+        :param size_limits: dict mapping message type to maximum size.
+        """
+        self.cache_dir = cache_dir
+        self.priorities = dict(self.default_priorities, **(priorities or {}))
+        self.size_limits = dict(
+            self.default_size_limits, **(size_limits or {}))
+        self._downloader = MediaDownloader(client)
+        self._queue = queue.PriorityQueue(maxsize=max_pending)
+        self._counter = itertools.count()
+        self._handles = {}
+        self._lock = threading.Lock()
+        self._workers = []
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+        for idx in range(max_workers):
+            worker = threading.Thread(
+                target=self._run, name='media-prefetch-{0}'.format(idx),
+                daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def get_path(self, message):
+        """Return local cache path of message media."""
+        msg_type = message.msg_type
+        ext = self.file_exts.get(msg_type, 'bin')
+        if msg_type == FileMessage.msg_type:
+            # File extension comes from sender, which mustn't escape cache
+            # directory
+            if self._file_ext_pattern.fullmatch(message.fileext or ''):
+                ext = message.fileext
+
+        return os.path.join(
+            self.cache_dir, '{0}.{1}'.format(message.msg_id, ext))
+
+    def feed(self, message):
+        """Schedule prefetching media of message.
+
+        Return a future of local file path, or None when message type isn't
+        prefetched, the media exceeds size limit or the queue is full.
+        """
+        priority = self.priorities.get(message.msg_type)
+        if priority is None:
+            return None
+
+        size_limit = self.size_limits.get(message.msg_type)
+        if (message.msg_type == FileMessage.msg_type and
+                size_limit is not None and message.filesize > size_limit):
+            return None
+
+        path = self.get_path(message)
+        with self._lock:
+            handle = self._handles.get(message.msg_id)
+            if handle is not None:
+                return handle
+
+            handle = Future()
+            if os.path.exists(path):
+                handle.set_result(path)
+                return handle
+
+            try:
+                self._queue.put_nowait((
+                    priority, next(self._counter), message, path, handle))
+            except queue.Full:
+                _logger.warning(
+                    'media prefetch queue is full, skip message %s',
+                    message.msg_id)
+                return None
+
+            self._handles[message.msg_id] = handle
+
+        return handle
+
+    def get(self, message):
+        """Return prefetch future of message, or None if not scheduled."""
+        with self._lock:
+            handle = self._handles.get(message.msg_id)
+
+        if handle is None:
+            path = self.get_path(message)
+            if os.path.exists(path):
+                handle = Future()
+                handle.set_result(path)
+
+        return handle
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item[2] is None:
+                    # Stop signal
+                    return
+
+                self._prefetch(*item[2:])
+            finally:
+                self._queue.task_done()
+
+    def _prefetch(self, message, path, handle):
+        if not handle.set_running_or_notify_cancel():
+            self._release(message)
+            return
+
+        try:
+            self._downloader.download(
+                message, path,
+                max_size=self.size_limits.get(message.msg_type))
+        except FileTooLarge as e:
+            _logger.info('skip prefetching large media %s', message.msg_id)
+            handle.set_exception(e)
+        except Exception as e:
+            _logger.exception('prefetch media %s failed', message.msg_id)
+            handle.set_exception(e)
+        else:
+            handle.set_result(path)
+        finally:
+            self._release(message)
+
+    def _release(self, message):
+        with self._lock:
+            self._handles.pop(message.msg_id, None)
+
+    def shutdown(self, wait=True):
+        """Stop workers after queued messages are processed."""
+        for __ in self._workers:
+            # Stop signals sort after all pending messages
+            self._queue.put((float('inf'), next(self._counter), None, None,
+                             None))
+
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+        self._downloader.shutdown(wait=wait)
@@ -0,0 +1,315 @@
+
+"""Scheduled message delivery module."""
+
+import functools
+import heapq
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+from concurrent.futures import CancelledError, Future
+from logging import getLogger
+
+from pywxclient.core.message import (
+    FileMessage, GifImageMessage, ImageMessage, MediaMessagebase,
+    TextMessage, VideoMessage)
+
+
+__all__ = ['MessageScheduler']
+
+
+_logger = getLogger(__name__)
+
+
+_schedulable_messages = {
+    msg_cls.msg_type: msg_cls
+    for msg_cls in (
+        TextMessage, ImageMessage, GifImageMessage, VideoMessage,
+        FileMessage)}
+
+
+def _dump_message(message):
+    # Local id is kept, so a retried or restored send is recognized by
+    # `SendLedger` as the same message
+    data = {
+        'type': message.msg_type, 'from_user': message.from_user,
+        'to_user': message.to_user, 'message': message.message,
+        'local_msg_id': message.local_msg_id}
+    if isinstance(message, MediaMessagebase):
+        data['media_id'] = message.media_id
+    if isinstance(message, FileMessage):
+        data.update(
+            filename=message.filename, filesize=message.filesize,
+            fileext=message.fileext)
+
+    return data
+
+
+def _load_message(data):
+    data = dict(data)
+    msg_cls = _schedulable_messages[data.pop('type')]
+    return msg_cls(data.pop('from_user'), data.pop('to_user'), **data)
+
+
+class MessageScheduler:
+    """Send messages at their due time.
+
+    Jobs are kept in a heap ordered by due time, a single worker thread
+    sleeps until the earliest job is due, so waking up costs O(1) however
+    many jobs are pending, and scheduling or cancelling costs O(log n).
+
+    When `path` is given, jobs are journaled to that file as json lines and
+    restored on start, jobs which became due while the process was down
+    are sent at once. A job is removed from journal only after it's sent,
+    so a job being sent when the process stops is sent again on restart.
+    The journal is compacted when it grows to twice the number of pending
+    jobs.
+
+    A failed send is retried after `retry_delay`, doubled on each attempt,
+    until `max_attempts` is reached.
+    """
+
+    min_compact_size = 1000
+
+    def __init__(
+            self, client, path=None, sender=None, max_attempts=3,
+            retry_delay=30):
+        """Initialize scheduler and start worker thread.
+
+        :param client: logged in `SyncClient`.
+        :param path: optional journal file of scheduled messages.
+        :param sender: callable sending a due message, defaults to
+            `client.send_message`, e.g. `SendQueue.put` for rate limiting.
+            A returned `concurrent.futures.Future` is awaited for the send
+            result.
+        :param max_attempts: maximum number of sends of a job.
+        :param retry_delay: seconds before the first retry of a failed
+            send.
+        """
+        self.client = client
+        self.path = path
+        self.sender = sender or client.send_message
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._jobs = {}
+        self._sending = {}
+        self._attempts = {}
+        self._heap = []
+        self._journal = None
+        self._journal_size = 0
+        self._cond = threading.Condition()
+        self._closed = False
+
+        if path:
+            self._load()
+
+        self._worker = threading.Thread(
+            target=self._run, name='message-scheduler', daemon=True)
+        self._worker.start()
+
+    def __len__(self):
+        """Return number of pending jobs, including those being sent."""
+        return len(self._jobs) + len(self._sending)
+
+    def __enter__(self):
+        """Return scheduler itself."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Shut down scheduler, keeping pending jobs in journal."""
+        self.shutdown()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Partially written last line
+                        continue
+
+                    if record['op'] == 'add':
+                        self._jobs[record['id']] = (
+                            record['due'], record['message'])
+                    else:
+                        self._jobs.pop(record['id'], None)
+        except IOError:
+            pass
+
+        self._rebuild_heap()
+        self._compact()
+
+    def _rebuild_heap(self):
+        self._heap = [
+            (due, job_id) for job_id, (due, __) in self._jobs.items()]
+        heapq.heapify(self._heap)
+
+    def _compact(self):
+        """Rewrite journal with pending jobs only."""
+        if self._journal is not None:
+            self._journal.close()
+
+        dir_name = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=dir_name, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            for jobs in (self._jobs, self._sending):
+                for job_id, (due, msg_data) in jobs.items():
+                    f.write(json.dumps({
+                        'op': 'add', 'id': job_id, 'due': due,
+                        'message': msg_data}) + '\n')
+
+        os.replace(tmp_path, self.path)
+        self._journal = open(self.path, 'a')
+        self._journal_size = len(self)
+
+    def _write_journal(self, record):
+        if self._journal is None:
+            return
+
+        self._journal.write(json.dumps(record) + '\n')
+        self._journal.flush()
+        self._journal_size += 1
+        if self._journal_size > max(self.min_compact_size, 2 * len(self)):
+            self._compact()
+
+    def schedule(self, message, at=None, delay=None):
+        """Schedule message and return job id.
+
+        :param at: unix timestamp the message is sent at.
+        :param delay: seconds from now the message is sent after.
+        """
+        if message.msg_type not in _schedulable_messages:
+            raise ValueError(
+                'message type {0} can not be scheduled'.format(
+                    message.msg_type))
+
+        due = at if at is not None else time.time() + (delay or 0)
+        job_id = uuid.uuid4().hex
+        msg_data = _dump_message(message)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('scheduler is shut down')
+
+            self._jobs[job_id] = (due, msg_data)
+            heapq.heappush(self._heap, (due, job_id))
+            self._write_journal({
+                'op': 'add', 'id': job_id, 'due': due, 'message': msg_data})
+            if self._heap[0][1] == job_id:
+                # New earliest job
+                self._cond.notify()
+
+        return job_id
+
+    def cancel(self, job_id):
+        """Cancel a pending job, return whether it's cancelled.
+
+        A job which is being sent can't be cancelled.
+        """
+        with self._cond:
+            if self._jobs.pop(job_id, None) is None:
+                return False
+
+            self._attempts.pop(job_id, None)
+            self._write_journal({'op': 'del', 'id': job_id})
+            if len(self._heap) > max(
+                    self.min_compact_size, 2 * len(self._jobs)):
+                # Drop heap entries of cancelled jobs
+                self._rebuild_heap()
+
+        return True
+
+    def _next_due(self):
+        """Pop a due job or return seconds until the earliest job."""
+        heap = self._heap
+        while heap:
+            due, job_id = heap[0]
+            if job_id not in self._jobs:
+                # Cancelled job
+                heapq.heappop(heap)
+                continue
+
+            delay = due - time.time()
+            if delay > 0:
+                return None, delay
+
+            heapq.heappop(heap)
+            job = self._sending[job_id] = self._jobs.pop(job_id)
+            return (job_id, job[1]), None
+
+        return None, None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        return
+
+                    job, delay = self._next_due()
+                    if job is not None:
+                        break
+
+                    self._cond.wait(delay)
+
+            job_id, msg_data = job
+            try:
+                result = self.sender(_load_message(msg_data))
+            except Exception as e:
+                self._finish(job_id, e)
+                continue
+
+            if isinstance(result, Future):
+                result.add_done_callback(
+                    functools.partial(self._on_sent, job_id))
+            else:
+                self._finish(job_id)
+
+    def _on_sent(self, job_id, future):
+        error = (
+            CancelledError() if future.cancelled() else future.exception())
+        self._finish(job_id, error)
+
+    def _finish(self, job_id, error=None):
+        """Remove a sent job, or reschedule it when send failed."""
+        with self._cond:
+            due, msg_data = self._sending.pop(job_id)
+            attempts = self._attempts.pop(job_id, 0) + 1
+            if error is not None and attempts < self.max_attempts:
+                delay = self.retry_delay * 2 ** (attempts - 1)
+                due = time.time() + delay
+                _logger.warning(
+                    'send scheduled message %s failed, retry in %ss: %r',
+                    job_id, delay, error)
+                self._attempts[job_id] = attempts
+                self._jobs[job_id] = (due, msg_data)
+                heapq.heappush(self._heap, (due, job_id))
+                self._write_journal({
+                    'op': 'add', 'id': job_id, 'due': due,
+                    'message': msg_data})
+                self._cond.notify()
+                return
+
+            if error is not None:
+                _logger.error(
+                    'send scheduled message %s failed %d times, give up: %r',
+                    job_id, attempts, error)
+
+            self._write_journal({'op': 'del', 'id': job_id})
+
+    def shutdown(self, wait=True):
+        """Stop worker, pending jobs are kept in journal."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+        if wait:
+            self._worker.join()
+
+        with self._cond:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
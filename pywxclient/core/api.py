@@ -5,12 +5,19 @@ import functools
 import json
 import math
 import random
+import requests
+import threading
 import time
 
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 from logging import getLogger
 
+from pywxclient.core.endpoint import EndpointSelector
 from pywxclient.core.exception import (
     APIResponseError, SessionExpiredError, LoginError, RequestError)
+from pywxclient.core.metrics import default_instrumentation
+from pywxclient.core.multipart import MultipartEncoder
+from pywxclient.core.timeout import AdaptiveTimeout
 from pywxclient.utils import ParseWxRes, json_dumps
 
 
@@ -20,6 +27,19 @@ __all__ = ['WeChatAPI']
 _logger = getLogger(__name__)
 
 
+# Timeouts applied by api calls of current thread, keyed by api name
+_applied_timeouts = threading.local()
+
+
+def _timeout_error(error):
+    """Return requests timeout error wrapped by error, or None."""
+    if isinstance(error, RequestError):
+        # Transport errors are wrapped by session
+        error = error.__cause__
+
+    return error if isinstance(error, requests.Timeout) else None
+
+
 def check_base_response(func):
     """Decorate for checking whether response is ok."""
     @functools.wraps(func)
@@ -41,6 +61,55 @@ def check_base_response(func):
     return wrapper
 
 
+def timed_api(func):
+    """Decorate for recording api latency and metrics."""
+    api_name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(cls, *args, **kwargs):
+
+        applied_timeouts = vars(_applied_timeouts)
+        applied_timeouts.pop(api_name, None)
+        start_time = time.monotonic()
+        try:
+            res = func(cls, *args, **kwargs)
+        except Exception as e:
+            latency = time.monotonic() - start_time
+            cls.instrumentation.emit(
+                'api', api_name, latency, error=type(e).__name__)
+
+            # A timed out call took at least the timeout in force, so the
+            # timeout can grow again. Fast failures like refused connection
+            # mustn't shrink timeout and aren't observed.
+            timeout_error = _timeout_error(e)
+            if timeout_error is not None:
+                timeout = applied_timeouts.pop(api_name, None)
+                if isinstance(timeout, tuple):
+                    timeout = timeout[
+                        0 if isinstance(
+                            timeout_error, requests.ConnectTimeout) else 1]
+                cls.timeout_manager.observe(
+                    api_name, max(latency, timeout or 0))
+            raise
+
+        latency = time.monotonic() - start_time
+        cls.timeout_manager.observe(api_name, latency)
+        if cls.instrumentation.enabled:
+            ret = None
+            if isinstance(res, dict):
+                base_response = res.get('BaseResponse')
+                if base_response:
+                    ret = base_response.get('Ret')
+
+            cls.instrumentation.emit(
+                'api', api_name, latency, ret=ret,
+                status=getattr(res, 'status_code', None))
+
+        return res
+
+    return wrapper
+
+
 def decode_json_response(res):
     """Decode wechat latin1 encoded json response."""
     if res.status_code != 200:
@@ -80,11 +149,21 @@ class WeChatAPI:
     oplog_url = '/cgi-bin/mmwebwx-bin/webwxoplog'
     logout_url = '/cgi-bin/mmwebwx-bin/webwxlogout'
 
+    # Sync check retcodes of a session logged out or taken over elsewhere
+    logout_retcodes = ('1100', '1101', '1102')
+
     low_timeout = (10, 15)
     middle_timeout = (15, 30)
     high_timeout = (30, 60)
+    long_poll_timeout = (15, 30)
 
     max_file_body = 512 * 1024  # 512k
+    upload_concurrency = 1
+    upload_chunk_retries = 2
+
+    endpoint_selector = EndpointSelector(wx_endpoints)
+    timeout_manager = AdaptiveTimeout()
+    instrumentation = default_instrumentation
 
     @classmethod
     def get_device_id(cls):
@@ -109,9 +188,36 @@ class WeChatAPI:
         return int(time.time() * 1000)
 
     @classmethod
-    def get_wx_endpoint(cls):
-        """Return wechat api endpoint."""
-        return random.choice(cls.wx_endpoints)
+    def get_wx_endpoint(cls, exclude=None):
+        """Return the preferred wechat api endpoint.
+
+        :param exclude: endpoints which should be avoided if possible.
+        """
+        return cls.endpoint_selector.select(exclude=exclude)
+
+    @classmethod
+    def probe_endpoints(cls, session):
+        """Probe login host of all endpoints to measure latency."""
+        def probe(endpoint):
+            api_path = cls.api_url_template.format(
+                schema=cls.schema, endpoint=cls.login_sub_host + endpoint,
+                url=cls.qrcode_uuid_url)
+            res = session.request('HEAD', api_path, timeout=cls.low_timeout)
+            if not 200 <= res.status_code < 400:
+                # Server error or captive portal page
+                raise RequestError
+
+        cls.endpoint_selector.probe(probe)
+
+        return cls.endpoint_selector.stats()
+
+    @classmethod
+    def get_timeout(cls, api_name, default):
+        """Return adaptive timeout of api bounded by default timeout."""
+        timeout = cls.timeout_manager.get(api_name, default)
+        # Timed out calls are observed with the applied timeout
+        vars(_applied_timeouts)[api_name] = timeout
+        return timeout
 
     @classmethod
     def get_login_endpoint(cls, session):
@@ -129,6 +235,7 @@ class WeChatAPI:
         return cls.file_sub_host + session.wx_endpoint
 
     @classmethod
+    @timed_api
     def get_qrcode_uuid(cls, session):
         """Get login qrcode uuid."""
         api_path = cls.api_url_template.format(
@@ -136,8 +243,25 @@ class WeChatAPI:
             url=cls.qrcode_uuid_url)
         params = {
             'appid': cls.appid, 'fun': 'new', '_': cls.get_client_msg_id()}
-        res = session.get(api_path, params=params, timeout=cls.middle_timeout)
 
+        wx_endpoint = session.wx_endpoint
+        start_time = time.monotonic()
+        try:
+            res = session.get(
+                api_path, params=params, timeout=cls.middle_timeout)
+            if res.status_code != 200:
+                raise RequestError
+        except RequestError:
+            cls.endpoint_selector.record(wx_endpoint, error=True)
+            if not session.authorized:
+                # Select another endpoint for the next try
+                session.wx_endpoint = cls.get_wx_endpoint(
+                    exclude=(wx_endpoint,))
+
+            raise
+
+        cls.endpoint_selector.record(
+            wx_endpoint, time.monotonic() - start_time)
         data = ParseWxRes.parse_qrcode_uuid(res.content)
 
         return data['uuid']
@@ -150,6 +274,7 @@ class WeChatAPI:
             url=cls.qrcode_url, uuid=uuid)
 
     @classmethod
+    @timed_api
     def get_login_info(cls, session, uuid):
         """Get login authorize info."""
         api_path = cls.api_url_template.format(
@@ -159,20 +284,20 @@ class WeChatAPI:
         params = {
             'loginicon': 'true', 'uuid': uuid, 'tip': 0,
             '_': msg_id, 'r': msg_id // 1992}
-        res = session.get(api_path, params=params, timeout=cls.middle_timeout)
-        _logger.debug('wechat login info res %s', res.content)
+        res = session.get(
+            api_path, params=params, timeout=cls.long_poll_timeout)
         data = ParseWxRes.parse_login(res.content)
 
         return data
 
     @classmethod
+    @timed_api
     def new_login_page(cls, session, login_api_path):
         """Create login page."""
         now_timestamp = int(time.time())
         params = {'scan': now_timestamp, 'version': 2, 'fun': 'new'}
         res = session.get(
             login_api_path, params=params, timeout=cls.middle_timeout)
-        _logger.debug('wechat new login page res %s', res.content)
         data = ParseWxRes.parse_new_login_page(res.content)
         if data['ret'] != '0':
             raise LoginError(data['message'])
@@ -181,6 +306,7 @@ class WeChatAPI:
 
     @classmethod
     @check_base_response
+    @timed_api
     def wx_init(cls, session):
         """Initialize WeChat session."""
         api_path = cls.api_url_template.format(
@@ -200,6 +326,7 @@ class WeChatAPI:
 
     @classmethod
     @check_base_response
+    @timed_api
     def notify_status(cls, session, user):
         """Notify session status."""
         api_path = cls.api_url_template.format(
@@ -216,33 +343,42 @@ class WeChatAPI:
         res = session.post(
             api_path, params=params, data=json_dumps(
                 data, compact=True, ensure_ascii=False).encode(),
-            timeout=cls.middle_timeout)
+            timeout=cls.get_timeout(
+                'notify_status', cls.middle_timeout))
 
         return decode_json_response(res)
 
     @classmethod
-    def get_icon(cls, session, icon_url):
+    @timed_api
+    def get_icon(cls, session, icon_url, headers=None):
         """Get user wechat icon."""
         api_path = cls.api_url_template.format(
             schema=cls.schema, endpoint=session.wx_endpoint, url=icon_url)
 
-        res = session.get(api_path, timeout=cls.middle_timeout)
+        res = session.get(
+            api_path, headers=headers,
+            timeout=cls.get_timeout('get_icon', cls.middle_timeout))
 
         return res
 
     @classmethod
-    def get_head_img(cls, session, headimg_url):
+    @timed_api
+    def get_head_img(cls, session, headimg_url, headers=None):
         """Get wechat head img."""
         api_path = cls.api_url_template.format(
             schema=cls.schema, endpoint=session.wx_endpoint,
             url=headimg_url)
 
-        res = session.get(api_path, timeout=cls.middle_timeout)
+        res = session.get(
+            api_path, headers=headers, timeout=cls.get_timeout(
+                'get_head_img', cls.middle_timeout))
 
         return res
 
     @classmethod
-    def get_msg_img(cls, session, msg_id, original=True, stream=True):
+    @timed_api
+    def get_msg_img(
+            cls, session, msg_id, original=True, stream=True, headers=None):
         """Get message image."""
         api_path = cls.api_url_template.format(
             schema=cls.schema, endpoint=session.wx_endpoint,
@@ -254,12 +390,14 @@ class WeChatAPI:
             params['type'] = 'slave'
 
         res = session.get(
-            api_path, params=params, timeout=cls.high_timeout, stream=stream)
+            api_path, params=params, headers=headers,
+            timeout=cls.high_timeout, stream=stream)
 
         return res
 
     @classmethod
-    def get_msg_voice(cls, session, msg_id, stream=True):
+    @timed_api
+    def get_msg_voice(cls, session, msg_id, stream=True, headers=None):
         """Get voice message data."""
         api_path = cls.api_url_template.format(
             schema=cls.schema, endpoint=session.wx_endpoint,
@@ -269,13 +407,16 @@ class WeChatAPI:
         params = {'msgid': msg_id, 'skey': wx_session_data['skey']}
 
         res = session.get(
-            api_path, params=params, timeout=cls.high_timeout, stream=stream)
+            api_path, params=params, headers=headers,
+            timeout=cls.high_timeout, stream=stream)
 
         return res
 
     @classmethod
+    @timed_api
     def get_msg_media(
-            cls, session, from_username, media_id, filename, stream=True):
+            cls, session, from_username, media_id, filename, stream=True,
+            headers=None):
         """Get message media data."""
         api_path = cls.api_url_template.format(
             schema=cls.schema, endpoint=cls.get_file_endpoint(session),
@@ -292,12 +433,14 @@ class WeChatAPI:
             'pass_ticket': pass_ticket, 'webwx_data_ticket': webwx_data_ticket}
 
         res = session.get(
-            api_path, params=params, timeout=cls.high_timeout, stream=stream)
+            api_path, params=params, headers=headers,
+            timeout=cls.high_timeout, stream=stream)
 
         return res
 
     @classmethod
     @check_base_response
+    @timed_api
     def get_contact_list(cls, session):
         """Get user contact list."""
         api_path = cls.api_url_template.format(
@@ -309,12 +452,15 @@ class WeChatAPI:
             'r': cls.get_client_msg_id(), 'seq': 0,
             'skey': wx_session_data['skey']}
 
-        res = session.get(api_path, params=params, timeout=cls.middle_timeout)
+        res = session.get(
+            api_path, params=params, timeout=cls.get_timeout(
+                'get_contact_list', cls.middle_timeout))
 
         return decode_json_response(res)
 
     @classmethod
     @check_base_response
+    @timed_api
     def mget_contact_list(cls, session, user_list):
         """Batch get user contact list."""
         api_path = cls.api_url_template.format(
@@ -334,11 +480,13 @@ class WeChatAPI:
         res = session.post(
             api_path, params=params, data=json_dumps(
                 data, compact=True, ensure_ascii=False).encode(),
-            headers=headers, timeout=cls.middle_timeout)
+            headers=headers, timeout=cls.get_timeout(
+                'mget_contact_list', cls.middle_timeout))
 
         return decode_json_response(res)
 
     @classmethod
+    @timed_api
     def check_sync(cls, session):
         """Check sync status."""
         api_path = cls.api_url_template.format(
@@ -357,12 +505,12 @@ class WeChatAPI:
             'uin': wxuin, 'sid': wxsid, 'skey': skey, 'deviceid': device_id,
             '_': cls.get_client_msg_id(), 'synckey': sync_key_str}
 
-        res = session.get(api_path, params=params, timeout=cls.middle_timeout)
-        _logger.debug('check wechat session sync res %s', res.content)
+        res = session.get(
+            api_path, params=params, timeout=cls.long_poll_timeout)
         data = ParseWxRes.parse_sync_check(res.content)
 
         if not data or data['retcode'] != '0':
-            if data['retcode'] == '1101':
+            if data and data['retcode'] in cls.logout_retcodes:
                 raise SessionExpiredError
 
             raise APIResponseError
@@ -370,8 +518,17 @@ class WeChatAPI:
         return data
 
     @classmethod
-    def upload_file(cls, session, file_obj, from_username, to_username):
-        """Upload file to WeChat."""
+    @timed_api
+    def upload_file(
+            cls, session, file_obj, from_username, to_username,
+            concurrency=None, chunk_retries=None, upload_session=None):
+        """Upload file to WeChat.
+
+        :param concurrency: maximum number of chunks uploaded in parallel.
+        :param chunk_retries: retry times of each failed chunk.
+        :param upload_session: `UploadSession` recording uploaded chunks,
+            an unfinished upload of the same file is resumed from it.
+        """
         api_path = cls.api_url_template.format(
             schema=cls.schema, endpoint=cls.get_file_endpoint(session),
             url=cls.upload_file_url)
@@ -384,57 +541,123 @@ class WeChatAPI:
         data_len = file_obj.size
         data_media_type = file_obj.media_type()
         filename = file_obj.name
+        concurrency = concurrency or cls.upload_concurrency
+        if chunk_retries is None:
+            chunk_retries = cls.upload_chunk_retries
+
+        chunks = math.ceil(data_len / cls.max_file_body)
+        if not chunks:
+            return
+
+        file_md5 = file_obj.md5
+        checkpoint = None
+        if upload_session is not None:
+            checkpoint = upload_session.resume(
+                file_md5, from_username, to_username, chunks)
+            if checkpoint is None:
+                checkpoint = upload_session.start(
+                    file_md5, from_username, to_username,
+                    cls.get_client_msg_id(), chunks)
+            elif checkpoint.done:
+                _logger.info(
+                    'resume uploading %s from %d/%d chunks', filename,
+                    len(checkpoint.done), chunks)
+
+            client_media_id = checkpoint.client_media_id
+            pending_chunks = checkpoint.pending_chunks()
+        else:
+            client_media_id = cls.get_client_msg_id()
+            pending_chunks = list(range(chunks))
 
         upload_req = {
             'UploadType': 2, 'BaseRequest': base_request,
-            'ClientMediaId': cls.get_client_msg_id(), 'TotalLen': data_len,
+            'ClientMediaId': client_media_id, 'TotalLen': data_len,
             'StartPos': 0, 'DataLen': data_len, 'MediaType': 4,
             'FromUserName': from_username, 'ToUserName': to_username,
-            'FileMd5': file_obj.md5}
+            'FileMd5': file_md5}
+
+        # Constant form fields are encoded only once for all chunks
+        encoder = MultipartEncoder((
+            ('id', 'WU_FILE_0'), ('name', filename),
+            ('type', data_media_type),
+            ('lastModifiedDate', file_obj.last_mtime), ('size', data_len),
+            ('mediatype', file_obj.short_type()),
+            ('uploadmediarequest', json_dumps(
+                upload_req, compact=True, ensure_ascii=False).encode()),
+            ('webwx_data_ticket', session_cookies['webwx_data_ticket']),
+            ('pass_ticket', pass_ticket)))
+        headers = {'Content-Type': encoder.content_type}
 
         def upload_chunk(chunk_index=0, chunk_num=1):
-            data = {
-                'id': 'WU_FILE_0', 'name': filename, 'type': data_media_type,
-                'lastModifiedDate': file_obj.last_mtime, 'size': data_len,
-                'mediatype': file_obj.short_type(),
-                'uploadmediarequest': json_dumps(
-                    upload_req, compact=True, ensure_ascii=False).encode(),
-                'webwx_data_ticket': session_cookies['webwx_data_ticket'],
-                'pass_ticket': pass_ticket}
+            extra_fields = ()
             if chunk_num > 1:
-                data['chunk'] = chunk_index
-                data['chunks'] = chunk_num
-                files = {'filename': (
-                    filename, file_obj.read(cls.max_file_body),
-                    data_media_type)}
-            else:
-                files = {'filename': (filename, file_obj, data_media_type)}
+                extra_fields = (('chunk', chunk_index), ('chunks', chunk_num))
+
+            offset = chunk_index * cls.max_file_body
+            body = encoder.encode(
+                'filename', filename, data_media_type, file_obj, offset,
+                min(cls.max_file_body, data_len - offset),
+                extra_fields=extra_fields)
 
             res = session.post(
-                api_path, params=params, data=data, files=files,
+                api_path, params=params, data=body, headers=headers,
                 timeout=cls.high_timeout)
             data = decode_json_response(res)
+            if data['BaseResponse']['Ret'] != 0:
+                raise APIResponseError
 
             return data
 
-        chunks = math.ceil(data_len / cls.max_file_body)
-        for chunk_idx in range(chunks):
-            data = upload_chunk(chunk_idx, chunk_num=chunks)
-            if chunk_idx < chunks - 1:
-                if data['BaseResponse']['Ret'] != 0:
-                    raise APIResponseError
-            else:
-                # The last uploaded chunk response
-                if data['BaseResponse']['Ret'] != 0 or not data['MediaId']:
-                    raise APIResponseError
+        def upload_chunk_retry(chunk_index, chunk_num):
+            for retry_idx in range(chunk_retries + 1):
+                try:
+                    data = upload_chunk(chunk_index, chunk_num)
+                    if checkpoint is not None and chunk_index < chunks - 1:
+                        upload_session.mark_done(checkpoint, chunk_index)
+
+                    return data
+                except (RequestError, APIResponseError):
+                    if retry_idx == chunk_retries:
+                        raise
+
+                    _logger.info(
+                        'retry uploading chunk %d of %s', chunk_index,
+                        filename)
+
+        # The last chunk is uploaded after all others have succeeded,
+        # whose response carries the media id.
+        leading_chunks = [idx for idx in pending_chunks if idx < chunks - 1]
+        if concurrency > 1 and len(leading_chunks) > 1:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                futures = [
+                    executor.submit(upload_chunk_retry, chunk_idx, chunks)
+                    for chunk_idx in leading_chunks]
+                done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+                for future in not_done:
+                    future.cancel()
+
+                for future in done:
+                    # Raise the first chunk error
+                    future.result()
+        else:
+            for chunk_idx in leading_chunks:
+                upload_chunk_retry(chunk_idx, chunks)
+
+        data = upload_chunk_retry(chunks - 1, chunks)
+        if not data['MediaId']:
+            raise APIResponseError
+
+        if data['StartPos'] != data_len:
+            _logger.warning('inconsistent start position value.')
 
-                if data['StartPos'] != data_len:
-                    _logger.warning('inconsistent start position value.')
+        if checkpoint is not None:
+            upload_session.finish(checkpoint)
 
-                return data['MediaId']
+        return data['MediaId']
 
     @classmethod
     @check_base_response
+    @timed_api
     def do_sync(cls, session):
         """Do WeChat session status sync."""
         api_path = cls.api_url_template.format(
@@ -455,12 +678,14 @@ class WeChatAPI:
         res = session.post(
             api_path, params=params, data=json_dumps(
                 data, compact=True, ensure_ascii=False).encode(),
-            headers=headers, timeout=cls.middle_timeout)
+            headers=headers, timeout=cls.get_timeout(
+                'do_sync', cls.middle_timeout))
 
         return decode_json_response(res)
 
     @classmethod
     @check_base_response
+    @timed_api
     def send_text_message(cls, session, message):
         """Send text message api."""
         api_path = cls.api_url_template.format(
@@ -479,12 +704,14 @@ class WeChatAPI:
         res = session.post(
             api_path, params=params, data=json_dumps(
                 data, compact=True, ensure_ascii=False).encode(),
-            headers=headers, timeout=cls.low_timeout)
+            headers=headers, timeout=cls.get_timeout(
+                'send_text_message', cls.low_timeout))
 
         return decode_json_response(res)
 
     @classmethod
     @check_base_response
+    @timed_api
     def send_image_message(cls, session, message):
         """Send image message api."""
         api_path = cls.api_url_template.format(
@@ -502,12 +729,14 @@ class WeChatAPI:
         res = session.post(
             api_path, params=params, data=json_dumps(
                 data, compact=True, ensure_ascii=False).encode(),
-            headers=headers, timeout=cls.low_timeout)
+            headers=headers, timeout=cls.get_timeout(
+                'send_image_message', cls.low_timeout))
 
         return decode_json_response(res)
 
     @classmethod
     @check_base_response
+    @timed_api
     def send_gif_message(cls, session, message):
         """Send gif message api."""
         api_path = cls.api_url_template.format(
@@ -527,12 +756,14 @@ class WeChatAPI:
         res = session.post(
             api_path, params=params, data=json_dumps(
                 data, compact=True, ensure_ascii=False).encode(),
-            headers=headers, timeout=cls.low_timeout)
+            headers=headers, timeout=cls.get_timeout(
+                'send_gif_message', cls.low_timeout))
 
         return decode_json_response(res)
 
     @classmethod
     @check_base_response
+    @timed_api
     def send_video_message(cls, session, message):
         """Send video message api."""
         api_path = cls.api_url_template.format(
@@ -551,7 +782,8 @@ class WeChatAPI:
         res = session.post(
             api_path, params=params, data=json_dumps(
                 data, compact=True, ensure_ascii=False).encode(),
-            headers=headers, timeout=cls.low_timeout)
+            headers=headers, timeout=cls.get_timeout(
+                'send_video_message', cls.low_timeout))
 
         return decode_json_response(res)
 
@@ -563,6 +795,7 @@ class WeChatAPI:
 
     @classmethod
     @check_base_response
+    @timed_api
     def send_app_message(cls, session, message):
         """Send app message api."""
         api_path = cls.api_url_template.format(
@@ -581,12 +814,14 @@ class WeChatAPI:
         res = session.post(
             api_path, params=params, data=json_dumps(
                 data, compact=True, ensure_ascii=False).encode(),
-            headers=headers, timeout=cls.low_timeout)
+            headers=headers, timeout=cls.get_timeout(
+                'send_app_message', cls.low_timeout))
 
         return decode_json_response(res)
 
     @classmethod
     @check_base_response
+    @timed_api
     def set_user_remark(cls, session, username, remark):
         """Set user remark api."""
         api_path = cls.api_url_template.format(
@@ -605,12 +840,14 @@ class WeChatAPI:
         res = session.post(
             api_path, params=params, data=json_dumps(
                 data, compact=True, ensure_ascii=False).encode(),
-            headers=headers, timeout=cls.low_timeout)
+            headers=headers, timeout=cls.get_timeout(
+                'set_user_remark', cls.low_timeout))
 
         return decode_json_response(res)
 
     @classmethod
     @check_base_response
+    @timed_api
     def logout(cls, session):
         """Logout wechat session."""
         api_path = cls.api_url_template.format(
@@ -626,6 +863,7 @@ class WeChatAPI:
         data = {'sid': wxsid, 'uin': wxuin}
 
         res = session.post(
-            api_path, params=params, data=data, timeout=cls.low_timeout)
+            api_path, params=params, data=data, timeout=cls.get_timeout(
+                'logout', cls.low_timeout))
 
         return decode_json_response(res)
@@ -0,0 +1,119 @@
+
+"""Uploaded media cache module."""
+
+import collections
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+__all__ = ['MediaCache']
+
+
+class MediaCache:
+    """LRU cache from file content to uploaded `MediaId`.
+
+    Entries are keyed by file md5 and media type, and expire after `ttl`
+    seconds. When `path` is given the cache is loaded from and saved to
+    that json file.
+    """
+
+    def __init__(self, max_entries=1024, ttl=24 * 3600, path=None):
+        """Initialize media cache.
+
+        :param max_entries: maximum number of cached media ids.
+        :param ttl: seconds a media id is reused after upload.
+        :param path: optional json file the cache is persisted to.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        if path:
+            self.load()
+
+    def __len__(self):
+        """Return number of cached entries."""
+        return len(self._entries)
+
+    @staticmethod
+    def make_key(file_md5, media_type):
+        """Return cache key."""
+        return '{0}:{1}'.format(media_type, file_md5)
+
+    def get(self, file_md5, media_type):
+        """Return cached media id or None."""
+        key = self.make_key(file_md5, media_type)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            media_id, expire_time = entry
+            if expire_time <= time.time():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return media_id
+
+    def set(self, file_md5, media_type, media_id):
+        """Cache media id of file content."""
+        key = self.make_key(file_md5, media_type)
+        with self._lock:
+            self._entries[key] = (media_id, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        if self.path:
+            self.save()
+
+    def invalidate(self, file_md5, media_type):
+        """Drop cached media id of file content."""
+        with self._lock:
+            removed = self._entries.pop(
+                self.make_key(file_md5, media_type), None)
+
+        if removed and self.path:
+            self.save()
+
+    def clear(self):
+        """Drop all cached media ids."""
+        with self._lock:
+            self._entries.clear()
+
+    def load(self):
+        """Load unexpired entries from cache file."""
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            return
+
+        now = time.time()
+        with self._lock:
+            for key, media_id, expire_time in entries:
+                if expire_time > now:
+                    self._entries[key] = (media_id, expire_time)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def save(self):
+        """Save entries to cache file."""
+        with self._lock:
+            entries = [
+                (key, media_id, expire_time)
+                for key, (media_id, expire_time) in self._entries.items()]
+
+        dir_name = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=dir_name, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entries, f)
+
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,173 @@
+
+"""Bounded request/response capture module for debugging."""
+
+import collections
+import re
+import threading
+import time
+
+from logging import getLogger
+
+
+__all__ = ['CaptureBuffer']
+
+
+_logger = getLogger(__name__)
+
+
+class CaptureBuffer:
+    """Keep the latest http exchanges of a session in memory.
+
+    Exchanges are recorded through `Session` hooks, so nothing is written
+    to log unless the buffer is dumped explicitly or `dump_on_error` is set
+    and a request raises exception.
+
+    Values of `sensitive_params` are redacted before an exchange is stored,
+    whether they are in request params, url query strings, json fields like
+    `BaseRequest` or xml elements of login responses. Keys are matched
+    case insensitively.
+    """
+
+    sensitive_params = (
+        'skey', 'pass_ticket', 'sid', 'wxsid', 'uin', 'wxuin', 'deviceid',
+        'ticket', 'webwx_data_ticket')
+
+    def __init__(self, capacity=50, max_body=2048, dump_on_error=False):
+        """Initialize capture buffer.
+
+        :param capacity: number of latest exchanges kept.
+        :param max_body: maximum captured bytes of each request and
+            response body.
+        :param dump_on_error: whether to log buffer when request fails.
+        """
+        self.max_body = max_body
+        self.dump_on_error = dump_on_error
+        self._exchanges = collections.deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        self._sessions = []
+
+        keys = '|'.join(map(re.escape, self.sensitive_params))
+        self._redact_pattern = re.compile((
+            # Query string, json field and xml element
+            r'(?P<query>[?&](?:{0})=)[^&#"\'\s]*|'
+            r'(?P<json>"(?:{0})"\s*:\s*)(?:"[^"]*"|[-\w.]+)|'
+            r'(?P<xml><(?:{0})>)[^<]*').format(keys).encode(), re.IGNORECASE)
+
+    def __len__(self):
+        """Return number of captured exchanges."""
+        return len(self._exchanges)
+
+    def attach(self, session):
+        """Start capturing exchanges of session."""
+        session.register_hook('response', self._on_response)
+        session.register_hook('exception', self._on_exception)
+        self._sessions.append(session)
+
+    def detach(self, session=None):
+        """Stop capturing exchanges of one or all attached sessions."""
+        sessions = [session] if session else list(self._sessions)
+        for sess in sessions:
+            sess.unregister_hook('response', self._on_response)
+            sess.unregister_hook('exception', self._on_exception)
+            self._sessions.remove(sess)
+
+    def _redact_text(self, text):
+        def replace(match):
+            if match.group('json'):
+                return match.group('json') + b'"***"'
+
+            return (match.group('query') or match.group('xml')) + b'***'
+
+        return self._redact_pattern.sub(replace, text)
+
+    def _truncate(self, body):
+        if body is None:
+            return None
+
+        if isinstance(body, str):
+            body = body.encode()
+        elif not isinstance(body, (bytes, bytearray)):
+            return '<{0}>'.format(type(body).__name__)
+
+        # Redact before truncating, so no partial secret is kept
+        body = self._redact_text(bytes(body))
+
+        if len(body) > self.max_body:
+            return bytes(body[:self.max_body]) + b'...<%d bytes>' % len(body)
+
+        return bytes(body)
+
+    def _redact(self, params):
+        if not isinstance(params, dict):
+            return params
+
+        return {
+            key: '***' if key.lower() in self.sensitive_params else val
+            for key, val in params.items()}
+
+    def _record(self, method, url, kwargs, elapsed, **fields):
+        exchange = {
+            'time': time.time(), 'method': method,
+            'url': self._redact_text(url.encode()).decode(),
+            'params': self._redact(kwargs.get('params')),
+            'request_body': (
+                '<multipart>' if kwargs.get('files') else
+                self._truncate(kwargs.get('data'))),
+            'elapsed': elapsed, 'status': None, 'response_body': None,
+            'error': None}
+        exchange.update(fields)
+
+        with self._lock:
+            self._exchanges.append(exchange)
+
+    def _on_response(self, method, url, kwargs, res, elapsed):
+        if kwargs.get('stream'):
+            # Reading streamed body here would consume it
+            body = '<stream>'
+        else:
+            body = self._truncate(res.content)
+
+        self._record(
+            method, url, kwargs, elapsed, status=res.status_code,
+            response_body=body)
+
+    def _on_exception(self, method, url, kwargs, exc, elapsed):
+        self._record(method, url, kwargs, elapsed, error=repr(exc))
+        if self.dump_on_error:
+            _logger.error('request failed, recent exchanges:\n%s', self.dump())
+
+    def exchanges(self):
+        """Return a list of captured exchanges, the oldest first."""
+        with self._lock:
+            return list(self._exchanges)
+
+    def dump(self, stream=None):
+        """Format captured exchanges as text.
+
+        :param stream: optional text stream the dump is written to.
+        """
+        lines = []
+        for exchange in self.exchanges():
+            lines.append(
+                '[{0:.3f}] {1} {2} params={3} elapsed={4:.3f}s'.format(
+                    exchange['time'], exchange['method'], exchange['url'],
+                    exchange['params'], exchange['elapsed']))
+            if exchange['request_body'] is not None:
+                lines.append('  request: {0!r}'.format(
+                    exchange['request_body']))
+            if exchange['error'] is not None:
+                lines.append('  error: {0}'.format(exchange['error']))
+            else:
+                lines.append('  response {0}: {1!r}'.format(
+                    exchange['status'], exchange['response_body']))
+
+        text = '\n'.join(lines)
+        if stream is not None:
+            stream.write(text + '\n')
+
+        return text
+
+    def clear(self):
+        """Drop all captured exchanges."""
+        with self._lock:
+            self._exchanges.clear()
@@ -1,27 +1,70 @@
 
 """WeChat Client module."""
 
-from urllib.parse import urlparse
+import heapq
+import itertools
+import queue
+import random
+import requests
+import threading
+import time
 import webbrowser
 
+from concurrent.futures import Future, ThreadPoolExecutor
+from logging import getLogger
+from urllib.parse import urlparse
+
 from pywxclient.core.api import WeChatAPI
 from pywxclient.core.exception import (
-    AuthorizeTimeout, UnknownWindowCode, WaitScanQRCode,
-    MessageAlreadyAcknowledge, UnacknowledgedMessage, UnsupportedMessage)
+    APIResponseError, AuthorizeTimeout, UnknownWindowCode, WaitScanQRCode,
+    MessageAlreadyAcknowledge, RequestError, SendTimeout,
+    UnacknowledgedMessage, UnsupportedMessage)
 from pywxclient.core.message import (
     TextMessage, ImageMessage, GifImageMessage, VideoMessage, FileMessage,
-    VoiceMessage)
+    VoiceMessage, parse_message)
+from pywxclient.core.metrics import default_instrumentation
 from pywxclient.core.session import Session
+from pywxclient.utils import SingleFlight, split_text
 
 
 __all__ = ['Client', 'SyncClient']
 
 
+_logger = getLogger(__name__)
+
+
+def _headers_key(headers):
+    """Return hashable key of request headers."""
+    return tuple(sorted(headers.items())) if headers else None
+
+
+def _is_ambiguous_send_error(error):
+    """Indicate whether a failed send may have reached the server.
+
+    Timeouts and broken connections leave the send outcome unknown, while a
+    server answer or an error raised before connecting means the message
+    wasn't sent.
+    """
+    if isinstance(error, RequestError):
+        # Transport errors are wrapped by session
+        error = error.__cause__
+
+    if isinstance(error, requests.ConnectTimeout):
+        return False
+
+    return isinstance(error, (
+        requests.Timeout, requests.ConnectionError,
+        requests.exceptions.ChunkedEncodingError))
+
+
 class Client:
     """WeChat client base class."""
 
     ok_login_code = (200, 201, 400, 408)
 
+    sync_retry_delay = 1
+    sync_max_retry_delay = 60
+
     def __init__(self, session, api_cls=WeChatAPI):
         """Initialize client with Session object and api class."""
         self.session = session
@@ -30,12 +73,27 @@ class Client:
         self._uuid = None
         self._login_uri = None
         self._api_cls = api_cls
+        self._message_handlers = []
+        self._contact_handlers = []
+        self._sync_key = None
+        self._handled_sync_key = None
+        self._stop_event = threading.Event()
+        self._loop_stats = {
+            'iterations': 0, 'syncs': 0, 'messages': 0, 'errors': 0,
+            'lag': None}
 
     def dump(self):
-        """Dump client object as dict."""
+        """Dump client object as dict.
+
+        Sync key of dumped session is the last one whose messages have been
+        handled, so restored client doesn't lose messages.
+        """
+        session_data = self.session.dump()
+        if self._handled_sync_key and session_data['wx_session']:
+            session_data['wx_session']['sync_key'] = self._handled_sync_key
+
         return {
-            'session': self.session.dump(), 'user': self.user,
-            'uuid': self._uuid}
+            'session': session_data, 'user': self.user, 'uuid': self._uuid}
 
     @classmethod
     def load(cls, client_dict):
@@ -78,7 +136,9 @@ class Client:
         """Sync WeChat message."""
         raise NotImplementedError
 
-    def upload(self, file_obj, to_username):
+    def upload(
+            self, file_obj, to_username, concurrency=None,
+            upload_session=None):
         """Upload message resource to WeChat."""
         raise NotImplementedError
 
@@ -93,11 +153,215 @@ class Client:
         Otherwise client is at risk of losing messages.
         """
         self.session.sync(self._sync_key)
+        self._handled_sync_key = self._sync_key
 
     def logout(self):
         """Logout WeChat."""
         raise NotImplementedError
 
+    def register_message_handler(self, handler, msg_types=None):
+        """Register a handler of messages received by `run_forever`.
+
+        :param handler: callable accepting a parsed message object.
+        :param msg_types: message types handled, all by default.
+        """
+        self._message_handlers.append(
+            (handler, frozenset(msg_types) if msg_types else None))
+
+    def register_contact_handler(self, handler):
+        """Register a handler of modified contacts received by sync.
+
+        :param handler: callable accepting a `ModContactList` item.
+        """
+        self._contact_handlers.append(handler)
+
+    def _dispatch_sync(self, sync_res, instrumentation):
+        now = time.time()
+        for msg_value in sync_res.get('AddMsgList', ()):
+            try:
+                message = parse_message(msg_value)
+            except UnsupportedMessage:
+                _logger.debug(
+                    'skip unsupported message type %s',
+                    msg_value.get('MsgType'))
+                continue
+            except Exception:
+                # One malformed message mustn't hold back the batch
+                _logger.exception(
+                    'skip malformed message %s', msg_value.get('MsgId'))
+                continue
+
+            lag = max(now - message.create_time, 0)
+            self._loop_stats['messages'] += 1
+            self._loop_stats['lag'] = lag
+            instrumentation.emit('loop', 'message_lag', lag)
+
+            for handler, msg_types in self._message_handlers:
+                if msg_types is None or message.msg_type in msg_types:
+                    try:
+                        handler(message)
+                    except Exception:
+                        _logger.exception(
+                            'message handler %r failed', handler)
+
+        for contact in sync_res.get('ModContactList', ()):
+            for handler in self._contact_handlers:
+                try:
+                    handler(contact)
+                except Exception:
+                    _logger.exception('contact handler %r failed', handler)
+
+    def _process_batches(self, batches, instrumentation, errors):
+        """Dispatch synced batches in order and record handled sync key.
+
+        A failure is appended to errors and stops the sync loop, so it's
+        raised by `run_forever`.
+        """
+        try:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    return
+
+                sync_res, sync_key, queued_time = batch
+                instrumentation.emit(
+                    'loop', 'batch_wait', time.monotonic() - queued_time)
+                self._dispatch_sync(sync_res, instrumentation)
+                self._handled_sync_key = sync_key
+        except Exception as e:
+            _logger.error('sync processor failed with %r, stop sync', e)
+            errors.append(e)
+            self._stop_event.set()
+
+    @staticmethod
+    def _put_batch(batches, batch, processor):
+        """Queue batch for processor, return False if processor is gone."""
+        while processor.is_alive():
+            try:
+                batches.put(batch, timeout=0.5)
+            except queue.Full:
+                continue
+
+            return True
+
+        return False
+
+    def run_forever(
+            self, instrumentation=None, pipelined=False, queue_size=8):
+        """Run message sync loop until `stop` is called.
+
+        Each iteration long polls `sync_check`. A zero selector means
+        nothing changed, so the poll is started again without syncing.
+        Other selectors tell new messages (2), contact changes (4, 6) or
+        activity on phone (7), each of them must be consumed by a sync
+        otherwise the poll returns at once again. So new messages and
+        modified contacts are synced, dispatched to registered handlers and
+        sync key is flushed. A failing handler is logged and doesn't block
+        the loop. Request errors are retried with exponential backoff and
+        jitter, `SessionExpiredError`, also raised when the session is
+        logged out or logged in elsewhere, ends the loop by raising.
+
+        Iteration latency, errors and lag between message creation and
+        dispatch are emitted as `loop` metric events, and summarized by
+        `loop_stats`.
+
+        In pipelined mode synced batches are handed to a processing thread
+        through a bounded queue, and the session sync key is advanced right
+        away, so the next long poll overlaps with handling of the current
+        batch. Batches are still handled in order, and `dump` keeps the
+        sync key of the last handled batch, so unhandled messages are
+        synced again by a restored client. When handling a batch fails, the
+        loop stops and the error is raised.
+
+        :param instrumentation: `Instrumentation` receiving loop metrics.
+        :param pipelined: whether to sync next batch while handling the
+            current one.
+        :param queue_size: maximum number of synced batches waiting to be
+            handled in pipelined mode.
+        """
+        instrumentation = instrumentation or default_instrumentation
+        if not pipelined:
+            self._run_sync_loop(instrumentation)
+            return
+
+        # Session sync key is advanced before batches are handled
+        self._handled_sync_key = self.session.get_wx_session_data().get(
+            'sync_key')
+        batches = queue.Queue(maxsize=queue_size)
+        errors = []
+        processor = threading.Thread(
+            target=self._process_batches,
+            args=(batches, instrumentation, errors), name='sync-processor',
+            daemon=True)
+        processor.start()
+        try:
+            self._run_sync_loop(instrumentation, batches, processor)
+        finally:
+            # Handle queued batches before return
+            self._put_batch(batches, None, processor)
+            processor.join()
+
+        if errors:
+            raise errors[0]
+
+    def _run_sync_loop(self, instrumentation, batches=None, processor=None):
+        stop_event = self._stop_event
+        stop_event.clear()
+        failures = 0
+        while not stop_event.is_set():
+            start_time = time.monotonic()
+            self._loop_stats['iterations'] += 1
+            try:
+                selector = self.sync_check()
+                if selector != 0:
+                    sync_res = self.sync_message()
+                    self._loop_stats['syncs'] += 1
+                    if batches is None:
+                        self._dispatch_sync(sync_res, instrumentation)
+                        self.flush_sync_key()
+                    else:
+                        sync_key = self._sync_key
+                        self.session.sync(sync_key)
+                        # Blocks while processing falls behind
+                        if not self._put_batch(
+                                batches,
+                                (sync_res, sync_key, time.monotonic()),
+                                processor):
+                            # Processor failed, its error is raised by
+                            # run_forever
+                            return
+            except (
+                    RequestError, APIResponseError,
+                    requests.RequestException) as e:
+                failures += 1
+                self._loop_stats['errors'] += 1
+                instrumentation.emit(
+                    'loop', 'iteration', time.monotonic() - start_time,
+                    error=e.__class__.__name__)
+
+                delay = min(
+                    self.sync_retry_delay * 2 ** (failures - 1),
+                    self.sync_max_retry_delay)
+                delay *= random.uniform(0.5, 1)
+                _logger.warning(
+                    'sync failed with %r, retry in %.1f seconds', e, delay)
+                stop_event.wait(delay)
+            else:
+                failures = 0
+                instrumentation.emit(
+                    'loop', 'iteration', time.monotonic() - start_time)
+
+    def stop(self):
+        """Stop `run_forever` after the current iteration."""
+        self._stop_event.set()
+
+    def loop_stats(self):
+        """Return sync loop iteration, sync, message and error counts.
+
+        `lag` is the lag of the last dispatched message in seconds.
+        """
+        return dict(self._loop_stats)
+
     def close(self):
         """Close client."""
         self.session.close()
@@ -107,6 +371,7 @@ class Client:
         self._login_uri = None
         self.user = None
         self._sync_key = None
+        self._handled_sync_key = None
 
 
 class SyncClient(Client):
@@ -120,6 +385,32 @@ class SyncClient(Client):
         FileMessage.msg_type: WeChatAPI.send_file_message
     }
 
+    send_concurrency = 4
+    send_ack_timeout = 30
+    text_part_chars = 2000
+    text_part_bytes = 6000
+
+    def __init__(
+            self, session, api_cls=WeChatAPI, media_cache=None,
+            send_ledger=None):
+        """Initialize client.
+
+        :param media_cache: optional `MediaCache` for skipping uploads of
+            the same file content.
+        :param send_ledger: optional `SendLedger` making retried sends of a
+            message idempotent.
+        """
+        super(SyncClient, self).__init__(session, api_cls=api_cls)
+        self.media_cache = media_cache
+        self.send_ledger = send_ledger
+        self._in_flight = SingleFlight()
+        self._send_executor = None
+        self._unacked = {}
+        self._unacked_deadlines = []
+        self._unacked_counter = itertools.count()
+        self._unacked_cond = threading.Condition()
+        self._unacked_watchdog = None
+
     def get_authorize_url(self):
         """Get WeChat authorize url."""
         uuid = self._api_cls.get_qrcode_uuid(self.session)
@@ -183,19 +474,30 @@ class SyncClient(Client):
         contact_res = self._api_cls.mget_contact_list(self.session, user_list)
         return contact_res['ContactList']
 
-    def get_icon(self, icon_url):
+    def get_icon(self, icon_url, headers=None):
         """Get user icon.
 
+        Concurrent calls of the same url share one request and response.
+
         :param icon_url: icon url.
+        :param headers: extra http request headers.
         """
-        return self._api_cls.get_icon(self.session, icon_url)
+        return self._in_flight.do(
+            ('icon', icon_url, _headers_key(headers)), self._api_cls.get_icon,
+            self.session, icon_url, headers=headers)
 
-    def get_head_img(self, headimg_url):
+    def get_head_img(self, headimg_url, headers=None):
         """Get user head image.
 
+        Concurrent calls of the same url share one request and response.
+
         :param headimg_url: headimg url.
+        :param headers: extra http request headers.
         """
-        return self._api_cls.get_head_img(self.session, headimg_url)
+        return self._in_flight.do(
+            ('head_img', headimg_url, _headers_key(headers)),
+            self._api_cls.get_head_img, self.session, headimg_url,
+            headers=headers)
 
     def sync_check(self):
         """Check session status."""
@@ -209,41 +511,296 @@ class SyncClient(Client):
         sync_key = message['SyncKey']
         self._sync_key = sync_key
 
+        if self.send_ledger is not None:
+            self.send_ledger.observe(
+                message['AddMsgList'], self.user['UserName'])
+
         return message
 
-    def upload(self, file_obj, to_username):
-        """Upload resource to WeChat."""
-        return self._api_cls.upload_file(
-            self.session, file_obj, self.user['UserName'], to_username)
+    def upload(
+            self, file_obj, to_username, concurrency=None,
+            upload_session=None, use_cache=True):
+        """Upload resource to WeChat.
 
-    def send_message(self, message):
-        """Send message to WeChat."""
+        :param concurrency: maximum number of chunks uploaded in parallel.
+        :param upload_session: `UploadSession` for resuming failed upload.
+        :param use_cache: whether to reuse media id of the same content
+            from media cache.
+        """
+        media_cache = self.media_cache
+        if media_cache is not None and use_cache:
+            media_id = media_cache.get(file_obj.md5, file_obj.media_type())
+            if media_id:
+                return media_id
+
+        media_id = self._api_cls.upload_file(
+            self.session, file_obj, self.user['UserName'], to_username,
+            concurrency=concurrency, upload_session=upload_session)
+
+        if media_cache is not None and media_id:
+            media_cache.set(file_obj.md5, file_obj.media_type(), media_id)
+
+        return media_id
+
+    def send_message(self, message, file_obj=None):
+        """Send message to WeChat.
+
+        :param message: message object.
+        :param file_obj: file uploaded for media message, when the message
+            carries a cached media id which is rejected, the file is
+            uploaded again and the message is resent.
+
+        With a send ledger, a message whose earlier send has an unknown
+        outcome raises `UnconfirmedMessage` until it's confirmed by sync,
+        and a confirmed message is acknowledged without being sent again.
+        """
         if message.check_ack_status():
             raise MessageAlreadyAcknowledge
 
-        msg_ret = self.msg_send_routines[message.msg_type](
-            self.session, message)
+        ledger = self.send_ledger
+        if ledger is None:
+            msg_ret = self._send_message(message, file_obj)
+        else:
+            record = ledger.begin(message)
+            if record.status == ledger.SENT:
+                message.ack(str(message.local_msg_id), record.msg_id)
+                return
+
+            try:
+                msg_ret = self._send_message(message, file_obj)
+            except Exception as e:
+                if _is_ambiguous_send_error(e):
+                    ledger.mark_unknown(record)
+                else:
+                    ledger.fail(record)
+
+                raise
+
+            ledger.succeed(record, msg_ret['MsgID'])
 
         local_msg_id = msg_ret['LocalID']
         msg_id = msg_ret['MsgID']
         message.ack(local_msg_id, msg_id)
 
-    def get_message_media(self, message):
-        """Get message media content."""
+    def _send_message(self, message, file_obj):
+        send_routine = self.msg_send_routines[message.msg_type]
+        try:
+            msg_ret = send_routine(self.session, message)
+        except APIResponseError:
+            media_cache = self.media_cache
+            if file_obj is None or media_cache is None:
+                raise
+
+            file_md5 = file_obj.md5
+            media_type = file_obj.media_type()
+            if media_cache.get(file_md5, media_type) != getattr(
+                    message, 'media_id', None):
+                raise
+
+            media_cache.invalidate(file_md5, media_type)
+            message.update_media_id(
+                self.upload(file_obj, message.to_user, use_cache=False))
+            msg_ret = send_routine(self.session, message)
+
+        return msg_ret
+
+    def send_message_async(self, message, file_obj=None, timeout=None):
+        """Send message in background and return a future.
+
+        Up to `send_concurrency` messages are sent in parallel over the
+        session connection pool, so parallel messages to one recipient may
+        arrive out of order. The future resolves to (LocalID, MsgID) when
+        the message is acknowledged, or fails with `SendTimeout` when it
+        isn't acknowledged within timeout.
+
+        :param timeout: seconds to wait for acknowledge, defaults to
+            `send_ack_timeout`.
+        """
+        if message.check_ack_status():
+            raise MessageAlreadyAcknowledge
+
+        if timeout is None:
+            timeout = self.send_ack_timeout
+
+        return self._submit_unacked([message], file_obj, timeout)
+
+    def send_long_text(
+            self, to_username, text, max_chars=None, max_bytes=None,
+            timeout=None):
+        """Send text in parts in background and return a future.
+
+        Text is split at sensible boundaries within limits. The parts are
+        sent one after another in background so that they arrive in order,
+        and the future resolves to a list of (LocalID, MsgID) when all parts
+        are acknowledged. When a part fails, the rest isn't sent and the
+        future fails with its error. Empty or whitespace only text raises
+        `ValueError`.
+
+        :param max_chars: maximum characters of a part, defaults to
+            `text_part_chars`.
+        :param max_bytes: maximum utf-8 encoded bytes of a part, defaults to
+            `text_part_bytes`.
+        :param timeout: seconds to wait for acknowledge of each part,
+            defaults to `send_ack_timeout`.
+        """
+        parts = split_text(
+            text, max_chars=max_chars or self.text_part_chars,
+            max_bytes=max_bytes or self.text_part_bytes)
+        if not parts:
+            raise ValueError('text to send is empty')
+
+        messages = [
+            TextMessage(self.user['UserName'], to_username, part)
+            for part in parts]
+        if timeout is None:
+            timeout = self.send_ack_timeout
+
+        return self._submit_unacked(
+            messages, None, timeout * len(parts), group=True)
+
+    def _submit_unacked(self, messages, file_obj, timeout, group=False):
+        future = Future()
+        # A running future can't be cancelled behind our back
+        future.set_running_or_notify_cancel()
+        deadline = time.monotonic() + timeout
+        with self._unacked_cond:
+            self._unacked[future] = (messages, deadline)
+            deadlines = self._unacked_deadlines
+            if len(deadlines) > max(64, 2 * len(self._unacked)):
+                # Drop deadlines of finished sends
+                deadlines[:] = [
+                    entry for entry in deadlines if entry[2] in self._unacked]
+                heapq.heapify(deadlines)
+
+            heapq.heappush(
+                deadlines, (deadline, next(self._unacked_counter), future))
+            if self._send_executor is None:
+                self._send_executor = ThreadPoolExecutor(
+                    max_workers=self.send_concurrency)
+
+            if self._unacked_watchdog is None:
+                self._unacked_watchdog = threading.Thread(
+                    target=self._watch_unacked, name='send-ack-watchdog',
+                    daemon=True)
+                self._unacked_watchdog.start()
+
+            executor = self._send_executor
+            self._unacked_cond.notify()
+
+        executor.submit(
+            self._send_unacked, future, messages, file_obj, group)
+        return future
+
+    def _send_unacked(self, future, messages, file_obj, group):
+        error = None
+        results = []
+        for message in messages:
+            with self._unacked_cond:
+                if future not in self._unacked:
+                    # Timed out while queued, a retry mustn't duplicate it
+                    return
+
+            try:
+                self.send_message(message, file_obj=file_obj)
+            except Exception as e:
+                error = e
+                break
+
+            results.append((str(message.local_msg_id), message.msg_id))
+
+        with self._unacked_cond:
+            entry = self._unacked.pop(future, None)
+
+        if entry is None:
+            # Already timed out
+            return
+
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(results if group else results[0])
+
+    def _watch_unacked(self):
+        """Expire unacknowledged messages at their deadline."""
+        deadlines = self._unacked_deadlines
+        while True:
+            with self._unacked_cond:
+                while True:
+                    if self._unacked_watchdog is None:
+                        return
+
+                    while deadlines and deadlines[0][2] not in self._unacked:
+                        heapq.heappop(deadlines)
+
+                    delay = (
+                        deadlines[0][0] - time.monotonic() if deadlines else
+                        None)
+                    if delay is not None and delay <= 0:
+                        break
+
+                    self._unacked_cond.wait(delay)
+
+            self.expire_unacked()
+
+    def unacked_messages(self):
+        """Return messages sent in background but not acknowledged yet."""
+        with self._unacked_cond:
+            return [
+                message for messages, __ in self._unacked.values()
+                for message in messages if not message.check_ack_status()]
+
+    def expire_unacked(self):
+        """Fail futures of messages not acknowledged before timeout.
+
+        A background watchdog calls this at the earliest deadline, so
+        futures fail in time without any other send activity.
+        """
+        now = time.monotonic()
+        with self._unacked_cond:
+            expired = [
+                (future, messages)
+                for future, (messages, deadline) in self._unacked.items()
+                if deadline <= now]
+            for future, __ in expired:
+                del self._unacked[future]
+
+        for future, messages in expired:
+            future.set_exception(SendTimeout(
+                'message {0} not acknowledged in time'.format(
+                    ', '.join(str(msg.local_msg_id) for msg in messages))))
+
+    def get_message_media(self, message, headers=None, stream=True):
+        """Get message media content.
+
+        A streamed response can't be shared, so only non-streamed requests
+        are deduplicated, whose concurrent callers share one request and
+        response body.
+
+        :param headers: extra http request headers, e.g. Range.
+        :param stream: whether to return a streamed response.
+        """
         if not message.check_ack_status():
             raise UnacknowledgedMessage
 
         msg_type = message.msg_type
         if msg_type in (ImageMessage.msg_type, GifImageMessage.msg_type):
-            return self._api_cls.get_msg_img(self.session, message.msg_id)
+            args = (self._api_cls.get_msg_img, self.session, message.msg_id)
         elif msg_type == VoiceMessage.msg_type:
-            return self._api_cls.get_msg_voice(self.session, message.msg_id)
+            args = (
+                self._api_cls.get_msg_voice, self.session, message.msg_id)
         elif msg_type == FileMessage.msg_type:
-            return self._api_cls.get_msg_media(
-                self.session, message.from_user, message.media_id,
-                message.filename)
+            args = (
+                self._api_cls.get_msg_media, self.session, message.from_user,
+                message.media_id, message.filename)
+        else:
+            raise UnsupportedMessage
 
-        raise UnsupportedMessage
+        if stream:
+            return args[0](*args[1:], headers=headers, stream=True)
+
+        return self._in_flight.do(
+            ('media', msg_type, message.msg_id, _headers_key(headers)),
+            *args, headers=headers, stream=False)
 
     def set_user_remark(self, username, remark):
         """Set user wechat remark."""
@@ -252,3 +809,18 @@ class SyncClient(Client):
     def logout(self):
         """Logout wechat session."""
         self._api_cls.logout(self.session)
+
+    def close(self):
+        """Close client after background sends finish."""
+        if self._send_executor is not None:
+            self._send_executor.shutdown()
+            self._send_executor = None
+
+        with self._unacked_cond:
+            watchdog, self._unacked_watchdog = self._unacked_watchdog, None
+            self._unacked_cond.notify_all()
+
+        if watchdog is not None:
+            watchdog.join()
+
+        super(SyncClient, self).close()
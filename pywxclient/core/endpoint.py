@@ -0,0 +1,159 @@
+
+"""WeChat api endpoint selection module."""
+
+import random
+import threading
+import time
+
+
+__all__ = ['EndpointSelector']
+
+
+class EndpointStats:
+    """Observed latency and error statistics of an endpoint."""
+
+    __slots__ = ('latency', 'error_rate', 'samples', 'last_failure')
+
+    def __init__(self):
+        """Initialize empty statistics."""
+        self.latency = None
+        self.error_rate = 0.0
+        self.samples = 0
+        self.last_failure = None
+
+    def to_dict(self):
+        """Return statistics as dict."""
+        return {
+            'latency': self.latency, 'error_rate': self.error_rate,
+            'samples': self.samples, 'last_failure': self.last_failure}
+
+
+class EndpointSelector:
+    """Select the endpoint with the best observed latency and error rate.
+
+    Latency and error rate are tracked as exponentially weighted moving
+    averages. Endpoints without any sample are tried first, after that the
+    endpoint with the lowest score wins, where score is latency plus a
+    penalty proportional to error rate.
+    """
+
+    def __init__(
+            self, endpoints, decay=0.3, error_penalty=5.0,
+            failure_cooldown=30, explore_ratio=0.05):
+        """Initialize selector.
+
+        :param endpoints: candidate endpoint hosts.
+        :param decay: weight of the newest sample in moving averages.
+        :param error_penalty: seconds added to score per unit error rate.
+        :param failure_cooldown: seconds an endpoint is avoided after failure.
+        :param explore_ratio: probability of choosing a random endpoint.
+        """
+        self._endpoints = tuple(endpoints)
+        self._stats = {endpoint: EndpointStats() for endpoint in endpoints}
+        self._lock = threading.Lock()
+        self.decay = decay
+        self.error_penalty = error_penalty
+        self.failure_cooldown = failure_cooldown
+        self.explore_ratio = explore_ratio
+
+    @property
+    def endpoints(self):
+        """Return candidate endpoints."""
+        return self._endpoints
+
+    def record(self, endpoint, latency=None, error=False):
+        """Record a request result of endpoint.
+
+        :param endpoint: endpoint host.
+        :param latency: request latency in seconds, ignored on error.
+        :param error: whether the request failed.
+        """
+        stats = self._stats.get(endpoint)
+        if stats is None:
+            return
+
+        decay = self.decay
+        with self._lock:
+            stats.samples += 1
+            stats.error_rate = (
+                (1 - decay) * stats.error_rate + decay * float(error))
+            if error:
+                stats.last_failure = time.monotonic()
+            elif latency is not None:
+                if stats.latency is None:
+                    stats.latency = latency
+                else:
+                    stats.latency = (
+                        (1 - decay) * stats.latency + decay * latency)
+
+    def score(self, endpoint):
+        """Return endpoint score, the lower the better."""
+        stats = self._stats[endpoint]
+        latency = stats.latency
+        if latency is None:
+            # Only failures observed
+            latency = self.error_penalty
+
+        return latency + stats.error_rate * self.error_penalty
+
+    def _in_cooldown(self, endpoint, now):
+        last_failure = self._stats[endpoint].last_failure
+        return (
+            last_failure is not None and
+            now - last_failure < self.failure_cooldown)
+
+    def select(self, exclude=None):
+        """Return the preferred endpoint.
+
+        :param exclude: endpoints which should be avoided if possible.
+        """
+        candidates = [
+            endpoint for endpoint in self._endpoints
+            if not exclude or endpoint not in exclude] or list(
+                self._endpoints)
+
+        with self._lock:
+            unsampled = [
+                endpoint for endpoint in candidates
+                if not self._stats[endpoint].samples]
+            if unsampled:
+                return random.choice(unsampled)
+
+            now = time.monotonic()
+            healthy = [
+                endpoint for endpoint in candidates
+                if not self._in_cooldown(endpoint, now)] or candidates
+
+            if len(healthy) > 1 and random.random() < self.explore_ratio:
+                return random.choice(healthy)
+
+            return min(healthy, key=self.score)
+
+    def probe(self, probe_func, endpoints=None):
+        """Probe endpoints and record their latency.
+
+        :param probe_func: callable accepting an endpoint, which raises
+            exception when endpoint is unavailable.
+        :param endpoints: endpoints to probe, default all endpoints.
+        """
+        for endpoint in endpoints or self._endpoints:
+            start_time = time.monotonic()
+            try:
+                probe_func(endpoint)
+            except Exception:
+                self.record(endpoint, error=True)
+            else:
+                self.record(endpoint, time.monotonic() - start_time)
+
+    def stats(self):
+        """Return all endpoints' statistics."""
+        with self._lock:
+            return {
+                endpoint: stats.to_dict()
+                for endpoint, stats in self._stats.items()}
+
+    def reset(self):
+        """Drop all observed statistics."""
+        with self._lock:
+            self._stats = {
+                endpoint: EndpointStats() for endpoint in self._endpoints}
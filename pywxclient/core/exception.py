@@ -5,7 +5,8 @@ __all__ = [
     'WaitScanQRCode', 'AuthorizeTimeout', 'UnknownWindowCode',
     'SessionInitFailure', 'NotifyStatusFailure', 'APIResponseError',
     'SessionExpiredError', 'MessageAlreadyAcknowledge', 'RequestError',
-    'UnacknowledgedMessage']
+    'UnacknowledgedMessage', 'FileTooLarge', 'SendQueueFull',
+    'SendTimeout', 'UnconfirmedMessage']
 
 
 class UnknownWindowCode(Exception):
@@ -78,3 +79,27 @@ class LoginError(Exception):
     """Login wechat failed error."""
 
     pass
+
+
+class FileTooLarge(Exception):
+    """File size exceeds limit error."""
+
+    pass
+
+
+class SendQueueFull(Exception):
+    """Outbound message queue is full error."""
+
+    pass
+
+
+class SendTimeout(Exception):
+    """Message isn't acknowledged in time error."""
+
+    pass
+
+
+class UnconfirmedMessage(Exception):
+    """Outcome of an earlier send of message isn't confirmed error."""
+
+    pass
@@ -0,0 +1,157 @@
+
+"""Idempotent message send ledger module."""
+
+import collections
+import html
+import threading
+import time
+
+from pywxclient.core.exception import UnconfirmedMessage
+
+
+__all__ = ['SendRecord', 'SendLedger']
+
+
+class SendRecord:
+    """Send outcome of a message."""
+
+    __slots__ = (
+        'key', 'to_user', 'msg_type', 'content', 'status', 'msg_id',
+        'deadline')
+
+    def __init__(self, key, to_user, msg_type, content):
+        """Initialize record."""
+        self.key = key
+        self.to_user = to_user
+        self.msg_type = msg_type
+        self.content = content
+        self.status = None
+        self.msg_id = None
+        self.deadline = None
+
+
+class SendLedger:
+    """Bounded record of send outcomes keyed by `ClientMsgId`.
+
+    A send which fails without a server answer, e.g. a timeout, is marked
+    unknown. Retrying such message raises `UnconfirmedMessage` until the
+    message is confirmed by its echo in `AddMsgList` of a later sync, which
+    makes the retry a no-op, or until `confirm_timeout` passes and the
+    message is resent. Echoes are matched by `ClientMsgId`, or by recipient
+    and content of text messages when the echo doesn't carry the id.
+    """
+
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    UNKNOWN = 'unknown'
+
+    def __init__(self, max_entries=10000, confirm_timeout=30):
+        """Initialize send ledger.
+
+        :param max_entries: maximum number of kept records.
+        :param confirm_timeout: seconds to wait for echo of a message with
+            unknown outcome before it may be resent.
+        """
+        self.max_entries = max_entries
+        self.confirm_timeout = confirm_timeout
+        self._records = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """Return number of kept records."""
+        return len(self._records)
+
+    @staticmethod
+    def make_key(message):
+        """Return ledger key of message."""
+        return str(message.to_value()['ClientMsgId'])
+
+    def get(self, message):
+        """Return record of message or None."""
+        with self._lock:
+            return self._records.get(self.make_key(message))
+
+    def begin(self, message):
+        """Record a message is being sent and return its record.
+
+        A returned record of `SENT` status means the message has already
+        been delivered and mustn't be sent again.
+        """
+        key = self.make_key(message)
+        with self._lock:
+            record = self._records.get(key)
+            if record is None:
+                msg_value = message.to_value()
+                content = (
+                    msg_value.get('Content') if msg_value['Type'] == 1 else
+                    None)
+                record = self._records[key] = SendRecord(
+                    key, message.to_user, msg_value['Type'], content)
+                while len(self._records) > self.max_entries:
+                    self._records.popitem(last=False)
+            elif record.status == self.SENT:
+                return record
+            elif record.status == self.PENDING or (
+                    record.status == self.UNKNOWN and
+                    record.deadline > time.monotonic()):
+                raise UnconfirmedMessage(key)
+
+            record.status = self.PENDING
+            return record
+
+    def succeed(self, record, msg_id):
+        """Record message has been sent."""
+        with self._lock:
+            record.status = self.SENT
+            record.msg_id = msg_id
+
+    def fail(self, record):
+        """Record server rejected message, it's safe to resend."""
+        with self._lock:
+            record.status = self.FAILED
+
+    def mark_unknown(self, record):
+        """Record outcome of sending message is unknown."""
+        with self._lock:
+            record.status = self.UNKNOWN
+            record.deadline = time.monotonic() + self.confirm_timeout
+
+    def observe(self, add_msg_list, username):
+        """Confirm unknown sends by message echoes of a sync.
+
+        :param add_msg_list: `AddMsgList` of sync response.
+        :param username: username of current user.
+        """
+        with self._lock:
+            unknown = [
+                record for record in self._records.values()
+                if record.status == self.UNKNOWN]
+            if not unknown:
+                return
+
+            for msg_value in add_msg_list:
+                if msg_value.get('FromUserName') != username:
+                    continue
+
+                record = self._match(unknown, msg_value)
+                if record is not None:
+                    record.status = self.SENT
+                    record.msg_id = msg_value.get('MsgId')
+                    unknown.remove(record)
+
+    def _match(self, unknown, msg_value):
+        client_msg_id = msg_value.get('ClientMsgId')
+        if client_msg_id:
+            record = self._records.get(str(client_msg_id))
+            return record if record in unknown else None
+
+        content = html.unescape(msg_value.get('Content', ''))
+        for record in unknown:
+            if (record.content is not None and
+                    record.to_user == msg_value.get('ToUserName') and
+                    record.msg_type == msg_value.get('MsgType') and
+                    record.content == content):
+                return record
+
+        return None
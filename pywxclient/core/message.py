@@ -1,7 +1,9 @@
 
 """WeChat message parse and construct module."""
 
+import copy
 import html
+import threading
 import time
 
 from pywxclient.core.exception import UnsupportedMessage
@@ -13,13 +15,39 @@ __all__ = [
     'FileMessage', 'VideoMessage', 'ExtendMessage', 'LocationShareMessage',
     'BusinessCardMessage', 'TransferMessage', 'ChatLogMessage',
     'ShareLinkMessage', 'WeAppMessage', 'NoticeMessage', 'RevokeMessage',
-    'StatusNotifyMessage', 'parse_message']
+    'StatusNotifyMessage', 'LocalMsgIdGenerator', 'parse_message']
 
 
 _specified_appmsg_appid = 'wxeb7ec651dd0aefa9'
 _supported_message_parser = {}
 
 
+class LocalMsgIdGenerator:
+    """Generate unique and increasing local message ids of this process.
+
+    An id is unix time in milliseconds followed by a 4 digits sequence,
+    the same layout as web WeChat. Ids keep increasing when the clock goes
+    backwards or the sequence overflows within a millisecond.
+    """
+
+    sequence_size = 10000
+
+    def __init__(self):
+        """Initialize generator."""
+        self._last_id = 0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        """Return next local message id."""
+        time_id = int(time.time() * 1000) * self.sequence_size
+        with self._lock:
+            self._last_id = max(self._last_id + 1, time_id)
+            return self._last_id
+
+
+_local_msg_id_generator = LocalMsgIdGenerator()
+
+
 class MessageBase(metaclass=MessageType):
     """WeChat message base class."""
 
@@ -39,8 +67,8 @@ class MessageBase(metaclass=MessageType):
         self._msg_value = None
 
     def get_local_msg_id(self):
-        """Generate local message id based on unix timestamp."""
-        return int(self.create_time * 1000000)
+        """Generate a unique local message id."""
+        return _local_msg_id_generator()
 
     def get_base_value(self):
         return {
@@ -69,6 +97,22 @@ class MessageBase(metaclass=MessageType):
         """Return formatted message content."""
         return self.message
 
+    def for_recipient(self, to_user):
+        """Return an unsent copy of this message to another recipient.
+
+        Constructed message value is shared by copies with only
+        `ToUserName`, `LocalID` and `ClientMsgId` replaced, so the content
+        isn't formatted again for each recipient.
+        """
+        msg_value = self.to_value()
+        msg_obj = copy.copy(self)
+        msg_obj.to_user = to_user
+        msg_obj.msg_id = None
+        msg_obj.local_msg_id = msg_obj.get_local_msg_id()
+        msg_obj._msg_value = dict(
+            msg_value, ToUserName=to_user, **msg_obj.get_base_value())
+        return msg_obj
+
     def ack(self, local_msg_id, msg_id):
         """Acknowledge message has been sent successfully."""
         assert local_msg_id == str(
@@ -140,6 +184,11 @@ class MediaMessagebase(MessageBase):
     def get_message_content(self):
         return self.media_id
 
+    def update_media_id(self, media_id):
+        """Replace media id of an unsent message."""
+        self.media_id = media_id
+        self._msg_value = None
+
     def get_body_value(self):
         """Return media message body value."""
         return {
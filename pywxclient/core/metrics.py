@@ -0,0 +1,259 @@
+
+"""Request instrumentation and metrics export module."""
+
+import bisect
+import threading
+
+from collections import namedtuple
+from logging import getLogger
+
+
+__all__ = [
+    'MetricEvent', 'Instrumentation', 'MetricsRegistry',
+    'default_instrumentation']
+
+
+_logger = getLogger(__name__)
+
+
+MetricEvent = namedtuple(
+    'MetricEvent', ('kind', 'name', 'latency', 'size', 'ret', 'status',
+                    'error', 'labels'))
+
+
+class Instrumentation:
+    """Dispatch metric events to pluggable sinks.
+
+    A sink is any callable accepting a `MetricEvent`, for example a plain
+    callback function or a `MetricsRegistry` instance.
+    """
+
+    def __init__(self, sinks=None):
+        """Initialize instrumentation with sinks."""
+        self._sinks = tuple(sinks or ())
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        """Indicate whether any sink is registered."""
+        return bool(self._sinks)
+
+    def add_sink(self, sink):
+        """Register a metric sink."""
+        with self._lock:
+            self._sinks += (sink,)
+
+    def remove_sink(self, sink):
+        """Unregister a metric sink."""
+        with self._lock:
+            self._sinks = tuple(s for s in self._sinks if s is not sink)
+
+    def emit(
+            self, kind, name, latency, size=None, ret=None, status=None,
+            error=None, labels=None):
+        """Emit a metric event to all sinks.
+
+        :param kind: event kind, `api` for WeChatAPI calls and `http` for
+            http requests.
+        :param name: api name or request url path.
+        :param latency: call latency in seconds.
+        :param size: response body size in bytes.
+        :param ret: WeChat `BaseResponse.Ret` code.
+        :param status: http status code.
+        :param error: raised exception class name.
+        :param labels: optional dict of extra event labels, e.g. `lane` of
+            queued messages.
+        """
+        sinks = self._sinks
+        if not sinks:
+            return
+
+        event = MetricEvent(
+            kind, name, latency, size, ret, status, error, labels)
+        for sink in sinks:
+            try:
+                sink(event)
+            except Exception:
+                _logger.exception('metric sink %r failed', sink)
+
+
+class Histogram:
+    """Cumulative bucket histogram."""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        """Initialize histogram with sorted bucket upper bounds."""
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        """Add an observed value."""
+        idx = bisect.bisect_left(self.buckets, value)
+        if idx < len(self.counts):
+            self.counts[idx] += 1
+
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        """Return (upper bound, cumulative count) pairs."""
+        total = 0
+        pairs = []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            pairs.append((bound, total))
+
+        return pairs
+
+    def to_dict(self):
+        """Return histogram data as dict."""
+        return {
+            'buckets': self.cumulative_counts(), 'sum': self.sum,
+            'count': self.count}
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace(
+        '"', '\\"')
+
+
+def _format_labels(labels):
+    return '{' + ','.join(
+        '{0}="{1}"'.format(key, _escape_label(val))
+        for key, val in labels) + '}'
+
+
+class MetricsRegistry:
+    """In-memory metric sink with Prometheus text format export.
+
+    Metrics are aggregated by event kind and name, events having `labels`
+    are also counted by their labels in `labeled_requests`.
+    """
+
+    latency_buckets = (
+        0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    size_buckets = (
+        256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+    def __init__(self, prefix='pywxclient'):
+        """Initialize an empty registry."""
+        self.prefix = prefix
+        self._requests = {}
+        self._latencies = {}
+        self._sizes = {}
+        self._rets = {}
+        self._errors = {}
+        self._labeled_requests = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        """Record a metric event."""
+        key = (event.kind, event.name)
+        with self._lock:
+            self._requests[key] = self._requests.get(key, 0) + 1
+
+            latency_hist = self._latencies.get(key)
+            if latency_hist is None:
+                latency_hist = self._latencies[key] = Histogram(
+                    self.latency_buckets)
+            latency_hist.observe(event.latency)
+
+            if event.size is not None:
+                size_hist = self._sizes.get(key)
+                if size_hist is None:
+                    size_hist = self._sizes[key] = Histogram(
+                        self.size_buckets)
+                size_hist.observe(event.size)
+
+            for counter, value in (
+                    (self._rets, event.ret), (self._errors, event.error)):
+                if value is not None:
+                    counter_key = key + (value,)
+                    counter[counter_key] = counter.get(counter_key, 0) + 1
+
+            if event.labels:
+                labeled_key = key + (tuple(sorted(event.labels.items())),)
+                self._labeled_requests[labeled_key] = (
+                    self._labeled_requests.get(labeled_key, 0) + 1)
+
+    def snapshot(self):
+        """Return all recorded metrics as dict."""
+        with self._lock:
+            return {
+                'requests': dict(self._requests),
+                'latency': {
+                    key: hist.to_dict()
+                    for key, hist in self._latencies.items()},
+                'size': {
+                    key: hist.to_dict() for key, hist in self._sizes.items()},
+                'ret': dict(self._rets), 'errors': dict(self._errors),
+                'labeled_requests': dict(self._labeled_requests)}
+
+    def reset(self):
+        """Drop all recorded metrics."""
+        with self._lock:
+            for metric in (
+                    self._requests, self._latencies, self._sizes,
+                    self._rets, self._errors, self._labeled_requests):
+                metric.clear()
+
+    def _format_histogram(self, lines, metric_name, histograms):
+        lines.append('# TYPE {0} histogram'.format(metric_name))
+        for (kind, name), hist in sorted(histograms.items()):
+            labels = (('kind', kind), ('name', name))
+            for bound, count in hist.cumulative_counts():
+                lines.append('{0}_bucket{1} {2}'.format(
+                    metric_name, _format_labels(labels + (('le', bound),)),
+                    count))
+
+            lines.append('{0}_bucket{1} {2}'.format(
+                metric_name, _format_labels(labels + (('le', '+Inf'),)),
+                hist.count))
+            lines.append('{0}_sum{1} {2}'.format(
+                metric_name, _format_labels(labels), hist.sum))
+            lines.append('{0}_count{1} {2}'.format(
+                metric_name, _format_labels(labels), hist.count))
+
+    def to_prometheus(self):
+        """Return metrics in Prometheus text exposition format."""
+        prefix = self.prefix
+        lines = []
+        with self._lock:
+            metric_name = prefix + '_requests_total'
+            lines.append('# TYPE {0} counter'.format(metric_name))
+            for (kind, name), count in sorted(self._requests.items()):
+                lines.append('{0}{1} {2}'.format(
+                    metric_name, _format_labels(
+                        (('kind', kind), ('name', name))), count))
+
+            self._format_histogram(
+                lines, prefix + '_request_latency_seconds', self._latencies)
+            self._format_histogram(
+                lines, prefix + '_response_size_bytes', self._sizes)
+
+            for metric_name, label, counter in (
+                    (prefix + '_api_ret_total', 'ret', self._rets),
+                    (prefix + '_errors_total', 'exception', self._errors)):
+                lines.append('# TYPE {0} counter'.format(metric_name))
+                for (kind, name, value), count in sorted(
+                        counter.items(), key=lambda item: str(item[0])):
+                    lines.append('{0}{1} {2}'.format(
+                        metric_name, _format_labels(
+                            (('kind', kind), ('name', name),
+                             (label, value))), count))
+
+            metric_name = prefix + '_labeled_requests_total'
+            lines.append('# TYPE {0} counter'.format(metric_name))
+            for (kind, name, labels), count in sorted(
+                    self._labeled_requests.items()):
+                lines.append('{0}{1} {2}'.format(
+                    metric_name, _format_labels(
+                        (('kind', kind), ('name', name)) + labels), count))
+
+        return '\n'.join(lines) + '\n'
+
+
+default_instrumentation = Instrumentation()
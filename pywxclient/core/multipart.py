@@ -0,0 +1,140 @@
+
+"""Streaming multipart/form-data encoding module."""
+
+import uuid
+
+
+__all__ = ['MultipartEncoder', 'MultipartBody']
+
+
+def _encode_value(value):
+    if isinstance(value, bytes):
+        return value
+
+    return str(value).encode()
+
+
+def _quote_param(value):
+    """Quote header parameter in HTML5 form style."""
+    return _encode_value(value).replace(b'"', b'%22').replace(
+        b'\r', b'%0D').replace(b'\n', b'%0A')
+
+
+class MultipartBody:
+    """A file-like multipart body streaming file data from source.
+
+    Body parts are either bytes or `(source, offset, length)` tuples, where
+    source provides `read_at(offset, size)` like `contrib.file.File`.
+    """
+
+    block_size = 64 * 1024
+
+    def __init__(self, parts):
+        """Initialize body with parts."""
+        self._parts = parts
+        self._len = sum(
+            len(part) if isinstance(part, bytes) else part[2]
+            for part in parts)
+        self._part_idx = 0
+        self._part_pos = 0
+
+    def __len__(self):
+        """Return total size of body in bytes."""
+        return self._len
+
+    def __iter__(self):
+        """Iterate body in blocks of `block_size`."""
+        while True:
+            block = self.read(self.block_size)
+            if not block:
+                break
+
+            yield block
+
+    def _read_part(self, part, size):
+        pos = self._part_pos
+        if isinstance(part, bytes):
+            return part[pos: pos + size]
+
+        source, offset, length = part
+        size = min(size, length - pos)
+        if size <= 0:
+            return b''
+
+        data = source.read_at(offset + pos, size)
+        if not data:
+            raise IOError('source ended before expected length.')
+
+        return data
+
+    def read(self, size=-1):
+        """Read at most size bytes of body."""
+        if size is None or size < 0:
+            size = self._len
+
+        blocks = []
+        while size > 0 and self._part_idx < len(self._parts):
+            data = self._read_part(self._parts[self._part_idx], size)
+            if not data:
+                self._part_idx += 1
+                self._part_pos = 0
+                continue
+
+            blocks.append(data)
+            self._part_pos += len(data)
+            size -= len(data)
+
+        return b''.join(blocks)
+
+
+class MultipartEncoder:
+    """Encode multipart/form-data bodies sharing constant form fields.
+
+    The constant fields are serialised once when the encoder is created,
+    each `encode` call only serialises the extra fields and the file part
+    header, while file data is streamed from its source.
+    """
+
+    def __init__(self, fields, boundary=None):
+        """Initialize encoder.
+
+        :param fields: iterable of constant (name, value) form fields.
+        :param boundary: multipart boundary, random by default.
+        """
+        self.boundary = boundary or uuid.uuid4().hex
+        self._boundary_line = b'--' + self.boundary.encode() + b'\r\n'
+        self._fields = self._encode_fields(fields)
+        self._end = b'\r\n--' + self.boundary.encode() + b'--\r\n'
+
+    @property
+    def content_type(self):
+        """Return Content-Type header value of encoded bodies."""
+        return 'multipart/form-data; boundary=' + self.boundary
+
+    def _encode_fields(self, fields):
+        return b''.join(
+            self._boundary_line + b'Content-Disposition: form-data; name="' +
+            _quote_param(name) + b'"\r\n\r\n' + _encode_value(value) +
+            b'\r\n' for name, value in fields)
+
+    def encode(
+            self, name, filename, content_type, source, offset, length,
+            extra_fields=()):
+        """Return a `MultipartBody` with a file part.
+
+        :param name: file field name.
+        :param filename: file name.
+        :param content_type: file content type.
+        :param source: file source providing `read_at(offset, size)`.
+        :param offset: file data offset in source.
+        :param length: file data length.
+        :param extra_fields: form fields specific to this body.
+        """
+        file_header = (
+            self._boundary_line + b'Content-Disposition: form-data; name="' +
+            _quote_param(name) + b'"; filename="' + _quote_param(filename) +
+            b'"\r\nContent-Type: ' + _encode_value(content_type) +
+            b'\r\n\r\n')
+        head = self._fields + self._encode_fields(extra_fields) + file_header
+
+        return MultipartBody([head, (source, offset, length), self._end])
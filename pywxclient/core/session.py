@@ -3,18 +3,25 @@
 
 import copy
 import requests
+import time
 
 from abc import ABCMeta, abstractmethod
+from logging import getLogger
+from urllib.parse import urlparse
 
 from pywxclient import __version__
 from pywxclient.utils import cookie_to_dict
 from pywxclient.core.exception import RequestError
 from pywxclient.core.api import WeChatAPI
+from pywxclient.core.metrics import default_instrumentation
 
 
 __all__ = ['Session']
 
 
+_logger = getLogger(__name__)
+
+
 class WxSession:
 
     def __init__(self, skey, pass_ticket, wxsid, wxuin, isgrayscale=0):
@@ -93,6 +100,7 @@ class RequestsSession(requests.Session):
 
     user_agent = 'pywxclient/' + __version__
     default_headers = {'User-Agent': user_agent}
+    instrumentation = default_instrumentation
 
     def load(self, cookies):
         """Load cookie dict into cookiejar object."""
@@ -122,10 +130,28 @@ class RequestsSession(requests.Session):
 
         kwargs['headers'] = headers
 
+        start_time = time.monotonic()
         try:
-            return super(RequestsSession, self).request(method, url, **kwargs)
-        except requests.RequestException:
-            raise RequestError
+            res = super(RequestsSession, self).request(method, url, **kwargs)
+        except requests.RequestException as e:
+            self.instrumentation.emit(
+                'http', urlparse(url).path, time.monotonic() - start_time,
+                error=type(e).__name__)
+            raise RequestError from e
+
+        if self.instrumentation.enabled:
+            if kwargs.get('stream'):
+                # Don't consume streamed body
+                size = res.headers.get('Content-Length')
+                size = int(size) if size else None
+            else:
+                size = len(res.content)
+
+            self.instrumentation.emit(
+                'http', urlparse(url).path, time.monotonic() - start_time,
+                size=size, status=res.status_code)
+
+        return res
 
     def get(self, url, **kwargs):
 
@@ -139,6 +165,8 @@ class RequestsSession(requests.Session):
 class Session:
     """WeChat client session class."""
 
+    hook_events = ('request', 'response', 'exception')
+
     def __init__(
             self, request_session_cls=RequestsSession, session_data=None,
             endpoint=None, **kwargs):
@@ -153,13 +181,67 @@ class Session:
         else:
             self._req_session = request_session_cls(**kwargs)
 
-        self.get = self._req_session.get
-        self.post = self._req_session.post
-        self.request = self._req_session.request
+        self._hooks = {event: () for event in self.hook_events}
 
         if session_data:
             self.load(session_data)
 
+    def register_hook(self, event, hook):
+        """Register a request event hook.
+
+        :param event: one of `request`, `response` and `exception`.
+        :param hook: callable invoked as `hook(method, url, kwargs)` on
+            request, `hook(method, url, kwargs, response, elapsed)` on
+            response and `hook(method, url, kwargs, exc, elapsed)` on
+            exception.
+        """
+        if event not in self._hooks:
+            raise ValueError('Unknown hook event {0}.'.format(event))
+
+        self._hooks[event] += (hook,)
+
+    def unregister_hook(self, event, hook):
+        """Unregister a request event hook."""
+        self._hooks[event] = tuple(
+            h for h in self._hooks[event] if h is not hook)
+
+    def _dispatch_hook(self, event, *args):
+        for hook in self._hooks[event]:
+            try:
+                hook(*args)
+            except Exception:
+                _logger.exception('session %s hook %r failed', event, hook)
+
+    def request(self, method, url, **kwargs):
+        """Do http request and dispatch event hooks."""
+        hooks = self._hooks
+        if not (hooks['request'] or hooks['response'] or hooks['exception']):
+            return self._req_session.request(method, url, **kwargs)
+
+        self._dispatch_hook('request', method, url, kwargs)
+        start_time = time.monotonic()
+        try:
+            res = self._req_session.request(method, url, **kwargs)
+        except Exception as e:
+            self._dispatch_hook(
+                'exception', method, url, kwargs, e,
+                time.monotonic() - start_time)
+            raise
+
+        self._dispatch_hook(
+            'response', method, url, kwargs, res,
+            time.monotonic() - start_time)
+
+        return res
+
+    def get(self, url, **kwargs):
+        """Do GET http request."""
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        """Do POST http request."""
+        return self.request('POST', url, **kwargs)
+
     def finish_authorize(self, endpoint):
         """Session has authorized successfully."""
         self._authorized = True
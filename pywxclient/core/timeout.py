@@ -0,0 +1,116 @@
+
+"""Adaptive request timeout module."""
+
+import collections
+import math
+import threading
+
+
+__all__ = ['AdaptiveTimeout']
+
+
+class LatencyWindow:
+    """A sliding window of latency samples."""
+
+    def __init__(self, size):
+        """Initialize window with maximum sample number."""
+        self._samples = collections.deque(maxlen=size)
+        self._sorted = None
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, latency):
+        """Add a latency sample."""
+        self._samples.append(latency)
+        self._sorted = None
+
+    def percentile(self, pct):
+        """Return the nearest-rank percentile of samples."""
+        if not self._samples:
+            return None
+
+        if self._sorted is None:
+            self._sorted = sorted(self._samples)
+
+        rank = max(int(math.ceil(pct / 100 * len(self._sorted))), 1)
+        return self._sorted[rank - 1]
+
+
+class AdaptiveTimeout:
+    """Derive request timeouts from observed latency percentiles.
+
+    Timeouts are keyed by api name. Until enough samples are collected the
+    default timeout is used, afterwards both connect and read timeout are
+    the latency percentile multiplied by `multiplier`, bounded by the
+    floors and the default timeout which acts as ceiling.
+    """
+
+    def __init__(
+            self, percentile=99, multiplier=3.0, window=200, min_samples=20,
+            connect_floor=3.0, read_floor=5.0):
+        """Initialize timeout manager.
+
+        :param percentile: latency percentile timeouts are derived from.
+        :param multiplier: factor applied to the latency percentile.
+        :param window: number of latest samples kept per api.
+        :param min_samples: samples required before adapting timeouts.
+        :param connect_floor: minimum connect timeout in seconds.
+        :param read_floor: minimum read timeout in seconds.
+        """
+        self.percentile = percentile
+        self.multiplier = multiplier
+        self.window = window
+        self.min_samples = min_samples
+        self.connect_floor = connect_floor
+        self.read_floor = read_floor
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def observe(self, api_name, latency):
+        """Record an observed latency of api."""
+        with self._lock:
+            window = self._windows.get(api_name)
+            if window is None:
+                window = self._windows[api_name] = LatencyWindow(
+                    self.window)
+
+            window.add(latency)
+
+    def get_percentile(self, api_name, pct=None):
+        """Return latency percentile of api or None without samples."""
+        with self._lock:
+            window = self._windows.get(api_name)
+            if window is None:
+                return None
+
+            return window.percentile(pct or self.percentile)
+
+    def get(self, api_name, default):
+        """Return (connect, read) timeout tuple of api.
+
+        :param api_name: api name.
+        :param default: default timeout tuple, also the timeout ceiling.
+        """
+        with self._lock:
+            window = self._windows.get(api_name)
+            if window is None or len(window) < self.min_samples:
+                return default
+
+            latency = window.percentile(self.percentile)
+
+        connect_ceiling, read_ceiling = default
+        budget = latency * self.multiplier
+        connect_timeout = min(
+            max(budget, self.connect_floor), connect_ceiling)
+        read_timeout = min(max(budget, self.read_floor), read_ceiling)
+
+        return connect_timeout, read_timeout
+
+    def reset(self, api_name=None):
+        """Drop observed samples of one or all apis."""
+        with self._lock:
+            if api_name is None:
+                self._windows.clear()
+            else:
+                self._windows.pop(api_name, None)
@@ -0,0 +1,132 @@
+
+"""Resumable upload checkpoint module."""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+
+__all__ = ['UploadCheckpoint', 'UploadSession']
+
+
+class UploadCheckpoint:
+    """Upload progress of a file to a recipient."""
+
+    __slots__ = ('key', 'client_media_id', 'chunks', 'done')
+
+    def __init__(self, key, client_media_id, chunks, done=()):
+        """Initialize checkpoint."""
+        self.key = key
+        self.client_media_id = client_media_id
+        self.chunks = chunks
+        self.done = set(done)
+
+    def pending_chunks(self):
+        """Return chunk indexes which haven't been uploaded."""
+        return [idx for idx in range(self.chunks) if idx not in self.done]
+
+    def to_dict(self):
+        """Return checkpoint data."""
+        return {
+            'key': self.key, 'client_media_id': self.client_media_id,
+            'chunks': self.chunks, 'done': sorted(self.done)}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Initialize checkpoint from dict."""
+        return cls(
+            data['key'], data['client_media_id'], data['chunks'],
+            done=data['done'])
+
+
+class UploadSession:
+    """Record uploaded chunks so that a failed upload can be resumed.
+
+    Checkpoints are keyed by file md5, sender and recipient, and keep the
+    `ClientMediaId` of the upload. When `path` is given each checkpoint is
+    persisted as a json file in that directory after every finished chunk,
+    so uploads can be resumed after process restart.
+    """
+
+    def __init__(self, path=None):
+        """Initialize upload session.
+
+        :param path: checkpoint directory, checkpoints are only kept in
+            memory by default.
+        """
+        self.path = path
+        self._checkpoints = {}
+        self._lock = threading.Lock()
+
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def make_key(file_md5, from_username, to_username):
+        """Return checkpoint key."""
+        return hashlib.md5('|'.join(
+            (file_md5, from_username, to_username)).encode()).hexdigest()
+
+    def _checkpoint_path(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def _load(self, key):
+        if not self.path:
+            return None
+
+        try:
+            with open(self._checkpoint_path(key)) as f:
+                return UploadCheckpoint.from_dict(json.load(f))
+        except (IOError, ValueError, KeyError):
+            return None
+
+    def _save(self, checkpoint):
+        if not self.path:
+            return
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(checkpoint.to_dict(), f)
+
+        os.replace(tmp_path, self._checkpoint_path(checkpoint.key))
+
+    def resume(self, file_md5, from_username, to_username, chunks):
+        """Return unfinished checkpoint of upload or None."""
+        key = self.make_key(file_md5, from_username, to_username)
+        with self._lock:
+            checkpoint = self._checkpoints.get(key) or self._load(key)
+            if checkpoint is None or checkpoint.chunks != chunks:
+                return None
+
+            self._checkpoints[key] = checkpoint
+            return checkpoint
+
+    def start(
+            self, file_md5, from_username, to_username, client_media_id,
+            chunks):
+        """Create a new checkpoint of upload."""
+        key = self.make_key(file_md5, from_username, to_username)
+        checkpoint = UploadCheckpoint(key, client_media_id, chunks)
+        with self._lock:
+            self._checkpoints[key] = checkpoint
+            self._save(checkpoint)
+
+        return checkpoint
+
+    def mark_done(self, checkpoint, chunk_index):
+        """Record a successfully uploaded chunk."""
+        with self._lock:
+            checkpoint.done.add(chunk_index)
+            self._save(checkpoint)
+
+    def finish(self, checkpoint):
+        """Drop checkpoint of a completed upload."""
+        with self._lock:
+            self._checkpoints.pop(checkpoint.key, None)
+            if self.path:
+                try:
+                    os.remove(self._checkpoint_path(checkpoint.key))
+                except OSError:
+                    pass
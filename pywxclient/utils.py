@@ -3,15 +3,18 @@
 
 import functools
 import json
+import threading
 
 from collections import OrderedDict
+from concurrent.futures import Future
 from urllib.request import unquote
 from xml.dom.minidom import Document, parseString
 
 
 __all__ = [
     'ParseWxRes', 'cookie_to_dict', 'MessageType', 'json_dumps', 'xml2dict',
-    'dict2xml', 'call_retry', 'list2orderdict']
+    'dict2xml', 'call_retry', 'list2orderdict', 'SingleFlight',
+    'split_text']
 
 
 class QRUUID:
@@ -244,3 +247,93 @@ def call_retry(retry_exceptions, retries=3):
 def list2orderdict(key_list, val_list):
     """Return a ordered dict with two lists."""
     return OrderedDict(zip(key_list, val_list))
+
+
+_text_boundaries = (
+    '\n\n', '\n', '\u3002', '\uff01', '\uff1f', '. ', '! ', '? ', ' ')
+
+
+def _fit_length(text, max_chars, max_bytes, encoding):
+    """Return length of the longest text prefix within limits."""
+    length = len(text) if max_chars is None else min(len(text), max_chars)
+    if max_bytes is not None:
+        data = text[:length].encode(encoding)
+        if len(data) > max_bytes:
+            length = len(data[:max_bytes].decode(encoding, 'ignore'))
+
+    return length
+
+
+def split_text(text, max_chars=None, max_bytes=None, encoding='utf-8'):
+    """Split text into parts within character and encoded byte limits.
+
+    A part is cut at the last paragraph, line, sentence or word boundary in
+    the second half of the limit, or right at the limit when there's none.
+    Whitespace around cuts is dropped. `ValueError` is raised when a single
+    character exceeds the limits.
+    """
+    parts = []
+    text = text.strip()
+    while text:
+        length = _fit_length(text, max_chars, max_bytes, encoding)
+        if length >= len(text):
+            parts.append(text)
+            break
+
+        if not length:
+            raise ValueError(
+                'character {0!r} exceeds part limits'.format(text[0]))
+
+        cut = length
+        window = text[:length]
+        for boundary in _text_boundaries:
+            idx = window.rfind(boundary)
+            if idx >= length // 2 and idx > 0:
+                cut = idx + len(boundary)
+                break
+
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+
+    return parts
+
+
+class SingleFlight:
+    """Share one in-flight call among concurrent callers with same key.
+
+    The first caller of a key executes the call, callers arriving before it
+    finishes wait and receive the same result or exception.
+    """
+
+    def __init__(self):
+        """Initialize with no in-flight call."""
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        """Call func or wait for the in-flight call of key."""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def in_flight(self):
+        """Return the number of in-flight calls."""
+        with self._lock:
+            return len(self._calls)
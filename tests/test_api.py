@@ -0,0 +1,185 @@
+
+import json
+import os
+import threading
+
+from email.parser import BytesParser
+
+import pytest
+
+from pywxclient.contrib.file import File
+from pywxclient.core.api import WeChatAPI
+from pywxclient.core.endpoint import EndpointSelector
+from pywxclient.core.exception import (
+    APIResponseError, RequestError, SessionExpiredError)
+from pywxclient.core.upload import UploadSession
+
+
+class FakeSession:
+
+    def __init__(self, fail_chunks=()):
+        self.chunks = []
+        self.upload_reqs = []
+        self.fail_chunks = list(fail_chunks)
+        self._lock = threading.Lock()
+
+    def get_wx_session_data(self):
+        return {'pass_ticket': 'ticket', 'wxuin': 1, 'wxsid': 's', 'skey': 'k'}
+
+    def get_session_cookies(self):
+        return {'webwx_data_ticket': 'data_ticket'}
+
+    @property
+    def wx_endpoint(self):
+        return 'wx.qq.com'
+
+    def post(self, url, data=None, headers=None, **kwargs):
+        body = data.read()
+        assert len(body) == len(data)
+
+        fields = parse_multipart(headers['Content-Type'], body)
+        assert fields['webwx_data_ticket'] == b'data_ticket'
+        assert fields['name'] == b'a.txt'
+
+        chunk = int(fields.get('chunk', 0))
+        chunks = int(fields.get('chunks', 1))
+        with self._lock:
+            if chunk in self.fail_chunks:
+                self.fail_chunks.remove(chunk)
+                raise RequestError
+
+            self.chunks.append((chunk, fields['filename']))
+            self.upload_reqs.append(json.loads(
+                fields['uploadmediarequest'].decode()))
+
+        return {
+            'BaseResponse': {'Ret': 0}, 'StartPos': 10,
+            'MediaId': '@media' if chunk == chunks - 1 else ''}
+
+
+def parse_multipart(content_type, body):
+    message = BytesParser().parsebytes(
+        b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+    return {
+        part.get_param('name', header='content-disposition'):
+        part.get_payload(decode=True) for part in message.get_payload()}
+
+
+@pytest.fixture
+def file_obj():
+    file_obj = File(b'0123456789')
+    file_obj.name = 'a.txt'
+    file_obj._type = 'txt'
+    file_obj._last_mtime = 0
+    return file_obj
+
+
+@pytest.fixture(autouse=True)
+def api(mocker):
+    mocker.patch.object(WeChatAPI, 'max_file_body', 3)
+    mocker.patch(
+        'pywxclient.core.api.decode_json_response', side_effect=lambda r: r)
+
+
+class TestUploadFile:
+
+    @pytest.mark.parametrize('concurrency', (1, 3))
+    @pytest.mark.parametrize('fail_chunks', ((), (1, 3)))
+    def test_upload_file(self, file_obj, concurrency, fail_chunks):
+        session = FakeSession(fail_chunks)
+        media_id = WeChatAPI.upload_file(
+            session, file_obj, '@a', '@b', concurrency=concurrency)
+
+        assert media_id == '@media'
+        assert sorted(session.chunks) == [
+            (0, b'012'), (1, b'345'), (2, b'678'), (3, b'9')]
+        assert session.chunks[-1][0] == 3
+
+    def test_upload_file_failure(self, file_obj):
+        session = FakeSession((1, 1))
+
+        with pytest.raises(RequestError):
+            WeChatAPI.upload_file(
+                session, file_obj, '@a', '@b', chunk_retries=1)
+
+        assert 3 not in dict(session.chunks)
+
+    def test_upload_file_no_media_id(self, file_obj, mocker):
+        session = FakeSession()
+        mocker.patch.object(WeChatAPI, 'max_file_body', 10)
+        mocker.patch.object(
+            session, 'post', return_value={
+                'BaseResponse': {'Ret': 0}, 'MediaId': '', 'StartPos': 10})
+
+        with pytest.raises(APIResponseError):
+            WeChatAPI.upload_file(session, file_obj, '@a', '@b')
+
+    @pytest.mark.parametrize('concurrency', (1, 3))
+    def test_resume_upload(self, tmpdir, file_obj, concurrency):
+        session = FakeSession((2,))
+        upload_session = UploadSession(str(tmpdir))
+
+        with pytest.raises(RequestError):
+            WeChatAPI.upload_file(
+                session, file_obj, '@a', '@b', concurrency=concurrency,
+                chunk_retries=0, upload_session=upload_session)
+
+        uploaded_chunks = session.chunks
+        assert (3, b'9') not in uploaded_chunks
+        assert len(os.listdir(str(tmpdir))) == 1
+
+        # Resume from checkpoint on disk
+        session.chunks = []
+        media_id = WeChatAPI.upload_file(
+            session, file_obj, '@a', '@b', concurrency=concurrency,
+            upload_session=UploadSession(str(tmpdir)))
+
+        assert media_id == '@media'
+        assert session.chunks[-1] == (3, b'9')
+        assert sorted(uploaded_chunks + session.chunks) == [
+            (0, b'012'), (1, b'345'), (2, b'678'), (3, b'9')]
+        assert len(set(
+            req['ClientMediaId'] for req in session.upload_reqs)) == 1
+        assert not os.listdir(str(tmpdir))
+
+
+def test_probe_endpoints(mocker):
+    statuses = {'wx.qq.com': 200, 'wx2.qq.com': 502, 'web.wechat.com': 302}
+
+    def request(method, url, **kwargs):
+        endpoint = url.split('/')[2][len(WeChatAPI.login_sub_host):]
+        return mocker.Mock(status_code=statuses.get(endpoint, 200))
+
+    session = mocker.Mock()
+    session.request.side_effect = request
+    mocker.patch.object(
+        WeChatAPI, 'endpoint_selector',
+        EndpointSelector(list(statuses)))
+
+    stats = WeChatAPI.probe_endpoints(session)
+
+    assert stats['wx.qq.com']['last_failure'] is None
+    assert stats['web.wechat.com']['last_failure'] is None
+    assert stats['wx2.qq.com']['last_failure'] is not None
+    assert stats['wx2.qq.com']['error_rate'] > 0
+
+
+@pytest.mark.parametrize('retcode, error', (
+    ('0', None), ('1100', SessionExpiredError),
+    ('1101', SessionExpiredError), ('1102', SessionExpiredError),
+    ('1205', APIResponseError)))
+def test_check_sync(mocker, retcode, error):
+    session = mocker.Mock(wx_endpoint='wx.qq.com')
+    session.get_wx_session_data.return_value = {
+        'wxuin': 1, 'wxsid': 's', 'skey': 'k',
+        'sync_key': {'List': [{'Key': 1, 'Val': 2}]}}
+    mocker.patch(
+        'pywxclient.utils.ParseWxRes.parse_sync_check',
+        return_value={'retcode': retcode, 'selector': '2'})
+
+    if error is None:
+        assert WeChatAPI.check_sync(session)['selector'] == '2'
+    else:
+        # Logged out session ends sync loop instead of being retried
+        with pytest.raises(error):
+            WeChatAPI.check_sync(session)
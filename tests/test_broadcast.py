@@ -0,0 +1,59 @@
+
+import threading
+
+import pytest
+
+from pywxclient.contrib import Broadcaster, SendQueue
+from pywxclient.core.exception import APIResponseError
+from pywxclient.core.message import ImageMessage
+
+
+class BroadcastClient:
+
+    def __init__(self):
+        self.uploads = []
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def upload(self, file_obj, to_username):
+        self.uploads.append(to_username)
+        return 'media-id'
+
+    def send_message(self, message, file_obj=None):
+        if message.to_user == 'bad':
+            raise APIResponseError('Ret 1')
+
+        with self._lock:
+            self.sent.append(message.to_value())
+
+        message.ack(str(message.local_msg_id), 'msg-' + message.to_user)
+
+
+@pytest.mark.parametrize('use_queue', (False, True))
+def test_broadcast(use_queue):
+    client = BroadcastClient()
+    send_queue = SendQueue(
+        client, account_rate=1000, account_burst=100) if use_queue else None
+    broadcaster = Broadcaster(
+        client, rate=1000, burst=100, send_queue=send_queue)
+    message = ImageMessage('me', None, None)
+    recipients = ['a', 'bad', 'c']
+
+    report = broadcaster.broadcast(message, recipients, file_obj=object())
+
+    assert client.uploads == ['a']
+    assert [result.username for result in report.results] == recipients
+    assert [result.msg_id for result in report.succeeded] == [
+        'msg-a', 'msg-c']
+    assert [result.username for result in report.failed] == ['bad']
+    assert isinstance(report.failed[0].error, APIResponseError)
+    assert sorted(value['ToUserName'] for value in client.sent) == ['a', 'c']
+    assert {value['MediaId'] for value in client.sent} == {'media-id'}
+    local_ids = [result.local_msg_id for result in report.results]
+    assert len(set(local_ids)) == len(recipients)
+    assert len({value['ClientMsgId'] for value in client.sent}) == 2
+
+    if send_queue is not None:
+        bulk_stats = send_queue.stats()['lanes']['bulk']
+        assert (bulk_stats['sent'], bulk_stats['failed']) == (2, 1)
+        send_queue.shutdown()
@@ -0,0 +1,444 @@
+
+import threading
+import time
+
+import pytest
+import requests
+
+from pywxclient.contrib.file import File
+from pywxclient.core.api import WeChatAPI
+from pywxclient.core.cache import MediaCache
+from pywxclient.core.client import SyncClient
+from pywxclient.core.exception import (
+    APIResponseError, RequestError, SendTimeout, SessionExpiredError,
+    UnconfirmedMessage)
+from pywxclient.core.ledger import SendLedger
+from pywxclient.core.message import ImageMessage, TextMessage
+from pywxclient.core.metrics import Instrumentation, MetricsRegistry
+from pywxclient.core.session import Session
+
+
+@pytest.fixture
+def file_obj():
+    file_obj = File(b'image content')
+    file_obj.name = 'a.png'
+    file_obj._type = 'png'
+    return file_obj
+
+
+@pytest.fixture
+def client(mocker):
+    client = SyncClient(mocker.Mock(), media_cache=MediaCache())
+    client.user = {'UserName': '@me'}
+    return client
+
+
+class TestMediaCache:
+
+    def test_lru(self):
+        cache = MediaCache(max_entries=2)
+        cache.set('md5a', 'image/png', '@a')
+        cache.set('md5b', 'image/png', '@b')
+        assert cache.get('md5a', 'image/png') == '@a'
+
+        cache.set('md5c', 'image/png', '@c')
+        assert cache.get('md5b', 'image/png') is None
+        assert cache.get('md5a', 'image/png') == '@a'
+        assert cache.get('md5a', 'image/gif') is None
+
+    def test_ttl(self):
+        cache = MediaCache(ttl=0)
+        cache.set('md5a', 'image/png', '@a')
+
+        assert cache.get('md5a', 'image/png') is None
+
+    def test_persistence(self, tmpdir):
+        path = str(tmpdir.join('media.json'))
+        cache = MediaCache(path=path)
+        cache.set('md5a', 'image/png', '@a')
+
+        assert MediaCache(path=path).get('md5a', 'image/png') == '@a'
+
+
+class TestClientMediaCache:
+
+    def test_upload_once(self, mocker, client, file_obj):
+        upload_func = mocker.patch.object(
+            WeChatAPI, 'upload_file', return_value='@media')
+
+        assert client.upload(file_obj, '@a') == '@media'
+        assert client.upload(file_obj, '@b') == '@media'
+        assert upload_func.call_count == 1
+
+    def test_send_fallback(self, mocker, client, file_obj):
+        mocker.patch.object(
+            WeChatAPI, 'upload_file', side_effect=['@old', '@new'])
+        message = ImageMessage('@me', '@a', client.upload(file_obj, '@a'))
+        message.to_value()
+
+        send_func = mocker.Mock(side_effect=[
+            APIResponseError,
+            {'LocalID': str(message.local_msg_id), 'MsgID': '123'}])
+        mocker.patch.dict(
+            client.msg_send_routines, {ImageMessage.msg_type: send_func})
+        client.send_message(message, file_obj=file_obj)
+
+        assert message.media_id == '@new'
+        assert message.to_value()['MediaId'] == '@new'
+        assert message.msg_id == '123'
+        assert client.media_cache.get(file_obj.md5, 'image/png') == '@new'
+
+
+class TestSendMessageAsync:
+
+    def test_pipelined_send(self, mocker, client):
+        barrier = threading.Barrier(3, timeout=5)
+
+        def send_text(session, message):
+            # All messages are in flight at the same time
+            barrier.wait()
+            return {'LocalID': str(message.local_msg_id),
+                    'MsgID': 'msg-' + message.to_user}
+
+        mocker.patch.dict(
+            client.msg_send_routines, {TextMessage.msg_type: send_text})
+        messages = [
+            TextMessage('@me', to_user, 'hi', local_msg_id=str(idx))
+            for idx, to_user in enumerate(('@a', '@b', '@c'))]
+        futures = [client.send_message_async(msg) for msg in messages]
+
+        assert [future.result(timeout=5) for future in futures] == [
+            ('0', 'msg-@a'), ('1', 'msg-@b'), ('2', 'msg-@c')]
+        assert client.unacked_messages() == []
+        client.close()
+
+    def test_send_timeout(self, mocker, client):
+        event = threading.Event()
+
+        def send_text(session, message):
+            event.wait(5)
+            raise APIResponseError
+
+        mocker.patch.dict(
+            client.msg_send_routines, {TextMessage.msg_type: send_text})
+        message = TextMessage('@me', '@a', 'hi')
+        future = client.send_message_async(message, timeout=0.05)
+
+        assert client.unacked_messages() == [message]
+        # Expired at deadline without any other send activity
+        error = future.exception(timeout=5)
+        assert isinstance(error, SendTimeout)
+        assert str(message.local_msg_id) in str(error)
+
+        assert client.unacked_messages() == []
+        # Zero timeout isn't replaced by default
+        expired = client.send_message_async(
+            TextMessage('@me', '@b', 'hi'), timeout=0)
+        assert isinstance(expired.exception(timeout=5), SendTimeout)
+
+        failed = client.send_message_async(TextMessage('@me', '@b', 'hi'))
+        event.set()
+        with pytest.raises(APIResponseError):
+            failed.result(timeout=5)
+
+        client.close()
+        assert client._unacked_watchdog is None
+
+    def test_expired_message_not_sent(self, mocker, client):
+        sent = []
+        event = threading.Event()
+
+        def send_text(session, message):
+            event.wait(5)
+            sent.append(message.message)
+            return {'LocalID': str(message.local_msg_id), 'MsgID': '1'}
+
+        mocker.patch.dict(
+            client.msg_send_routines, {TextMessage.msg_type: send_text})
+        client.send_concurrency = 1
+        first = client.send_message_async(TextMessage('@me', '@a', 'first'))
+        second = client.send_message_async(
+            TextMessage('@me', '@a', 'second'), timeout=0.05)
+
+        # Expires while queued behind the first message
+        assert isinstance(second.exception(timeout=5), SendTimeout)
+        event.set()
+        first.result(timeout=5)
+        client.close()
+
+        assert sent == ['first']
+
+
+class TestSendLedger:
+
+    @pytest.fixture
+    def client(self, mocker):
+        client = SyncClient(
+            mocker.Mock(), send_ledger=SendLedger(confirm_timeout=60))
+        client.user = {'UserName': '@me'}
+        return client
+
+    def patch_send(self, mocker, client, side_effect):
+        send_func = mocker.Mock(side_effect=side_effect)
+        mocker.patch.dict(
+            client.msg_send_routines, {TextMessage.msg_type: send_func})
+        return send_func
+
+    @pytest.mark.parametrize('echo', (
+        {'ClientMsgId': '{local_msg_id}'},
+        {'ToUserName': '@a', 'MsgType': 1, 'Content': 'a &amp; b'}))
+    def test_confirm_by_echo(self, mocker, client, echo):
+        send_func = self.patch_send(mocker, client, [requests.Timeout])
+        message = TextMessage('@me', '@a', 'a & b')
+
+        with pytest.raises(requests.Timeout):
+            client.send_message(message)
+
+        with pytest.raises(UnconfirmedMessage):
+            client.send_message(message)
+
+        echo = {
+            key: val.format(local_msg_id=message.local_msg_id)
+            if isinstance(val, str) else val for key, val in echo.items()}
+        echo.update(FromUserName='@me', MsgId='123')
+        mocker.patch.object(WeChatAPI, 'do_sync', return_value={
+            'SyncKey': {}, 'AddMsgList': [
+                {'FromUserName': '@a', 'MsgId': '1', 'Content': 'a & b'},
+                echo]})
+        client.sync_message()
+
+        client.send_message(message)
+        assert message.msg_id == '123'
+        assert send_func.call_count == 1
+
+    def test_resend(self, mocker, client):
+        message = TextMessage('@me', '@a', 'hi')
+        send_func = self.patch_send(mocker, client, [
+            APIResponseError, requests.ConnectionError,
+            {'LocalID': str(message.local_msg_id), 'MsgID': '1'}])
+
+        with pytest.raises(APIResponseError):
+            client.send_message(message)
+
+        # Rejected message is resent at once
+        with pytest.raises(requests.ConnectionError):
+            client.send_message(message)
+
+        client.send_ledger.confirm_timeout = 0
+        client.send_ledger.mark_unknown(client.send_ledger.get(message))
+        client.send_message(message)
+
+        assert message.msg_id == '1'
+        assert send_func.call_count == 3
+        assert client.send_ledger.get(message).status == SendLedger.SENT
+
+    @pytest.mark.parametrize('error, status', (
+        (APIResponseError, SendLedger.FAILED),
+        (SessionExpiredError, SendLedger.FAILED),
+        (RequestError, SendLedger.FAILED),
+        (requests.ConnectTimeout, SendLedger.FAILED),
+        (requests.ReadTimeout, SendLedger.UNKNOWN),
+        (requests.ConnectionError, SendLedger.UNKNOWN)))
+    def test_outcome(self, mocker, client, error, status):
+        self.patch_send(mocker, client, [error])
+        message = TextMessage('@me', '@a', 'hi')
+
+        with pytest.raises(error):
+            client.send_message(message)
+
+        assert client.send_ledger.get(message).status == status
+
+    def test_wrapped_transport_error(self, mocker, client):
+        def send_text(session, message):
+            try:
+                raise requests.ReadTimeout
+            except requests.ReadTimeout as e:
+                raise RequestError from e
+
+        self.patch_send(mocker, client, send_text)
+        message = TextMessage('@me', '@a', 'hi')
+
+        with pytest.raises(RequestError):
+            client.send_message(message)
+
+        assert client.send_ledger.get(message).status == SendLedger.UNKNOWN
+
+
+def test_send_long_text(mocker, client):
+    sent = []
+
+    def send_text(session, message):
+        sent.append(message.message)
+        return {'LocalID': str(message.local_msg_id),
+                'MsgID': str(len(sent))}
+
+    mocker.patch.dict(
+        client.msg_send_routines, {TextMessage.msg_type: send_text})
+    future = client.send_long_text(
+        '@a', 'first line\nsecond line\nthird', max_chars=12)
+
+    assert [msg_id for __, msg_id in future.result(timeout=5)] == [
+        '1', '2', '3']
+    assert sent == ['first line', 'second line', 'third']
+
+    with pytest.raises(ValueError):
+        client.send_long_text('@a', '   ')
+
+    client.close()
+
+
+class TestRunForever:
+
+    def test_sync_loop(self, mocker, client):
+        client.sync_retry_delay = 0.01
+        selectors = [RequestError, 0, 2, 7]
+
+        def sync_check():
+            selector = selectors.pop(0)
+            if not selectors:
+                client.stop()
+            if isinstance(selector, type):
+                raise selector
+
+            return selector
+
+        sync_res = {
+            'AddMsgList': [
+                {'MsgId': '1', 'MsgType': 1, 'FromUserName': '@a',
+                 'ToUserName': '@me', 'Content': 'hi',
+                 'CreateTime': int(time.time())},
+                {'MsgId': '2', 'MsgType': 9999},
+                # Malformed messages are skipped
+                {'MsgId': '3', 'MsgType': 49},
+                {'MsgId': '4', 'MsgType': 1, 'Content': 'no sender'}],
+            'ModContactList': [{'UserName': '@a'}]}
+        mocker.patch.object(client, 'sync_check', side_effect=sync_check)
+        mocker.patch.object(client, 'sync_message', return_value=sync_res)
+        flush = mocker.patch.object(client, 'flush_sync_key')
+
+        texts = []
+        contacts = []
+        client.register_message_handler(
+            lambda message: texts.append(message.message),
+            msg_types=(TextMessage.msg_type,))
+        client.register_message_handler(mocker.Mock(side_effect=ValueError))
+        client.register_contact_handler(contacts.append)
+        registry = MetricsRegistry()
+        client.run_forever(instrumentation=Instrumentation([registry]))
+
+        # Zero selector isn't synced
+        assert client.sync_message.call_count == 2
+        assert flush.call_count == 2
+        assert texts == ['hi', 'hi']
+        assert contacts == [{'UserName': '@a'}] * 2
+        stats = client.loop_stats()
+        assert stats['iterations'] == 4
+        assert stats['errors'] == 1
+        assert stats['messages'] == 2
+        assert 0 <= stats['lag'] < 5
+        requests_count = registry.snapshot()['requests']
+        assert requests_count[('loop', 'iteration')] == 4
+        assert requests_count[('loop', 'message_lag')] == 2
+
+    def test_session_expired(self, mocker, client):
+        mocker.patch.object(
+            client, 'sync_check', side_effect=SessionExpiredError)
+
+        with pytest.raises(SessionExpiredError):
+            client.run_forever()
+
+    def test_pipelined_sync_loop(self, mocker):
+        session = Session()
+        session.initialize_wx_session({
+            'skey': 'skey', 'pass_ticket': 'ticket', 'wxsid': 'sid',
+            'wxuin': 1, 'isgrayscale': 0, 'sync_key': {'Count': 0}})
+        client = SyncClient(session)
+        client.user = {'UserName': '@me'}
+        polled_keys = []
+        second_synced = threading.Event()
+        batch_keys = iter((1, 2))
+
+        def sync_check():
+            polled_keys.append(
+                session.get_wx_session_data()['sync_key']['Count'])
+            if len(polled_keys) == 2:
+                client.stop()
+
+            return 2
+
+        def sync_message():
+            key = next(batch_keys)
+            if key == 2:
+                second_synced.set()
+
+            client._sync_key = {'Count': key}
+            return {'AddMsgList': [
+                {'MsgId': str(key), 'MsgType': 1, 'FromUserName': '@a',
+                 'ToUserName': '@me', 'Content': str(key),
+                 'CreateTime': int(time.time())}]}
+
+        handled = []
+        dumped_keys = []
+
+        def handler(message):
+            if message.message == '1':
+                # Next batch is synced while this one is being handled
+                assert second_synced.wait(5)
+
+            dumped_keys.append(
+                client.dump()['session']['wx_session']['sync_key'])
+            handled.append(message.message)
+
+        mocker.patch.object(client, 'sync_check', side_effect=sync_check)
+        mocker.patch.object(client, 'sync_message', side_effect=sync_message)
+        client.register_message_handler(handler)
+        client.run_forever(pipelined=True, queue_size=1)
+
+        assert polled_keys == [0, 1]
+        assert handled == ['1', '2']
+        # Dumped sync key only advances after batch is handled
+        assert dumped_keys == [{'Count': 0}, {'Count': 1}]
+        assert client.dump()['session']['wx_session']['sync_key'] == {
+            'Count': 2}
+
+    @pytest.fixture
+    def pipelined_client(self, mocker):
+        session = Session()
+        session.initialize_wx_session({
+            'skey': 'skey', 'pass_ticket': 'ticket', 'wxsid': 'sid',
+            'wxuin': 1, 'isgrayscale': 0, 'sync_key': {'Count': 0}})
+        client = SyncClient(session)
+        client.user = {'UserName': '@me'}
+        mocker.patch.object(client, 'sync_check', return_value=2)
+        return client
+
+    def test_pipelined_malformed_message(self, mocker, pipelined_client):
+        client = pipelined_client
+        handled = []
+
+        def handler(message):
+            handled.append(message.message)
+            client.stop()
+
+        mocker.patch.object(client, 'sync_message', return_value={
+            'AddMsgList': [
+                {'MsgId': '1', 'MsgType': 49},
+                {'MsgId': '2', 'MsgType': 1, 'FromUserName': '@a',
+                 'ToUserName': '@me', 'Content': 'hi',
+                 'CreateTime': int(time.time())}]})
+        client.register_message_handler(handler)
+        client.run_forever(pipelined=True, queue_size=1)
+
+        assert handled[0] == 'hi'
+
+    def test_pipelined_malformed_batch(self, mocker, pipelined_client):
+        client = pipelined_client
+        mocker.patch.object(
+            client, 'sync_message', return_value={'AddMsgList': None})
+
+        # Processor failure is raised instead of blocking on full queue
+        with pytest.raises(TypeError):
+            client.run_forever(pipelined=True, queue_size=1)
+
+        assert client.dump()['session']['wx_session']['sync_key'] == {
+            'Count': 0}
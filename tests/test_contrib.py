@@ -1,7 +1,20 @@
 
+import hashlib
+import io
+import os
+import threading
+
+from unittest import mock
+
 import pytest
+import requests
 
-from pywxclient.contrib import HTTPFile
+from pywxclient.contrib import (
+    AvatarCache, HTTPFile, LocalFile, MediaDownloader, MediaPrefetcher)
+from pywxclient.contrib.file import File
+from pywxclient.core.message import (
+    FileMessage, ImageMessage, TextMessage, VoiceMessage)
+from pywxclient.core.exception import FileTooLarge
 
 
 @pytest.mark.parametrize(
@@ -31,3 +44,277 @@ def test_http_file_name(mocker, url, content_disposition, name):
     file_obj = HTTPFile(url)
 
     assert file_obj.name == name
+
+
+@pytest.mark.parametrize('use_mmap', (True, False))
+@pytest.mark.parametrize('content', (b'', b'hello world', b'x' * 1300000))
+def test_local_file(tmpdir, use_mmap, content):
+    file_path = tmpdir.join('haha.png')
+    file_path.write_binary(content)
+
+    with LocalFile(str(file_path), use_mmap=use_mmap) as file_obj:
+        assert file_obj.name == 'haha.png'
+        assert file_obj.size == len(content)
+        assert file_obj.media_type() == 'image/png'
+        assert file_obj.md5 == hashlib.md5(content).hexdigest()
+
+        assert file_obj.read(5) == content[:5]
+        assert file_obj.read_at(3, 4) == content[3:7]
+        assert file_obj.tell() == len(content[:5])
+        file_obj.seek(0)
+        assert file_obj.read() == content
+
+        if use_mmap and content:
+            with pytest.raises(io.UnsupportedOperation):
+                file_obj.fileno()
+        else:
+            assert file_obj.fileno() >= 0
+
+    assert file_obj.closed()
+    with pytest.raises(io.UnsupportedOperation):
+        File(b'hello').fileno()
+
+
+@pytest.mark.parametrize(
+    'content, max_size, content_length', (
+        (b'hello' * 100000, None, None),
+        (b'hello' * 100000, 500000, '500000'),
+        (b'hello' * 100000, 499999, None),
+        (b'hello' * 100000, 499999, '500000')))
+def test_http_file_stream(mocker, content, max_size, content_length):
+
+    class Res:
+
+        headers = {'Content-Type': 'video/mp4'}
+        if content_length:
+            headers['Content-Length'] = content_length
+
+        @classmethod
+        def iter_content(cls, chunk_size):
+            for idx in range(0, len(content), chunk_size):
+                yield content[idx: idx + chunk_size]
+
+        @classmethod
+        def close(cls):
+            pass
+
+    get_func = mocker.patch('requests.get')
+    get_func.return_value = Res
+    mocker.patch.object(HTTPFile, 'spool_size', 1024)
+
+    if max_size is not None and len(content) > max_size:
+        with pytest.raises(FileTooLarge):
+            HTTPFile('https://foo.com/a.mp4', stream=True, max_size=max_size)
+
+        return
+
+    file_obj = HTTPFile(
+        'https://foo.com/a.mp4', stream=True, max_size=max_size)
+
+    assert file_obj.size == len(content)
+    assert file_obj.md5 == hashlib.md5(content).hexdigest()
+    assert file_obj.media_type() == 'video/mp4'
+    assert file_obj.read() == content
+
+
+def test_file_md5_cache(tmpdir, mocker):
+    file_path = tmpdir.join('haha.txt')
+    file_path.write_binary(b'hello')
+
+    file_obj = LocalFile(str(file_path), use_mmap=False)
+    iter_chunks = mocker.spy(file_obj, 'iter_chunks')
+
+    assert file_obj.md5 == hashlib.md5(b'hello').hexdigest()
+    assert file_obj.fingerprint == (file_obj.md5, 5)
+    assert iter_chunks.call_count == 1
+
+    file_path.write_binary(b'world')
+    os.utime(str(file_path), ns=(0, 10 ** 9))
+
+    assert file_obj.md5 == hashlib.md5(b'world').hexdigest()
+    assert iter_chunks.call_count == 2
+
+    file_obj.invalidate_digest()
+    assert file_obj.md5 == hashlib.md5(b'world').hexdigest()
+    assert iter_chunks.call_count == 3
+    file_obj.close()
+
+
+class MediaClient:
+
+    content = b'0123456789' * 10000
+
+    def __init__(self, support_range=True):
+        self.support_range = support_range
+        self.requests = []
+
+    def get_message_media(self, message, headers=None):
+        self.requests.append(headers)
+        content = self.content
+        status_code = 200
+        if headers and self.support_range:
+            offset = int(headers['Range'][6:-1])
+            content = content[offset:]
+            status_code = 206
+
+        fail = len(self.requests) == 1
+
+        class Res:
+
+            headers = {}
+
+            @classmethod
+            def iter_content(cls, chunk_size):
+                yield content[:30000]
+                if fail:
+                    raise requests.ConnectionError
+
+                yield content[30000:]
+
+            @classmethod
+            def close(cls):
+                pass
+
+        Res.status_code = status_code
+        return Res
+
+
+@pytest.mark.parametrize('support_range', (True, False))
+def test_media_downloader(tmpdir, support_range):
+    client = MediaClient(support_range)
+    path = str(tmpdir.join('media.jpg'))
+
+    with MediaDownloader(client, max_workers=2) as downloader:
+        result = downloader.submit(mock.Mock(msg_id='1'), path).result()
+
+    assert tmpdir.join('media.jpg').read_binary() == client.content
+    assert client.requests == [None, {'Range': 'bytes=30000-'}]
+    assert result.size == len(client.content)
+    assert result.resumed == support_range
+    assert result.downloaded == (
+        100000 if support_range else 130000)
+    assert downloader.stats()['downloads'] == 1
+
+
+def test_media_prefetcher(tmpdir):
+
+    class Client:
+
+        def __init__(self):
+            self.fetched = []
+            self.started = threading.Event()
+            self.event = threading.Event()
+
+        def get_message_media(self, message, headers=None):
+            self.started.set()
+            self.event.wait(5)
+            self.fetched.append(message.msg_id)
+            res = mock.Mock(status_code=200, headers={})
+            res.iter_content.return_value = [message.msg_id.encode()]
+            return res
+
+    client = Client()
+    prefetcher = MediaPrefetcher(client, str(tmpdir), max_workers=1)
+
+    # Hold the worker until all messages are queued
+    prefetcher.feed(mock.Mock(msg_id='0', msg_type=ImageMessage.msg_type))
+    client.started.wait(5)
+
+    messages = (
+        mock.Mock(msg_id='1', msg_type=FileMessage.msg_type, filesize=10,
+                  fileext='pdf'),
+        mock.Mock(msg_id='2', msg_type=VoiceMessage.msg_type),
+        mock.Mock(msg_id='3', msg_type=ImageMessage.msg_type),
+        mock.Mock(msg_id='4', msg_type=FileMessage.msg_type,
+                  filesize=10 ** 10, fileext='pdf'),
+        mock.Mock(msg_id='5', msg_type=TextMessage.msg_type))
+    handles = [prefetcher.feed(message) for message in messages]
+
+    assert handles[3] is None
+    assert handles[4] is None
+    assert prefetcher.feed(messages[2]) is handles[2]
+
+    client.event.set()
+    paths = [handle.result(timeout=5) for handle in handles[:3]]
+    prefetcher.shutdown()
+
+    assert paths[0] == str(tmpdir.join('1.pdf'))
+    assert tmpdir.join('3.jpg').read_binary() == b'3'
+    assert client.fetched == ['0', '3', '2', '1']
+    assert prefetcher.get(messages[1]).result() == str(tmpdir.join('2.mp3'))
+
+
+@pytest.mark.parametrize('fileext, path', (
+    ('pdf', '1.pdf'), ('../../etc/passwd', '1.bin'), ('', '1.bin'),
+    ('a' * 11, '1.bin'), (None, '1.bin')))
+def test_media_prefetcher_path(tmpdir, fileext, path):
+    prefetcher = MediaPrefetcher(mock.Mock(), str(tmpdir), max_workers=0)
+    message = mock.Mock(
+        msg_id='1', msg_type=FileMessage.msg_type, fileext=fileext)
+
+    assert prefetcher.get_path(message) == str(tmpdir.join(path))
+    prefetcher.shutdown()
+
+
+class TestAvatarCache:
+
+    @pytest.fixture
+    def client(self):
+
+        def get_head_img(url, headers=None):
+            if headers and headers.get('If-None-Match') == '"v1"':
+                return mock.Mock(status_code=304)
+
+            return mock.Mock(
+                status_code=200, content=url.encode(),
+                headers={'ETag': '"v1"'})
+
+        return mock.Mock(get_head_img=mock.Mock(side_effect=get_head_img))
+
+    def test_cache(self, tmpdir, client):
+        cache = AvatarCache(client, str(tmpdir))
+        url = '/cgi-bin/mmwebwx-bin/webwxgeticon?username=@a&skey={0}'
+
+        assert cache.get_head_img(url.format('k1')) == url.format(
+            'k1').encode()
+        assert cache.get_head_img(url.format('k2')) == url.format(
+            'k1').encode()
+        assert client.get_head_img.call_count == 1
+
+        # Revalidate expired image
+        cache.flush()
+        cache = AvatarCache(client, str(tmpdir), max_age=0)
+        assert cache.get_head_img(url.format('k3')) == url.format(
+            'k1').encode()
+        client.get_head_img.assert_called_with(
+            url.format('k3'), headers={'If-None-Match': '"v1"'})
+
+    def test_evict(self, tmpdir, client):
+        cache = AvatarCache(client, str(tmpdir), max_bytes=100)
+        for idx in range(5):
+            cache.get_head_img('/icon?username=@{0}{1}'.format(idx, 'x' * 30))
+
+        cache.flush()
+        assert cache.total_bytes <= 100
+        assert len(tmpdir.listdir()) == 3
+
+    def test_index_save(self, mocker, tmpdir, client):
+        cache = AvatarCache(client, str(tmpdir))
+        write_index = mocker.spy(cache, '_write_index')
+        for idx in range(5):
+            cache.get_head_img('/icon?username=@{0}'.format(idx))
+
+        # Index is written at most once per save interval
+        assert write_index.call_count == 0
+        cache.index_save_interval = 0
+        cache.get_head_img('/icon?username=@5')
+        assert write_index.call_count == 1
+        cache.flush()
+        assert write_index.call_count == 1
+
+        # Images missing from index are removed on start
+        cache.index_save_interval = 5
+        cache.get_head_img('/icon?username=@6')
+        cache = AvatarCache(client, str(tmpdir))
+        assert len(cache._index) == 6
+        assert len(tmpdir.listdir()) == 7
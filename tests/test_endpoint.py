@@ -0,0 +1,47 @@
+
+import pytest
+
+from pywxclient.core.endpoint import EndpointSelector
+
+
+class TestEndpointSelector:
+
+    def test_select_unsampled_first(self):
+        selector = EndpointSelector(('a.com', 'b.com'))
+        selector.record('a.com', 0.1)
+
+        assert selector.select() == 'b.com'
+
+    @pytest.mark.parametrize(
+        'samples, best', (
+            ((('a.com', 0.5, False), ('b.com', 0.1, False)), 'b.com'),
+            ((('a.com', 0.5, False), ('b.com', 0.1, True)), 'a.com'),
+            ((('a.com', 0.1, False), ('b.com', 0.5, False)), 'a.com')))
+    def test_select_best(self, samples, best):
+        selector = EndpointSelector(('a.com', 'b.com'), explore_ratio=0)
+        for endpoint, latency, error in samples:
+            selector.record(endpoint, latency, error=error)
+
+        assert selector.select() == best
+
+    def test_select_exclude(self):
+        selector = EndpointSelector(('a.com', 'b.com'), explore_ratio=0)
+        selector.record('a.com', 0.1)
+        selector.record('b.com', 0.5)
+
+        assert selector.select(exclude=('a.com',)) == 'b.com'
+
+    def test_probe(self):
+        selector = EndpointSelector(('a.com', 'b.com'))
+
+        def probe(endpoint):
+            if endpoint == 'b.com':
+                raise IOError
+
+        selector.probe(probe)
+        stats = selector.stats()
+
+        assert stats['a.com']['latency'] is not None
+        assert stats['b.com']['latency'] is None
+        assert stats['b.com']['error_rate'] > 0
+        assert selector.select() == 'a.com'
@@ -1,7 +1,9 @@
 
 import pytest
+import threading
 
-from pywxclient.core.message import TextMessage, ImageMessage, FileMessage
+from pywxclient.core.message import (
+    LocalMsgIdGenerator, TextMessage, ImageMessage, FileMessage)
 
 
 class TestMessage:
@@ -151,3 +153,55 @@ class TestMessage:
         assert msg.fileext == ext
         assert msg.create_time == int(msg_value['CreateTime'])
         assert msg.check_ack_status()
+
+    @pytest.mark.parametrize(
+        'msg', (
+            TextMessage('@aaaa', '@bbbb', '你好', local_msg_id='1'),
+            FileMessage('@aaaa', '@bbbb', 'media', 'a.pdf', 12, 'pdf',
+                        local_msg_id='1')))
+    def test_message_for_recipient(self, msg):
+        msg_value = msg.to_value()
+        copied_msg = msg.for_recipient('@cccc')
+        copied_value = copied_msg.to_value()
+
+        assert copied_msg.to_user == '@cccc'
+        assert copied_msg.msg_id is None
+        assert copied_value['ToUserName'] == '@cccc'
+        assert copied_value['Content'] is msg_value['Content']
+        assert copied_value['ClientMsgId'] == copied_msg.local_msg_id
+        assert msg_value['ToUserName'] == '@bbbb'
+        assert type(copied_msg) is type(msg)
+
+        # Copies made within the same millisecond get distinct ids
+        copies = [msg.for_recipient('@cccc') for __ in range(100)]
+        local_ids = {copy_msg.to_value()['LocalID'] for copy_msg in copies}
+        assert len(local_ids | {msg_value['LocalID']}) == 101
+
+
+def test_local_msg_id_generator(mocker):
+    generator = LocalMsgIdGenerator()
+    ids = []
+
+    def generate():
+        ids.extend(generator() for __ in range(1000))
+
+    threads = [threading.Thread(target=generate) for __ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(set(ids)) == len(ids)
+    assert len(str(ids[0])) == 17
+
+    # Clock goes backwards
+    last_id = generator()
+    mocker.patch('time.time', return_value=1)
+    assert generator() == last_id + 1
+
+
+def test_local_msg_id_unique():
+    messages = [TextMessage('@a', '@b', 'hi') for __ in range(100)]
+
+    assert len({msg.local_msg_id for msg in messages}) == 100
+    assert len({msg.create_time for msg in messages}) <= 2
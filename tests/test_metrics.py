@@ -0,0 +1,135 @@
+
+import pytest
+import requests
+
+from pywxclient.core.api import WeChatAPI
+from pywxclient.core.exception import RequestError
+from pywxclient.core.message import TextMessage
+from pywxclient.core.metrics import Instrumentation, MetricsRegistry
+from pywxclient.core.timeout import AdaptiveTimeout
+
+
+class TestMetrics:
+
+    def test_callback_sink(self):
+        events = []
+        instrumentation = Instrumentation(sinks=(events.append,))
+        instrumentation.emit('api', 'do_sync', 0.1, ret=0)
+
+        assert len(events) == 1
+        assert events[0].name == 'do_sync'
+        assert events[0].ret == 0
+
+    def test_registry(self):
+        registry = MetricsRegistry()
+        instrumentation = Instrumentation(sinks=(registry,))
+        instrumentation.emit('http', '/synccheck', 0.2, size=100, status=200)
+        instrumentation.emit('http', '/synccheck', 2, error='ConnectTimeout')
+
+        snapshot = registry.snapshot()
+        key = ('http', '/synccheck')
+        assert snapshot['requests'][key] == 2
+        assert snapshot['latency'][key]['count'] == 2
+        assert snapshot['size'][key]['sum'] == 100
+        assert snapshot['errors'][key + ('ConnectTimeout',)] == 1
+
+        text = registry.to_prometheus()
+        assert (
+            'pywxclient_requests_total{kind="http",name="/synccheck"} 2'
+            in text)
+        assert (
+            'pywxclient_request_latency_seconds_bucket{kind="http",'
+            'name="/synccheck",le="0.25"} 1' in text)
+        assert (
+            'pywxclient_errors_total{kind="http",name="/synccheck",'
+            'exception="ConnectTimeout"} 1' in text)
+
+    def test_registry_labels(self):
+        registry = MetricsRegistry()
+        instrumentation = Instrumentation(sinks=(registry,))
+        for lane in ('bulk', 'bulk', 'interactive'):
+            instrumentation.emit(
+                'queue', 'send_message', 0.1, labels={'lane': lane})
+
+        snapshot = registry.snapshot()
+        assert snapshot['requests'][('queue', 'send_message')] == 3
+        assert snapshot['labeled_requests'][
+            ('queue', 'send_message', (('lane', 'bulk'),))] == 2
+
+        text = registry.to_prometheus()
+        assert (
+            'pywxclient_labeled_requests_total{kind="queue",'
+            'name="send_message",lane="interactive"} 1' in text)
+
+    @pytest.mark.parametrize(
+        'res, ret, error', (
+            ({'BaseResponse': {'Ret': 0}, 'ContactList': []}, 0, None),
+            (RequestError, None, 'RequestError')))
+    def test_api_instrumentation(self, mocker, res, ret, error):
+        registry = MetricsRegistry()
+        mocker.patch.object(
+            WeChatAPI, 'instrumentation', Instrumentation(sinks=(registry,)))
+        mocker.patch.object(
+            WeChatAPI, 'get_base_request', return_value={})
+        timeout_manager = AdaptiveTimeout()
+        mocker.patch.object(WeChatAPI, 'timeout_manager', timeout_manager)
+        decode_func = mocker.patch('pywxclient.core.api.decode_json_response')
+        if isinstance(res, dict):
+            decode_func.return_value = res
+        else:
+            decode_func.side_effect = res
+
+        session = mocker.Mock()
+        session.wx_endpoint = 'wx.qq.com'
+        session.get_wx_session_data.return_value = {'pass_ticket': ''}
+        try:
+            WeChatAPI.mget_contact_list(session, [])
+        except RequestError:
+            pass
+
+        snapshot = registry.snapshot()
+        key = ('api', 'mget_contact_list')
+        assert snapshot['requests'][key] == 1
+        if ret is not None:
+            assert snapshot['ret'][key + (ret,)] == 1
+        if error is not None:
+            assert snapshot['errors'][key + (error,)] == 1
+
+        # Only successful calls are latency samples of adaptive timeout
+        percentile = timeout_manager.get_percentile('mget_contact_list')
+        assert (percentile is None) == (error is not None)
+
+    @pytest.mark.parametrize('error, timeout', (
+        (requests.ReadTimeout, (10, 15)), (requests.ConnectTimeout, (10, 15)),
+        # Fast failures aren't observed
+        (requests.ConnectionError, (3.0, 5.0))))
+    def test_api_timeout_observed(self, mocker, error, timeout):
+        mocker.patch.object(
+            WeChatAPI, 'get_base_request', return_value={})
+        timeout_manager = AdaptiveTimeout(min_samples=5, window=50)
+        mocker.patch.object(WeChatAPI, 'timeout_manager', timeout_manager)
+        mocker.patch('pywxclient.core.api.decode_json_response')
+        for __ in range(20):
+            timeout_manager.observe('send_text_message', 0.1)
+
+        assert WeChatAPI.get_timeout(
+            'send_text_message', (10, 15)) == (3.0, 5.0)
+
+        def post(*args, **kwargs):
+            try:
+                raise error
+            except error as e:
+                raise RequestError from e
+
+        session = mocker.Mock()
+        session.wx_endpoint = 'wx.qq.com'
+        session.get_wx_session_data.return_value = {'pass_ticket': ''}
+        session.post.side_effect = post
+        message = TextMessage('@me', '@a', 'hi')
+        for __ in range(5):
+            with pytest.raises(RequestError):
+                WeChatAPI.send_text_message(session, message)
+
+        # Timed out calls are observed at the applied timeout
+        assert WeChatAPI.get_timeout(
+            'send_text_message', (10, 15)) == timeout
@@ -0,0 +1,34 @@
+
+import requests
+
+from email.parser import BytesParser
+
+from pywxclient.contrib.file import File
+from pywxclient.core.multipart import MultipartEncoder
+
+
+def test_multipart_encoder():
+    source = File(b'hello world')
+    encoder = MultipartEncoder((('id', 'WU_FILE_0'), ('size', 11)))
+    body = encoder.encode(
+        'filename', '哈哈.txt', 'application/txt', source, 6, 5,
+        extra_fields=(('chunk', 1),))
+
+    req = requests.Request(
+        'POST', 'https://file.wx.qq.com/', data=body,
+        headers={'Content-Type': encoder.content_type}).prepare()
+    assert req.headers['Content-Length'] == str(len(body))
+    assert req.body is body
+
+    content = b''.join(body)
+    assert len(content) == len(body)
+
+    message = BytesParser().parsebytes(
+        b'Content-Type: ' + encoder.content_type.encode() + b'\r\n\r\n' +
+        content)
+    parts = message.get_payload()
+    assert [part.get_param('name', header='content-disposition')
+            for part in parts] == ['id', 'size', 'chunk', 'filename']
+    assert parts[1].get_payload(decode=True) == b'11'
+    assert 'filename="哈哈.txt"'.encode() in content
+    assert parts[3].get_payload(decode=True) == b'world'
@@ -0,0 +1,171 @@
+
+import threading
+import time
+
+import pytest
+
+from pywxclient.contrib import SendQueue, TokenBucket
+from pywxclient.core.exception import APIResponseError, SendQueueFull
+from pywxclient.core.message import TextMessage
+from pywxclient.core.metrics import Instrumentation, MetricsRegistry
+
+
+class SendClient:
+
+    def __init__(self, fail_users=()):
+        self.fail_users = fail_users
+        self.sent = []
+        self.event = threading.Event()
+        self.event.set()
+
+    def send_message(self, message, file_obj=None):
+        self.event.wait(5)
+        if message.to_user in self.fail_users:
+            raise APIResponseError('Ret 1205')
+
+        self.sent.append((message.to_user, message.message))
+
+
+def test_token_bucket():
+    bucket = TokenBucket(10, capacity=2)
+
+    assert bucket.consume()
+    assert bucket.consume()
+    assert not bucket.consume()
+    assert 0 < bucket.delay() <= 0.1
+    assert bucket.acquire(timeout=1)
+    assert not bucket.acquire(timeout=0)
+
+    bucket.drain()
+    assert not bucket.is_full()
+
+
+def test_send_queue_recipient_rate():
+    client = SendClient()
+    registry = MetricsRegistry()
+    queue = SendQueue(
+        client, account_rate=1000, account_burst=10, recipient_rate=10,
+        recipient_burst=1, instrumentation=Instrumentation([registry]))
+
+    messages = [
+        TextMessage('me', to_user, text)
+        for to_user, text in (('a', '1'), ('a', '2'), ('b', '3'))]
+    futures = [queue.put(message) for message in messages]
+    assert [future.result(timeout=5) for future in futures] == messages
+    queue.shutdown()
+
+    # Message to b isn't held back by rate limit of a
+    assert client.sent == [('a', '1'), ('b', '3'), ('a', '2')]
+    stats = queue.stats()
+    assert stats['sent'] == 3
+    assert stats['depth'] == 0
+    assert stats['max_wait_time'] >= 0.05
+    snapshot = registry.snapshot()
+    assert snapshot['requests'][('queue', 'send_message')] == 3
+    assert snapshot['labeled_requests'][
+        ('queue', 'send_message', (('lane', 'normal'),))] == 3
+
+
+@pytest.mark.parametrize('block', (True, False))
+def test_send_queue_full(block):
+    client = SendClient()
+    client.event.clear()
+    queue = SendQueue(client, maxsize=1, block=block)
+
+    first = queue.put(TextMessage('me', 'a', '1'))
+    # Wait until dispatcher takes the first message
+    while len(queue):
+        time.sleep(0.01)
+
+    queue.put(TextMessage('me', 'b', '2'))
+    with pytest.raises(SendQueueFull):
+        queue.put(TextMessage('me', 'c', '3'), timeout=0.05)
+
+    client.event.set()
+    first.result(timeout=5)
+    queue.shutdown()
+
+    assert queue.stats()['rejected'] == 1
+    assert client.sent == [('a', '1'), ('b', '2')]
+
+
+def test_send_queue_rejected_message():
+    client = SendClient(fail_users=('a',))
+    queue = SendQueue(client, account_rate=10, account_burst=5)
+
+    failed = queue.put(TextMessage('me', 'a', '1'))
+    sent = queue.put(TextMessage('me', 'b', '2'))
+
+    with pytest.raises(APIResponseError):
+        failed.result(timeout=5)
+
+    start_time = time.monotonic()
+    sent.result(timeout=5)
+    # Account tokens are dropped after server rejection
+    assert time.monotonic() - start_time >= 0.05
+    queue.shutdown()
+
+    assert queue.stats()['failed'] == 1
+
+    with pytest.raises(RuntimeError):
+        queue.put(TextMessage('me', 'b', '3'))
+
+
+def test_send_queue_stats_on_result():
+    client = SendClient(fail_users=('a',))
+    queue = SendQueue(
+        client, account_rate=1000, account_burst=10, recipient_rate=1000,
+        recipient_burst=10)
+
+    for idx in range(20):
+        to_user = 'ab'[idx % 2]
+        future = queue.put(TextMessage('me', to_user, str(idx)))
+        future.exception(timeout=5)
+
+        # Stats are updated before future is resolved
+        stats = queue.stats()
+        assert stats['sent'] + stats['failed'] == idx + 1
+
+    queue.shutdown()
+
+
+@pytest.mark.parametrize(
+    'starvation_timeout, order', (
+        (60, ['r0', 'r1', 'r2', '0', 'r3', 'r4', 'r5', '1']),
+        # Every message is starving, so they are sent in queuing order
+        (0, ['0', '1', 'r0', 'r1', 'r2', 'r3', 'r4', 'r5'])))
+def test_send_queue_lanes(starvation_timeout, order):
+    client = SendClient()
+    client.event.clear()
+    queue = SendQueue(
+        client, account_rate=1000, account_burst=100, recipient_rate=1000,
+        recipient_burst=100, lane_weights={'bulk': 1, 'interactive': 6},
+        starvation_timeout=starvation_timeout)
+
+    # Hold the dispatcher until all messages are queued
+    queue.put(TextMessage('me', 'x', 'hold'))
+    while len(queue):
+        time.sleep(0.01)
+
+    futures = [
+        queue.put(TextMessage('me', 'u', str(idx)), priority='bulk')
+        for idx in range(2)]
+    futures.extend(
+        queue.put(TextMessage('me', 'u', 'r' + str(idx)),
+                  priority='interactive')
+        for idx in range(6))
+
+    with pytest.raises(ValueError):
+        queue.put(TextMessage('me', 'u', 'x'), priority='unknown')
+
+    client.event.set()
+    for future in futures:
+        future.result(timeout=5)
+
+    queue.shutdown()
+
+    assert [text for __, text in client.sent[1:]] == order
+    stats = queue.stats()
+    assert stats['sent'] == 9
+    assert stats['lanes']['bulk']['sent'] == 2
+    assert stats['lanes']['interactive']['sent'] == 6
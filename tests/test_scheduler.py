@@ -0,0 +1,129 @@
+
+import json
+import threading
+import time
+
+from concurrent.futures import Future
+
+import pytest
+
+from pywxclient.contrib import MessageScheduler
+from pywxclient.core.message import FileMessage, TextMessage, VoiceMessage
+
+
+class ScheduleClient:
+
+    def __init__(self):
+        self.sent = []
+        self.event = threading.Event()
+
+    def send_message(self, message):
+        self.sent.append(message)
+        self.event.set()
+
+
+def test_schedule():
+    client = ScheduleClient()
+    scheduler = MessageScheduler(client)
+
+    later = scheduler.schedule(TextMessage('@me', '@a', 'later'), delay=100)
+    cancelled = scheduler.schedule(
+        TextMessage('@me', '@a', 'cancelled'), delay=0.05)
+    scheduler.schedule(TextMessage('@me', '@a', 'soon'), delay=0.05)
+
+    assert scheduler.cancel(cancelled)
+    assert not scheduler.cancel(cancelled)
+    assert client.event.wait(5)
+    time.sleep(0.05)
+
+    assert [msg.message for msg in client.sent] == ['soon']
+    assert len(scheduler) == 1
+    assert scheduler.cancel(later)
+    scheduler.shutdown()
+
+    with pytest.raises(ValueError):
+        scheduler.schedule(VoiceMessage('@me', '@a', 'media'))
+
+
+def test_schedule_persistence(tmpdir):
+    path = str(tmpdir.join('schedule.jsonl'))
+    client = ScheduleClient()
+    scheduler = MessageScheduler(client, path=path)
+    message = FileMessage('@me', '@a', 'media', 'a.pdf', 12, 'pdf')
+    scheduler.schedule(message, at=time.time() + 0.2)
+    scheduler.schedule(TextMessage('@me', '@a', 'later'), delay=100)
+    cancelled = scheduler.schedule(TextMessage('@me', '@a', 'x'), delay=100)
+    scheduler.cancel(cancelled)
+    scheduler.shutdown()
+
+    time.sleep(0.2)
+    scheduler = MessageScheduler(client, path=path)
+    assert client.event.wait(5)
+    scheduler.shutdown()
+
+    sent_message = client.sent[0]
+    assert isinstance(sent_message, FileMessage)
+    assert sent_message.to_value()['Content'] == message.to_value()['Content']
+    assert sent_message.local_msg_id == message.local_msg_id
+    assert len(scheduler) == 1
+    # Journal is compacted on restart
+    assert len(tmpdir.join('schedule.jsonl').readlines()) == 3
+
+
+def test_schedule_retry():
+    client = ScheduleClient()
+    errors = [RuntimeError, RuntimeError, RuntimeError]
+    attempted_ids = []
+
+    def sender(message):
+        attempted_ids.append(message.to_value()['ClientMsgId'])
+        if errors:
+            raise errors.pop()
+
+        client.send_message(message)
+
+    scheduler = MessageScheduler(
+        client, sender=sender, max_attempts=3, retry_delay=0.01)
+    scheduler.schedule(TextMessage('@me', '@a', 'failed'))
+    while errors or len(scheduler):
+        time.sleep(0.01)
+
+    # Given up after max attempts
+    assert not client.sent
+
+    errors.append(RuntimeError)
+    del attempted_ids[:]
+    message = TextMessage('@me', '@a', 'retried')
+    scheduler.schedule(message)
+    assert client.event.wait(5)
+    scheduler.shutdown()
+
+    assert [msg.message for msg in client.sent] == ['retried']
+    # Retried send is the same message to send ledger
+    assert attempted_ids == [message.to_value()['ClientMsgId']] * 2
+
+
+def test_schedule_journal_after_send(tmpdir):
+    path = tmpdir.join('schedule.jsonl')
+    futures = []
+
+    def sender(message):
+        future = Future()
+        futures.append(future)
+        return future
+
+    scheduler = MessageScheduler(None, path=str(path), sender=sender)
+    scheduler.schedule(TextMessage('@me', '@a', 'hi'))
+    while not futures:
+        time.sleep(0.01)
+
+    # Job being sent is kept in journal
+    assert len(scheduler) == 1
+    assert not scheduler.cancel(json.loads(path.readlines()[0])['id'])
+    assert [json.loads(line)['op'] for line in path.readlines()] == ['add']
+
+    futures[0].set_result(None)
+    assert len(scheduler) == 0
+    assert [json.loads(line)['op'] for line in path.readlines()] == [
+        'add', 'del']
+    scheduler.shutdown()
@@ -0,0 +1,104 @@
+
+import io
+
+import pytest
+
+from pywxclient.core.capture import CaptureBuffer
+from pywxclient.core.exception import RequestError
+from pywxclient.core.session import Session
+
+
+class Response:
+
+    status_code = 200
+
+    def __init__(self, content):
+        self.content = content
+
+
+@pytest.fixture
+def session(mocker):
+    session = Session()
+    mocker.patch.object(session, '_req_session')
+    return session
+
+
+class TestSessionHook:
+
+    def test_hooks(self, session):
+        events = []
+        session._req_session.request.return_value = Response(b'ok')
+        session.register_hook(
+            'request', lambda *args: events.append('request'))
+        session.register_hook(
+            'response', lambda *args: events.append('response'))
+
+        res = session.get('https://wx.qq.com/')
+
+        assert res.content == b'ok'
+        assert events == ['request', 'response']
+
+        with pytest.raises(ValueError):
+            session.register_hook('unknown', print)
+
+
+class TestCaptureBuffer:
+
+    def test_capacity(self, session):
+        capture = CaptureBuffer(capacity=3, max_body=4)
+        capture.attach(session)
+        for idx in range(5):
+            session._req_session.request.return_value = Response(
+                'body{0}'.format(idx).encode() * 2)
+            session.get('https://wx.qq.com/', params={'skey': 'secret'})
+
+        exchanges = capture.exchanges()
+        assert len(exchanges) == 3
+        assert exchanges[0]['response_body'].startswith(b'body')
+        assert exchanges[0]['params'] == {'skey': '***'}
+        assert b'...<10 bytes>' in exchanges[0]['response_body']
+
+        capture.detach()
+        session.get('https://wx.qq.com/')
+        assert len(capture) == 3
+
+    def test_exception_dump(self, session):
+        capture = CaptureBuffer(dump_on_error=True)
+        capture.attach(session)
+        session._req_session.request.side_effect = RequestError
+
+        with pytest.raises(RequestError):
+            session.post('https://wx.qq.com/', data=b'{}', stream=True)
+
+        stream = io.StringIO()
+        capture.dump(stream)
+        assert 'POST https://wx.qq.com/' in stream.getvalue()
+        assert 'RequestError' in stream.getvalue()
+
+    def test_redaction(self, session):
+        capture = CaptureBuffer(dump_on_error=True, max_body=120)
+        capture.attach(session)
+        session._req_session.request.return_value = Response(
+            b'<error><ret>0</ret><skey>@crypt_secret</skey>'
+            b'<wxsid>secretsid</wxsid><pass_ticket>secretticket'
+            b'</pass_ticket></error>')
+        session.get(
+            'https://wx.qq.com/cgi-bin/mmwebwx-bin/webwxnewloginpage'
+            '?ticket=secretticket&uuid=abc&scan=1')
+
+        session._req_session.request.side_effect = RequestError
+        with pytest.raises(RequestError):
+            session.post(
+                'https://wx.qq.com/webwxsync?sid=secretsid&SKey=%40secret',
+                params={'Skey': '@secret', 'r': 1},
+                data=('{"BaseRequest": {"Uin": 12345, "Sid": "secretsid", '
+                      '"Skey": "@crypt_secret", "DeviceID": "e123456"}, '
+                      '"rr": 1}'))
+
+        text = capture.dump()
+        for secret in ('secret', '12345', 'e123456'):
+            assert secret not in text
+
+        assert 'uuid=abc' in text
+        assert '"rr": 1' in text
+        assert "'r': 1" in text
@@ -0,0 +1,33 @@
+
+import pytest
+
+from pywxclient.core.timeout import AdaptiveTimeout
+
+
+class TestAdaptiveTimeout:
+
+    def test_default_timeout(self):
+        manager = AdaptiveTimeout(min_samples=5)
+        for __ in range(4):
+            manager.observe('send_text_message', 0.1)
+
+        assert manager.get('send_text_message', (10, 15)) == (10, 15)
+        assert manager.get('do_sync', (15, 30)) == (15, 30)
+
+    @pytest.mark.parametrize(
+        'latency, timeout', (
+            (0.1, (3.0, 5.0)), (2, (6, 6)), (4, (10, 12)), (10, (10, 15))))
+    def test_adaptive_timeout(self, latency, timeout):
+        manager = AdaptiveTimeout(multiplier=3, min_samples=5)
+        for __ in range(10):
+            manager.observe('send_text_message', latency)
+
+        assert manager.get('send_text_message', (10, 15)) == timeout
+
+    def test_percentile(self):
+        manager = AdaptiveTimeout(window=100)
+        for idx in range(1, 101):
+            manager.observe('do_sync', idx / 100)
+
+        assert manager.get_percentile('do_sync') == 0.99
+        assert manager.get_percentile('do_sync', 50) == 0.5
@@ -1,9 +1,12 @@
 
 import pytest
+import threading
+import time
 
 from collections import OrderedDict
 
-from pywxclient.utils import dict2xml, list2orderdict, xml2dict
+from pywxclient.utils import (
+    SingleFlight, dict2xml, list2orderdict, split_text, xml2dict)
 
 
 @pytest.mark.parametrize(
@@ -48,3 +51,67 @@ def test_dict2xml_attr(data, e_xml):
     xml = dict2xml(data)
 
     assert xml == e_xml
+
+
+@pytest.mark.parametrize('error', (None, ValueError('failed')))
+def test_single_flight(error):
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def fetch(url):
+        calls.append(url)
+        started.set()
+        release.wait(5)
+        if error:
+            raise error
+
+        return url.upper()
+
+    def worker():
+        try:
+            results.append(flight.do('key', fetch, 'img'))
+        except ValueError as e:
+            results.append(e)
+
+    threads = [threading.Thread(target=worker) for __ in range(4)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+
+    # Let followers reach the in-flight call
+    time.sleep(0.1)
+    assert flight.in_flight() == 1
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert calls == ['img']
+    assert results == [error or 'IMG'] * 4
+    assert flight.in_flight() == 0
+    assert flight.do('key', str.upper, 'new') == 'NEW'
+
+
+@pytest.mark.parametrize(
+    'text, max_chars, max_bytes, parts', (
+        ('short', 10, None, ['short']),
+        ('Hello world. This is a test! Another line\n\nnew para here', 20,
+         None, ['Hello world.', 'This is a test!', 'Another line',
+                'new para here']),
+        ('a' * 25, 10, None, ['a' * 10, 'a' * 10, 'a' * 5]),
+        ('你好世界。再见世界！', None, 16, ['你好世界。', '再见世界！']),
+        ('你好你好你好', 10, 7, ['你好', '你好', '你好']),
+        ('', 10, None, [])))
+def test_split_text(text, max_chars, max_bytes, parts):
+    assert split_text(text, max_chars=max_chars, max_bytes=max_bytes) == parts
+
+
+def test_split_text_too_small_limit():
+    with pytest.raises(ValueError):
+        split_text('你好', max_bytes=2)
+
+    with pytest.raises(ValueError):
+        split_text('hello', max_chars=0, max_bytes=0)